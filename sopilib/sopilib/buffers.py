@@ -0,0 +1,66 @@
+import numpy as np
+
+from sopilib.schema import audio_dtype
+
+class buffer_cache(object):
+    """
+        Pd array handles kept by name, opened with open_buffer (pyext.Buffer)
+        on first use, so repeated writes to the same arrays skip the lookup.
+        Samples are copied straight into the array's memory when it exposes
+        float32 samples, and arrays are only resized when the length changes.
+
+        Pd arrays may only be touched from the Pd thread.
+    """
+    def __init__(self, open_buffer):
+        self._open = open_buffer
+        self._buffers = {}
+
+    def get(self, name):
+        key = str(name)
+
+        if key not in self._buffers:
+            self._buffers[key] = self._open(name)
+
+        return self._buffers[key]
+
+    def forget(self, name):
+        self._buffers.pop(str(name), None)
+
+    def clear(self):
+        self._buffers.clear()
+
+    def presize(self, names, length):
+        for name in names:
+            buf = self.get(name)
+
+            if len(buf) != length:
+                buf.resize(length)
+                buf.dirty()
+
+    def store(self, name, samples):
+        """
+            Fills the named array with samples, resizing it to fit.
+        """
+        try:
+            buf, view = self._target(self.get(name), len(samples))
+        except (RuntimeError, ValueError):
+            # the array was deleted or recreated since it was cached
+            self.forget(name)
+            buf, view = self._target(self.get(name), len(samples))
+
+        if view is not None:
+            view[:] = samples
+        else:
+            buf[:] = samples
+
+        buf.dirty()
+
+    def _target(self, buf, length):
+        if len(buf) != length:
+            buf.resize(length)
+
+        view = np.asarray(buf)
+        if view.dtype == audio_dtype and view.flags.c_contiguous and view.flags.writeable and len(view) == length:
+            return buf, view
+
+        return buf, None
@@ -0,0 +1,134 @@
+from __future__ import print_function
+
+import subprocess
+import sys
+import threading
+
+import numpy as np
+
+from sopilib import schema
+from sopilib.utils import read_msg, read_msg_into, sopimagenta_path
+
+class worker_died(Exception):
+    """
+        The worker process exited, or closed its end of the pipes, while a
+        request was being sent or its reply read.
+    """
+    pass
+
+class request_yielded(Exception):
+    """
+        The worker suspended the request to serve another one and replied
+        with the yield tag instead. Sending the resume tag continues it.
+    """
+    pass
+
+class worker_client(object):
+    """
+        The client end of a worker process started from sopimagenta_path(name)
+        with the given arguments. The worker's stderr is forwarded with the
+        worker name as a prefix.
+    """
+    def __init__(self, name, protocol, *args):
+        self.name = name
+        self.protocol = protocol
+        # a cancel may be written from another thread while a request is read
+        self._write_lock = threading.Lock()
+
+        self.proc = subprocess.Popen(
+            (sys.executable, sopimagenta_path(name), *map(str, args)),
+            stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE
+        )
+        self._stderr_printer = threading.Thread(target = self._keep_printing_stderr, daemon = True)
+        self._stderr_printer.start()
+
+    def _keep_printing_stderr(self):
+        while True:
+            line = self.proc.stderr.readline()
+
+            if not line:
+                break
+
+            sys.stderr.write("[{}] ".format(self.name))
+            sys.stderr.write(line.decode("utf-8"))
+            sys.stderr.flush()
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def _died(self):
+        return worker_died("{} exited with code {}".format(self.name, self.proc.poll()))
+
+    def write_msg(self, tag, *msgs):
+        try:
+            with self._write_lock:
+                self.proc.stdin.write(self.protocol.to_tag_msg(tag))
+                for msg in msgs:
+                    self.proc.stdin.write(msg)
+                self.proc.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            raise self._died()
+
+    def read(self, n):
+        try:
+            return read_msg(self.proc.stdout, n)
+        except EOFError:
+            raise self._died()
+
+    def read_into(self, buf):
+        try:
+            return read_msg_into(self.proc.stdout, buf)
+        except EOFError:
+            raise self._died()
+
+    def read_struct(self, msg_struct):
+        return msg_struct.from_msg(self.read(msg_struct.size))
+
+    def read_audio(self, length):
+        return schema.from_audio_msg(self.read(schema.audio_size(length))) if length else np.zeros(0, dtype=schema.audio_dtype)
+
+    def read_tag(self, expected_tag=None):
+        tag = self.read_struct(self.protocol.tag_struct)
+
+        if tag == schema.TAG_YIELD:
+            raise request_yielded()
+
+        if expected_tag is not None and tag != expected_tag:
+            raise ValueError("expected tag {}, got {}".format(expected_tag, tag))
+
+        return tag
+
+    def metrics(self):
+        """
+            Request timings of the worker as {tag: (count, total seconds,
+            longest seconds)}.
+        """
+        self.write_msg(schema.TAG_METRICS)
+        return self.read_metrics()
+
+    def read_metrics(self):
+        self.read_tag(schema.TAG_METRICS)
+
+        count = self.read_struct(schema.metrics_count_struct)
+        metrics = {}
+        for i in range(count):
+            tag, handled, total, longest = self.read_struct(schema.metric_struct)
+            metrics[tag] = (handled, total, longest)
+
+        return metrics
+
+    def close(self):
+        if self.alive():
+            self.proc.terminate()
+        self.proc.wait()
+
+        for pipe in (self.proc.stdin, self.proc.stdout):
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                pass
+
+        self._stderr_printer.join()
+        self.proc.stderr.close()
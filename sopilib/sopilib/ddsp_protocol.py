@@ -1,28 +1,55 @@
 from __future__ import print_function
 
-import struct
-
-import numpy as np
+from sopilib.schema import TAG_METRICS, audio_dtype, audio_size, from_audio_msg, from_str_msg, message, simple_conv, to_audio_msg, to_str_msg
 
 IN_TAG_TIMBRE_TRANSFER = 0
+IN_TAG_STREAM_BEGIN = 1
+IN_TAG_STREAM_FRAME = 2
+IN_TAG_STREAM_END = 3
 
 OUT_TAG_INIT = 0
 OUT_TAG_TIMBRE_TRANSFERRED = 1
+OUT_TAG_STREAM_BLOCK = 2
 
 # tag: message type identifier
-tag_struct = struct.Struct("I")
+tag_struct = message(("tag", "I"))
 
 # timbre_transfer: input sample rate, output sample rate, f0 octave shift, f0 confidence threshold, loudness db shift, adjust, quiet, autotune, ckpt path length, source audio length, (ckpt path, source audio)
-timbre_transfer_struct = struct.Struct("IIddd?ddLL")
+timbre_transfer_struct = message(
+    ("in_sample_rate", "I"),
+    ("out_sample_rate", "I"),
+    ("f0_octave_shift", "d"),
+    ("f0_confidence_threshold", "d"),
+    ("loudness_db_shift", "d"),
+    ("adjust", "?"),
+    ("quiet", "d"),
+    ("autotune", "d"),
+    ("ckpt_path_len", "Q"),
+    ("audio_len", "Q")
+)
 
 # timbre_transferred: audio length
-timbre_transferred_struct = struct.Struct("L")
+timbre_transferred_struct = message(("audio_len", "Q"))
+
+# stream_begin: input sample rate, output sample rate, f0 octave shift, f0 confidence threshold, loudness db shift, adjust, quiet, autotune, ckpt path length, block length in input samples, (ckpt path)
+stream_begin_struct = message(
+    ("in_sample_rate", "I"),
+    ("out_sample_rate", "I"),
+    ("f0_octave_shift", "d"),
+    ("f0_confidence_threshold", "d"),
+    ("loudness_db_shift", "d"),
+    ("adjust", "?"),
+    ("quiet", "d"),
+    ("autotune", "d"),
+    ("ckpt_path_len", "Q"),
+    ("block_len", "Q")
+)
 
-def simple_conv(msg_struct):
-    to_msg = lambda *args: msg_struct.pack(*args)
-    from_msg = lambda msg: (lambda t: t if len(t) > 1 else t[0])(msg_struct.unpack(msg))
+# stream_frame: audio length, (audio)
+stream_frame_struct = message(("audio_len", "Q"))
 
-    return to_msg, from_msg
+# stream_block: audio length, last block, (audio)
+stream_block_struct = message(("audio_len", "Q"), ("last", "?"))
 
 to_tag_msg, from_tag_msg = simple_conv(tag_struct)
 
@@ -30,11 +57,8 @@ to_timbre_transfer_msg, from_timbre_transfer_msg = simple_conv(timbre_transfer_s
 
 to_timbre_transferred_msg, from_timbre_transferred_msg = simple_conv(timbre_transferred_struct)
 
-to_str_msg = lambda s: s.encode("utf-8")
-from_str_msg = lambda s: s.decode("utf-8")
+to_stream_begin_msg, from_stream_begin_msg = simple_conv(stream_begin_struct)
 
-def to_audio_msg(buf):
-    return buf.tobytes()
+to_stream_frame_msg, from_stream_frame_msg = simple_conv(stream_frame_struct)
 
-def from_audio_msg(msg):
-    return np.frombuffer(msg, dtype=np.float32)
+to_stream_block_msg, from_stream_block_msg = simple_conv(stream_block_struct)
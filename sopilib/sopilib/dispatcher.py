@@ -0,0 +1,212 @@
+from __future__ import print_function
+
+from collections import deque
+import threading
+import time
+import traceback
+from types import SimpleNamespace
+
+from sopilib.client import request_yielded, worker_died
+from sopilib.supervisor import request_expired
+from sopilib.utils import print_err
+
+# request lanes, served in this order
+PRIORITY_REALTIME = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2
+
+priorities = {
+    "realtime": PRIORITY_REALTIME,
+    "interactive": PRIORITY_INTERACTIVE,
+    "background": PRIORITY_BACKGROUND
+}
+
+class request_dispatcher(object):
+    """
+        Sends requests to a worker_supervisor one at a time from a thread, so
+        callers don't block while the worker renders. At most max_pending
+        requests wait in the queue and submit() refuses more, which lets the
+        caller signal backpressure. A request with a timeout is dropped if it
+        is still queued when the timeout passes, and cancelled on the worker
+        if it is running by then.
+
+        Requests wait in one lane per priority and the highest priority lane
+        is served first; max_pending applies to each lane. A background
+        request that is running when a request of higher priority arrives is
+        asked to yield after its current chunk, and is resumed before the
+        other background requests once the higher lanes are empty.
+    """
+    def __init__(self, supervisor, max_pending=4):
+        self.supervisor = supervisor
+        self.max_pending = max_pending
+
+        self._lanes = [deque() for priority in priorities]
+        self._cond = threading.Condition()
+        self._closed = False
+        self._running = None
+
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def submit(self, tag, *msgs, read_reply=None, done=None, dropped=None, timeout=None, idempotent=True, session_key=None, priority=PRIORITY_INTERACTIVE):
+        """
+            Queues a request. done(reply) is called with the value returned
+            by read_reply(), or dropped(reason) with "expired", "cancelled" or
+            "failed" if the request does not complete. A request with a
+            session_key is sent with supervisor.remember(). Returns False
+            without queueing if max_pending requests are already waiting in
+            the priority's lane.
+        """
+        request = SimpleNamespace(
+            tag = tag,
+            msgs = msgs,
+            read_reply = read_reply,
+            done = done or (lambda reply: None),
+            dropped = dropped or (lambda reason: None),
+            deadline = time.monotonic() + timeout if timeout else None,
+            idempotent = idempotent,
+            session_key = session_key,
+            priority = priority,
+            suspended = False,
+            preempted = False,
+            cancelled = False
+        )
+
+        with self._cond:
+            lane = self._lanes[priority]
+            if self._closed or len(lane) >= self.max_pending:
+                return False
+
+            lane.append(request)
+            self._cond.notify()
+
+            # sent under the lock that hands out the next request, so the
+            # yield only ever reaches the background request; if that one
+            # has just finished, the worker ignores the yield
+            running = self._running
+            if running is not None and running.priority == PRIORITY_BACKGROUND and priority < PRIORITY_BACKGROUND and not running.preempted:
+                running.preempted = self.supervisor.preempt()
+
+        return True
+
+    def pending(self):
+        with self._cond:
+            return sum(len(lane) for lane in self._lanes)
+
+    def cancel(self):
+        """
+            Drops the queued requests and cancels the one running on the
+            worker, or suspended on it.
+        """
+        with self._cond:
+            dropped = [request for lane in self._lanes for request in lane]
+            for lane in self._lanes:
+                lane.clear()
+
+            if self._running is not None:
+                self._running.cancelled = True
+
+        for request in dropped:
+            request.dropped("cancelled")
+
+        self.supervisor.cancel()
+        if any(request.suspended for request in dropped):
+            self.supervisor.discard()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            for lane in self._lanes:
+                lane.clear()
+            self._cond.notify()
+
+    def _next(self):
+        with self._cond:
+            while not any(self._lanes) and not self._closed:
+                self._cond.wait()
+
+            if self._closed:
+                return None
+
+            self._running = next(lane for lane in self._lanes if lane).popleft()
+            return self._running
+
+    def _yielded(self, request):
+        """
+            Puts a suspended request back at the front of its lane, unless it
+            was cancelled while it was yielding.
+        """
+        with self._cond:
+            self._running = None
+            if not request.cancelled and not self._closed:
+                request.suspended = True
+                request.preempted = False
+                self._lanes[request.priority].appendleft(request)
+                return
+
+        request.dropped("cancelled")
+        self.supervisor.discard()
+
+    def _send(self, request):
+        if request.suspended:
+            return self.supervisor.resume(
+                read_reply = request.read_reply,
+                deadline = request.deadline
+            )
+
+        if request.session_key is not None:
+            return self.supervisor.remember(
+                request.session_key,
+                request.tag,
+                *request.msgs,
+                read_reply = request.read_reply
+            )
+
+        return self.supervisor.request(
+            request.tag,
+            *request.msgs,
+            read_reply = request.read_reply,
+            idempotent = request.idempotent,
+            deadline = request.deadline
+        )
+
+    def _run(self):
+        while True:
+            request = self._next()
+            if request is None:
+                return
+
+            if request.deadline is not None and time.monotonic() >= request.deadline:
+                if request.suspended:
+                    self.supervisor.discard()
+                request.dropped("expired")
+                continue
+
+            try:
+                reply = self._send(request)
+            except request_yielded:
+                self._yielded(request)
+                continue
+            except request_expired:
+                request.dropped("expired")
+                continue
+            except worker_died as e:
+                if self._closed:
+                    return
+
+                print_err(e)
+                request.dropped("failed")
+                continue
+            except Exception:
+                traceback.print_exc()
+                request.dropped("failed")
+                continue
+            finally:
+                with self._cond:
+                    if self._running is request:
+                        self._running = None
+
+            try:
+                request.done(reply)
+            except Exception:
+                traceback.print_exc()
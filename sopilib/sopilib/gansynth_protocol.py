@@ -1,47 +1,67 @@
 from __future__ import print_function
 
 import struct
-import sys
 
 import numpy as np
 import math
 
+from sopilib.schema import TAG_METRICS, audio_dtype, from_audio_msg, message, simple_conv, to_audio_msg
+
 
 Z_SIZE = 256
 
 # init: audio length, sample rate
-init_struct = struct.Struct("i" * 2)
+init_struct = message(("audio_length", "Q"), ("sample_rate", "i"))
 
-load_ganspace_components_struct = struct.Struct("255s")
+load_ganspace_components_struct = message(("path", "255s"))
 
 # tag: integer denoting the type of message
-tag_struct = struct.Struct("i")
+tag_struct = message(("tag", "i"))
 
 # z: latent vector as 256 doubles
-z_struct = struct.Struct(Z_SIZE*"d")
+z_struct = message(("z", "{}d".format(Z_SIZE)))
 
 # f64: double-precision float
-f64_struct = struct.Struct("d")
+f64_struct = message(("value", "d"))
 
-int_struct = struct.Struct("i")
+int_struct = message(("value", "i"))
 
 # slerp_z: source 0, source 1, interpolation amount
-slerp_z_struct = struct.Struct(z_struct.format + z_struct.format + f64_struct.format)
+slerp_z_struct = message(("z0", "{}d".format(Z_SIZE)), ("z1", "{}d".format(Z_SIZE)), ("amount", "d"))
 
 # count: integer denoting a number of items
-count_struct = struct.Struct("i")
+count_struct = message(("count", "i"))
 
 # gen_audio: pitch, z
-gen_audio_struct = struct.Struct("i" + (Z_SIZE*"d"))
+gen_audio_struct = message(("pitch", "i"), ("z", "{}d".format(Z_SIZE)))
+
+# the gen_audio layout as a numpy record, for filling requests in place
+gen_audio_dtype = np.dtype([("pitch", "<i4"), ("z", "<f8", (Z_SIZE,))])
+
+f64_dtype = np.dtype("<f8")
 
 # audio_size: length of audio data
-audio_size_struct = struct.Struct("i")
+audio_size_struct = message(("size", "Q"))
 
 # hallucinate: note count, interpolation steps, spacing, start trim, attack, sustain, release
-hallucinate_struct = struct.Struct("i" * 2 + "d" * 5)
+hallucinate_struct = message(
+    ("note_count", "i"),
+    ("interpolation_steps", "i"),
+    ("spacing", "d"),
+    ("start_trim", "d"),
+    ("attack", "d"),
+    ("sustain", "d"),
+    ("release", "d")
+)
 
 # synthesize_noz: pitch, n_edits
-synthesize_noz_struct = struct.Struct("ii")
+synthesize_noz_struct = message(("pitch", "i"), ("edit_count", "i"))
+
+# gen_audio_shifted: max pitch shift in semitones, resampling quality
+gen_audio_shifted_struct = message(("max_shift", "i"), ("quality", "i"))
+
+# note_status: outcome of synthesizing a single note
+note_status_struct = message(("status", "i"))
 
 IN_TAG_RAND_Z = 0
 IN_TAG_SLERP_Z = 1
@@ -51,22 +71,37 @@ IN_TAG_LOAD_COMPONENTS = 4
 IN_TAG_SET_COMPONENT_AMPLITUDES = 5
 IN_TAG_SYNTHESIZE_NOZ = 6
 IN_TAG_HALLUCINATE_NOZ = 7
+IN_TAG_GET_PITCHES = 8
+IN_TAG_GEN_AUDIO_SHIFTED = 9
+IN_TAG_CANCEL = 10
 
 OUT_TAG_INIT = 0
 OUT_TAG_Z = 1
 OUT_TAG_AUDIO = 2
 OUT_TAG_LOAD_COMPONENTS = 3
+OUT_TAG_PITCHES = 4
+OUT_TAG_CANCELLED = 5
 
-def simple_conv(msg_struct):
-    to_msg = lambda *args: msg_struct.pack(*args)
-    from_msg = lambda msg: msg_struct.unpack(msg)[0]
+NOTE_STATUS_OK = 0
+NOTE_STATUS_SNAPPED = 1
+NOTE_STATUS_FAILED = 2
+NOTE_STATUS_CANCELLED = 3
 
-    return to_msg, from_msg
+RESAMPLE_LINEAR = 0
+RESAMPLE_SINC = 1
 
 to_tag_msg, from_tag_msg = simple_conv(tag_struct)
 
 to_count_msg, from_count_msg = simple_conv(count_struct)
 
+to_note_status_msg, from_note_status_msg = simple_conv(note_status_struct)
+
+def to_gen_audio_shifted_msg(max_shift, quality):
+    return gen_audio_shifted_struct.pack(max_shift, quality)
+
+def from_gen_audio_shifted_msg(msg):
+    return gen_audio_shifted_struct.unpack(msg)
+
 def to_float_msg(f):
     return f64_struct.pack(f)
 
@@ -94,6 +129,12 @@ def to_load_ganspace_components_msg(components_file):
 def from_load_ganspace_components_msg(msg):
     return load_ganspace_components_struct.unpack(msg)[0].decode('utf-8').strip().rstrip('\r\n').rstrip('\n')
 
+def to_pitches_msg(pitches):
+    return struct.pack("<{}i".format(len(pitches)), *pitches)
+
+def from_pitches_msg(msg):
+    return list(struct.unpack("<{}i".format(len(msg) // int_struct.size), msg))
+
 def to_info_msg(audio_length, sample_rate):
     return init_struct.pack(audio_length, sample_rate)
 
@@ -101,10 +142,10 @@ def from_info_msg(msg):
     return init_struct.unpack(msg)
 
 def to_z_msg(z):
-    return z_struct.pack(*z)
+    return np.ascontiguousarray(z, dtype=f64_dtype).reshape(Z_SIZE).tobytes()
 
 def from_z_msg(msg):
-    return np.array(z_struct.unpack(msg), dtype=np.float64)
+    return np.frombuffer(msg, dtype=f64_dtype, count=Z_SIZE).astype(np.float64)
 
 to_audio_size_msg, from_audio_size_msg = simple_conv(audio_size_struct)
 
@@ -122,11 +163,38 @@ def from_slerp_z_msg(msg):
     amount = from_f64_msg(msg[2*z_size : ])
     return z0, z1, amount
 
-def to_audio_msg(buf):
-    return buf.tobytes()
+def to_f64_array_msg(values):
+    return np.ascontiguousarray(values, dtype=f64_dtype).tobytes()
+
+def f64_array_size(count):
+    return count * f64_dtype.itemsize
+
+def from_f64_array_msg(msg):
+    return np.frombuffer(msg, dtype=f64_dtype)
+
+def to_component_amplitudes_msg(amplitudes):
+    amplitudes = np.asarray(amplitudes)
+    return to_count_msg(len(amplitudes)) + to_f64_array_msg(amplitudes)
+
+component_amplitudes_size = f64_array_size
 
-def from_audio_msg(msg):
-    return np.frombuffer(msg, dtype=np.float32)
+from_component_amplitudes_msg = from_f64_array_msg
+
+def to_gen_audio_request_msg(pitches, zs):
+    """
+        Packs the count and the gen_audio messages of a whole request into
+        one preallocated buffer. Each z is copied straight into place, so
+        zs can be numpy views of Pd arrays.
+    """
+    msg = bytearray(count_struct.size + len(pitches) * gen_audio_struct.size)
+    count_struct.pack_into(msg, 0, len(pitches))
+
+    notes = np.frombuffer(msg, dtype=gen_audio_dtype, offset=count_struct.size)
+    notes["pitch"] = pitches
+    for i, z in enumerate(zs):
+        notes["z"][i] = z
+
+    return msg
 
 
 def to_hallucinate_msg(
@@ -154,3 +222,33 @@ def to_synthesize_noz_msg(pitch, num_edits):
 
 def from_synthesize_noz_msg(msg):
     return synthesize_noz_struct.unpack(msg)
+
+def to_synthesize_noz_request_msg(pitches, edits):
+    """
+        Packs the count and the synthesize_noz messages of a whole request
+        into one preallocated buffer. The edits of each sound are given as a
+        list of parts, each a number or a sequence of numbers (e.g. a numpy
+        view of a Pd array), which are copied straight into place.
+    """
+    edit_counts = [sum(np.size(part) for part in parts) for parts in edits]
+    msg = bytearray(
+        count_struct.size
+        + len(pitches) * synthesize_noz_struct.size
+        + f64_array_size(sum(edit_counts))
+    )
+    count_struct.pack_into(msg, 0, len(pitches))
+
+    offset = count_struct.size
+    for pitch, parts, edit_count in zip(pitches, edits, edit_counts):
+        synthesize_noz_struct.pack_into(msg, offset, pitch, edit_count)
+        offset += synthesize_noz_struct.size
+
+        sound_edits = np.frombuffer(msg, dtype=f64_dtype, count=edit_count, offset=offset)
+        i = 0
+        for part in parts:
+            n = np.size(part)
+            sound_edits[i:i+n] = part
+            i += n
+        offset += f64_array_size(edit_count)
+
+    return msg
@@ -0,0 +1,79 @@
+from __future__ import print_function
+
+import numpy as np
+
+from sopilib.schema import TAG_METRICS, message, simple_conv
+
+IN_TAG_GENERATE = 0
+IN_TAG_GENERATE_CANDIDATES = 1
+
+OUT_TAG_INIT = 0
+OUT_TAG_GENERATED = 1
+OUT_TAG_CANDIDATES = 2
+
+# candidate scores, higher is better
+SCORE_SIMILARITY = 0 # pitch class histogram closest to the primer's
+SCORE_RANGE = 1      # pitch range closest to the primer's
+SCORE_DENSITY = 2    # notes per second closest to the primer's
+
+# tag: message type identifier
+tag_struct = message(("tag", "i"))
+
+# generate: request id, duration in seconds, tempo in qpm, primer note count, (primer notes)
+generate_struct = message(("request_id", "i"), ("duration", "d"), ("qpm", "d"), ("note_count", "i"))
+
+# generate candidates: request id, duration in seconds, tempo in qpm, primer note count,
+#   candidate count, score type, (primer notes)
+generate_candidates_struct = message(
+    ("request_id", "i"),
+    ("duration", "d"),
+    ("qpm", "d"),
+    ("note_count", "i"),
+    ("candidate_count", "i"),
+    ("score_type", "i")
+)
+
+# candidates: request id, candidate count, (candidates, best first)
+candidates_struct = message(("request_id", "i"), ("candidate_count", "i"))
+
+# candidate: score, note event count, (note events)
+candidate_struct = message(("score", "d"), ("note_count", "i"))
+
+# generated: request id, note event count, (note events)
+generated_struct = message(("request_id", "i"), ("note_count", "i"))
+
+# note event: time in seconds, pitch, velocity (0 for note-off)
+note_dtype = np.dtype([("time", "<f8"), ("pitch", "<i4"), ("vel", "<i4")])
+
+# primer note: start and end time in seconds, pitch, velocity
+primer_note_dtype = np.dtype([("start", "<f8"), ("end", "<f8"), ("pitch", "<i4"), ("vel", "<i4")])
+
+to_tag_msg, from_tag_msg = simple_conv(tag_struct)
+
+to_generate_msg, from_generate_msg = simple_conv(generate_struct)
+
+to_generated_msg, from_generated_msg = simple_conv(generated_struct)
+
+to_generate_candidates_msg, from_generate_candidates_msg = simple_conv(generate_candidates_struct)
+
+to_candidates_msg, from_candidates_msg = simple_conv(candidates_struct)
+
+to_candidate_msg, from_candidate_msg = simple_conv(candidate_struct)
+
+def to_notes_msg(notes):
+    return np.array(notes, dtype=note_dtype).tobytes()
+
+def from_notes_msg(msg):
+    return np.frombuffer(msg, dtype=note_dtype)
+
+def notes_size(count):
+    return count * note_dtype.itemsize
+
+def to_primer_notes_msg(notes):
+    return np.asarray(notes, dtype=primer_note_dtype).tobytes()
+
+def from_primer_notes_msg(msg):
+    return np.frombuffer(msg, dtype=primer_note_dtype)
+
+def primer_notes_size(count):
+    return count * primer_note_dtype.itemsize
@@ -0,0 +1,96 @@
+import numpy as np
+
+def closest_pitch_indices(pitches, requested):
+    """
+        Finds the index of the closest available pitch for each requested pitch.
+        pitches must be sorted. Ties go to the lower pitch.
+    """
+    pitches = np.asarray(pitches)
+    requested = np.asarray(requested)
+    last_i = len(pitches) - 1
+
+    i_r = np.searchsorted(pitches, requested)
+    i_l = np.clip(i_r - 1, 0, last_i)
+    i_r = np.clip(i_r, 0, last_i)
+
+    diff_l = np.abs(requested - pitches[i_l])
+    diff_r = np.abs(pitches[i_r] - requested)
+
+    return np.where(diff_l <= diff_r, i_l, i_r)
+
+def pitch_rate(pitch, base_pitch):
+    """
+        Playback rate that turns audio at base_pitch into audio at pitch.
+    """
+    return 2.0**((np.asarray(pitch) - np.asarray(base_pitch))/12.0)
+
+def resample_linear(audio, rate):
+    """
+        Plays audio back at the given rate, keeping its length. The tail is
+        zero-padded when rate > 1.
+    """
+    if rate == 1.0:
+        return audio
+
+    n = audio.shape[-1]
+    positions = np.arange(n) * rate
+
+    return np.interp(positions, np.arange(n), audio, right=0.0).astype(audio.dtype)
+
+def resample_sinc(audio, rate, half_width=16, block_size=8192):
+    """
+        Like resample_linear, but with Hann-windowed sinc interpolation. The
+        kernel is widened to band-limit the signal when rate > 1.
+    """
+    if rate == 1.0:
+        return audio
+
+    n = audio.shape[-1]
+    cutoff = min(1.0, 1.0/rate)
+    width = int(np.ceil(half_width / cutoff))
+    taps = np.arange(-width + 1, width + 1)
+
+    out = np.zeros(n, dtype=audio.dtype)
+    for start in range(0, n, block_size):
+        positions = np.arange(start, min(start + block_size, n)) * rate
+        idx = np.floor(positions).astype(np.int64)[:, None] + taps
+        x = positions[:, None] - idx
+
+        window = 0.5 + 0.5*np.cos(np.pi * np.clip(x / width, -1.0, 1.0))
+        weights = cutoff * np.sinc(cutoff * x) * window
+
+        valid = (idx >= 0) & (idx < n)
+        samples = np.where(valid, audio[np.clip(idx, 0, n - 1)], 0.0)
+
+        out[start:start + len(positions)] = np.sum(samples * weights, axis=1)
+
+    return out
+
+def base_pitches(trained, requested, max_shift):
+    """
+        Picks a base pitch for each requested pitch so that neighbouring pitches
+        can share one rendered note: every requested pitch gets a trained pitch
+        at most max_shift semitones away, preferring bases that cover as many
+        requested pitches as possible. Pitches with no trained pitch in range
+        fall back to the closest trained pitch.
+    """
+    trained = np.asarray(trained)
+    requested = np.asarray(requested)
+    bases = trained[closest_pitch_indices(trained, requested)]
+
+    order = np.argsort(requested, kind="stable")
+    i = 0
+    while i < len(order):
+        pitch = requested[order[i]]
+        in_range = trained[np.abs(trained - pitch) <= max_shift]
+
+        if len(in_range) == 0:
+            i += 1
+            continue
+
+        base = in_range[-1]
+        while i < len(order) and abs(requested[order[i]] - base) <= max_shift:
+            bases[order[i]] = base
+            i += 1
+
+    return bases
@@ -0,0 +1,105 @@
+import numpy as np
+
+from sopilib.melody_rnn_protocol import primer_note_dtype
+
+class primer_buffer(object):
+    """
+        Keeps the most recent notes played into a model as an array of
+        finished (start, end, pitch, velocity) notes, built up as note-on and
+        note-off events arrive, along with a rolling tempo estimate. At most
+        max_notes notes are kept, so the primer stays the same size however
+        long a session runs.
+    """
+    def __init__(self, max_notes=256, tempo_window=16):
+        self._notes = np.zeros(max_notes, dtype=primer_note_dtype)
+        self._first = 0
+        self._count = 0
+
+        self._onsets = np.zeros(tempo_window, dtype=np.float64)
+        self._onset_count = 0
+
+        self._notes_on = {}
+
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        self._first = 0
+        self._count = 0
+        self._onset_count = 0
+        self._notes_on.clear()
+
+    def resize(self, max_notes):
+        """
+            Changes the number of kept notes, keeping the most recent ones.
+        """
+        kept = min(self._count, max_notes)
+        ix = (self._first + self._count - kept + np.arange(kept)) % len(self._notes)
+
+        notes = np.zeros(max_notes, dtype=primer_note_dtype)
+        notes[:kept] = self._notes[ix]
+
+        self._notes = notes
+        self._first = 0
+        self._count = kept
+
+    def add(self, t, pitch, vel):
+        # a note is added only after a note-on and a corresponding note-off
+        if vel > 0:
+            self._notes_on[pitch] = (t, vel)
+            self._onsets[self._onset_count % len(self._onsets)] = t
+            self._onset_count += 1
+            return
+
+        if pitch not in self._notes_on:
+            return
+
+        t_on, vel_on = self._notes_on.pop(pitch)
+
+        capacity = len(self._notes)
+        i = (self._first + self._count) % capacity
+        if self._count == capacity:
+            # drop the oldest note
+            self._first = (self._first + 1) % capacity
+        else:
+            self._count += 1
+
+        self._notes[i] = (t_on, t, pitch, vel_on)
+
+    def notes(self):
+        """
+            The kept notes sorted by start time, with times relative to the
+            first start.
+        """
+        ix = (self._first + np.arange(self._count)) % len(self._notes)
+        notes = self._notes[ix]
+        notes = notes[np.argsort(notes["start"], kind="stable")]
+
+        if len(notes) > 0:
+            t0 = notes["start"][0]
+            notes["start"] -= t0
+            notes["end"] -= t0
+
+        return notes
+
+    def qpm(self, default=120.0, min_notes=5, min_interval=0.05):
+        """
+            Estimates the tempo from the median interval between recent
+            onsets, ignoring near-simultaneous ones.
+        """
+        if self._count < min_notes:
+            return default
+
+        n = min(self._onset_count, len(self._onsets))
+        onsets = np.sort(self._onsets[:n])
+        intervals = np.diff(onsets)
+        intervals = intervals[intervals >= min_interval]
+
+        if len(intervals) == 0:
+            return default
+
+        qpm = 60.0 / np.median(intervals)
+        if qpm > 240:
+            qpm /= 2
+
+        return float(qpm)
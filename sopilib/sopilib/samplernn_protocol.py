@@ -1,30 +1,46 @@
 from __future__ import print_function
 
-import struct
-
 import numpy as np
 
+from sopilib.schema import TAG_METRICS, audio_dtype, audio_size, from_audio_msg, from_str_msg, message, simple_conv, to_audio_msg, to_str_msg
+
 IN_TAG_GENERATE = 0
+IN_TAG_GENERATE_CHUNKED = 1
+IN_TAG_CANCEL = 2
 
 OUT_TAG_INIT = 0
 OUT_TAG_GENERATED = 1
+OUT_TAG_CHUNK = 2
 
 # tag: message type identifier
-tag_struct = struct.Struct("I")
+tag_struct = message(("tag", "I"))
 
-size_struct = struct.Struct("N")
+size_struct = message(("size", "Q"))
 
 # generate: seed sample rate, output sample rate, number of outputs, output audio duration, seed audio length, (seed audio, temp1 length, temp1 string, temp2 length, temp2 string...)
-generate_struct = struct.Struct("IIINN")
+generate_struct = message(
+    ("seed_sample_rate", "I"),
+    ("out_sample_rate", "I"),
+    ("num_outputs", "I"),
+    ("duration", "Q"),
+    ("seed_len", "Q")
+)
+
+# generate_chunked: like generate, followed by the chunk length in output samples
+generate_chunked_struct = message(
+    ("seed_sample_rate", "I"),
+    ("out_sample_rate", "I"),
+    ("num_outputs", "I"),
+    ("duration", "Q"),
+    ("seed_len", "Q"),
+    ("chunk_len", "Q")
+)
+
+# chunk: offset in output samples, chunk length, last chunk, (chunk audio of each output)
+chunk_struct = message(("offset", "Q"), ("chunk_len", "Q"), ("last", "?"))
 
 # generated: output sample rate, number of outputs, output audio length, (output audios)
-generated_struct = struct.Struct("IIN")
-
-def simple_conv(msg_struct):
-    to_msg = lambda *args: msg_struct.pack(*args)
-    from_msg = lambda msg: (lambda t: t if len(t) > 1 else t[0])(msg_struct.unpack(msg))
-
-    return to_msg, from_msg
+generated_struct = message(("out_sample_rate", "I"), ("num_outputs", "I"), ("audio_len", "Q"))
 
 to_tag_msg, from_tag_msg = simple_conv(tag_struct)
 
@@ -34,15 +50,10 @@ to_generate_msg, from_generate_msg = simple_conv(generate_struct)
 
 to_generated_msg, from_generated_msg = simple_conv(generated_struct)
 
-to_str_msg = lambda s: s.encode("utf-8")
-from_str_msg = lambda s: s.decode("utf-8")
+to_generate_chunked_msg, from_generate_chunked_msg = simple_conv(generate_chunked_struct)
 
-f32_struct = struct.Struct("f")
+to_chunk_msg, from_chunk_msg = simple_conv(chunk_struct)
 
-to_f32_msg, from_f32_msg = simple_conv(f32_struct)
-
-def to_audio_msg(buf):
-    return buf.tobytes()
+f32_struct = message(("value", "f"))
 
-def from_audio_msg(msg):
-    return np.frombuffer(msg, dtype=np.float32)
+to_f32_msg, from_f32_msg = simple_conv(f32_struct)
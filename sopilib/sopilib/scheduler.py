@@ -0,0 +1,105 @@
+import heapq
+import itertools
+import threading
+import time
+
+from sopilib.utils import print_err
+
+class scheduler(object):
+    """
+        Runs timed callbacks on a single thread. Events are kept in a heap of
+        deadlines (time.monotonic seconds); events of a sequence that share a
+        timestamp are delivered to their callback in one call.
+    """
+    # below this, wait by yielding instead of on the condition for precision
+    spin_time = 0.002
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def schedule_sequence(self, t0, events, callback, group = None):
+        """
+            Schedules events, a list of (time offset, payload), relative to the
+            monotonic time t0. callback(payloads) is called once per distinct
+            time. Returns the deadline of the last event.
+        """
+        batches = {}
+        for t, payload in events:
+            batches.setdefault(t, []).append(payload)
+
+        with self._cond:
+            for t, payloads in batches.items():
+                heapq.heappush(self._heap, (t0 + t, next(self._counter), group, callback, payloads))
+            self._cond.notify()
+
+        return t0 + max(batches) if batches else t0
+
+    def cancel(self, group):
+        """
+            Drops all pending events of a group.
+        """
+        with self._cond:
+            self._heap = [entry for entry in self._heap if entry[2] != group]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def flush(self, group):
+        """
+            Delivers all pending events of a group right away, in their
+            order, on the scheduler thread.
+        """
+        with self._cond:
+            now = time.monotonic()
+            flushed = sorted(entry for entry in self._heap if entry[2] == group)
+
+            self._heap = [entry for entry in self._heap if entry[2] != group]
+            for deadline, _, group, callback, payloads in flushed:
+                self._heap.append((now, next(self._counter), group, callback, payloads))
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._heap = []
+            self._cond.notify()
+
+    def _next_due(self):
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                remaining = self._heap[0][0] - time.monotonic()
+                if remaining <= 0:
+                    return heapq.heappop(self._heap)
+
+                if remaining > self.spin_time:
+                    self._cond.wait(remaining - self.spin_time)
+                else:
+                    self._cond.release()
+                    try:
+                        time.sleep(0)
+                    finally:
+                        self._cond.acquire()
+
+    def _run(self):
+        while True:
+            entry = self._next_due()
+            if entry is None:
+                return
+
+            deadline, _, group, callback, payloads = entry
+            try:
+                callback(payloads)
+            except Exception as e:
+                print_err("scheduled callback failed: {}".format(e))
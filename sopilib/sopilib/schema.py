@@ -0,0 +1,86 @@
+from __future__ import print_function
+
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from sopilib.utils import read_msg
+
+# tags reserved by the worker runtime in every protocol
+TAG_METRICS = 0x7FFFFFFF
+# in: suspend the running chunked request, out: the request was suspended
+TAG_YIELD = 0x7FFFFFFE
+# in: continue the suspended request, which then replies as usual
+TAG_RESUME = 0x7FFFFFFD
+# in: drop the suspended request without a reply
+TAG_DISCARD = 0x7FFFFFFC
+
+class message(object):
+    """
+        A fixed-size message declared as a list of (name, struct format)
+        fields. The fields are compiled into a single struct.Struct once, and
+        a message can be used wherever a struct.Struct is expected. Unpacking
+        gives a namedtuple when each field holds one value.
+
+        Messages are little-endian with standard sizes and no alignment
+        padding unless another byte order is given, so they can cross
+        hosts and architectures.
+    """
+    def __init__(self, *fields, byte_order="<"):
+        self.names = tuple(name for name, fmt in fields)
+        self.struct = struct.Struct(byte_order + "".join(fmt for name, fmt in fields))
+        self.format = self.struct.format
+        self.size = self.struct.size
+        self.pack = self.struct.pack
+        self.pack_into = self.struct.pack_into
+
+        if len(self.names) > 1 and len(self.struct.unpack(bytes(self.size))) == len(self.names):
+            self._tuple = namedtuple("message", self.names)._make
+        else:
+            self._tuple = None
+
+    def unpack(self, msg):
+        values = self.struct.unpack(msg)
+        return self._tuple(values) if self._tuple else values
+
+    def unpack_from(self, buf, offset=0):
+        values = self.struct.unpack_from(buf, offset)
+        return self._tuple(values) if self._tuple else values
+
+    def to_msg(self, *args):
+        return self.struct.pack(*args)
+
+    def from_msg(self, msg):
+        values = self.unpack(msg)
+        return values if len(values) > 1 else values[0]
+
+    def read(self, stream):
+        return self.from_msg(read_msg(stream, self.size))
+
+def simple_conv(msg_struct):
+    to_msg = lambda *args: msg_struct.pack(*args)
+    from_msg = lambda msg: (lambda t: t if len(t) > 1 else t[0])(msg_struct.unpack(msg))
+
+    return to_msg, from_msg
+
+# audio payloads: little-endian float32 samples
+audio_dtype = np.dtype("<f4")
+
+to_str_msg = lambda s: s.encode("utf-8")
+from_str_msg = lambda s: s.decode("utf-8")
+
+def to_audio_msg(buf):
+    return np.ascontiguousarray(buf, dtype=audio_dtype).tobytes()
+
+def from_audio_msg(msg):
+    return np.frombuffer(msg, dtype=audio_dtype)
+
+def audio_size(length):
+    return length * audio_dtype.itemsize
+
+# metrics: entry count, (metric entries)
+metrics_count_struct = message(("count", "i"))
+
+# metric: request tag, handled count, total seconds, longest seconds
+metric_struct = message(("tag", "i"), ("count", "q"), ("total", "d"), ("longest", "d"))
@@ -0,0 +1,298 @@
+from __future__ import print_function
+
+from collections import OrderedDict
+import threading
+import time
+
+from sopilib import schema
+from sopilib.client import worker_client, worker_died
+from sopilib.utils import print_err
+
+class request_expired(Exception):
+    """
+        A request passed its deadline. It was cancelled on the worker, or the
+        worker was restarted to abandon it if it did not answer the cancel in
+        time.
+    """
+    pass
+
+class deadline_watch(object):
+    """
+        Sends cancel_tag to the client's worker when the deadline
+        (time.monotonic seconds) passes, and kills the worker if the request
+        is still running grace seconds later.
+    """
+    def __init__(self, client, deadline, grace, cancel_tag):
+        self.client = client
+        self.grace = grace
+        self.cancel_tag = cancel_tag
+        self.expired = False
+
+        self._lock = threading.Lock()
+        self._done = False
+        self._start_timer(max(0.0, deadline - time.monotonic()), self._expire)
+
+    def _start_timer(self, seconds, fn):
+        self._timer = threading.Timer(seconds, fn)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _expire(self):
+        with self._lock:
+            if self._done:
+                return
+
+            self.expired = True
+            if self.cancel_tag is not None:
+                try:
+                    self.client.write_msg(self.cancel_tag)
+                except worker_died:
+                    return
+
+            self._start_timer(self.grace, self._kill)
+
+    def _kill(self):
+        with self._lock:
+            if self._done:
+                return
+
+            print_err("[{}] request not cancelled in time, killing the worker".format(self.client.name))
+            self.client.proc.kill()
+
+    def done(self):
+        with self._lock:
+            self._done = True
+            self._timer.cancel()
+
+class worker_supervisor(object):
+    """
+        Keeps a worker running for a client. The worker is started with
+        worker_client(name, protocol, *args) and init(client) reads its init
+        messages. When the worker dies, it is reaped and replaced, by a warm
+        spare started in the background if spare is set, and the session
+        state registered with remember() is sent to the new worker again.
+        Idempotent requests that were in flight are then sent again.
+
+        Replies are read through the supervisor's read methods from the
+        read_reply callable given with each request.
+
+        A request can have a deadline. The running request is cancelled when
+        the deadline passes, and the worker is restarted if it has not
+        replied cancel_grace seconds later.
+
+        A chunked request can be suspended with preempt(), in which case
+        request() raises request_yielded, and continued with resume().
+    """
+    cancel_grace = 2.0
+
+    def __init__(self, name, protocol, args, init, spare=False, retries=1):
+        self.name = name
+        self.protocol = protocol
+        self.restarts = 0
+
+        self._args = args
+        self._init = init
+        self._use_spare = spare
+        self._retries = retries
+        self._session = OrderedDict()
+
+        self._spare = None
+        self._spare_starter = None
+        self._spare_lock = threading.Lock()
+        self._closed = False
+        self._in_flight = False
+
+        self.client, self.info = self._start()
+
+        if spare:
+            self._start_spare()
+
+    def _start(self):
+        client = worker_client(self.name, self.protocol, *self._args)
+
+        try:
+            info = self._init(client)
+        except:
+            client.close()
+            raise
+
+        return client, info
+
+    def _keep_spare(self):
+        try:
+            spare = self._start()
+        except Exception as e:
+            print_err("[{}] failed to start a spare: {}".format(self.name, e))
+            return
+
+        with self._spare_lock:
+            # a spare that finishes starting after close() is not kept
+            if not self._closed:
+                self._spare = spare
+                return
+
+        spare[0].close()
+
+    def _start_spare(self):
+        self._spare_starter = threading.Thread(target = self._keep_spare, daemon = True)
+        self._spare_starter.start()
+
+    def _take_spare(self):
+        if not self._spare_starter:
+            return None
+
+        self._spare_starter.join()
+        self._spare_starter = None
+
+        spare, self._spare = self._spare, None
+        if spare and not spare[0].alive():
+            spare[0].close()
+            return None
+
+        return spare
+
+    def restart(self):
+        """
+            Replaces the worker and restores the session on the new one.
+        """
+        print_err("[{}] worker died, restarting".format(self.name))
+        self.client.close()
+
+        for attempt in range(self._retries + 1):
+            self.client, self.info = self._take_spare() or self._start()
+            self.restarts += 1
+
+            if self._use_spare:
+                self._start_spare()
+
+            try:
+                for tag, msgs, read_reply in self._session.values():
+                    self.client.write_msg(tag, *msgs)
+                    if read_reply:
+                        read_reply()
+                return
+            except worker_died:
+                if attempt == self._retries:
+                    raise
+                self.client.close()
+
+    def request(self, tag, *msgs, read_reply=None, idempotent=True, deadline=None):
+        """
+            Sends a request and returns read_reply(). If the worker dies on
+            the way, it is restarted, and the request is sent again if it is
+            idempotent; otherwise worker_died is raised after the restart.
+            If the deadline (time.monotonic seconds) passed while the request
+            was running, request_expired is raised instead of returning the
+            reply to the cancel, or after restarting the killed worker.
+        """
+        for attempt in range(self._retries + 1):
+            watch = None
+            if deadline is not None:
+                cancel_tag = getattr(self.protocol, "IN_TAG_CANCEL", None)
+                watch = deadline_watch(self.client, deadline, self.cancel_grace, cancel_tag)
+
+            self._in_flight = True
+            try:
+                self.client.write_msg(tag, *msgs)
+                reply = read_reply() if read_reply else None
+
+                if watch:
+                    watch.done()
+                    if watch.expired:
+                        raise request_expired("request {} passed its deadline".format(tag))
+
+                return reply
+            except worker_died:
+                if watch:
+                    watch.done()
+
+                if self._closed:
+                    raise
+
+                self.restart()
+
+                if watch and watch.expired:
+                    raise request_expired("request {} passed its deadline".format(tag))
+
+                if not idempotent or attempt == self._retries:
+                    raise
+            finally:
+                self._in_flight = False
+                if watch:
+                    watch.done()
+
+    def resume(self, read_reply=None, deadline=None):
+        """
+            Continues the request the worker suspended. A suspended request
+            does not survive a restart, so it is not sent again.
+        """
+        return self.request(schema.TAG_RESUME, read_reply=read_reply, idempotent=False, deadline=deadline)
+
+    def _control(self, tag, idle=False):
+        if self._in_flight or idle:
+            try:
+                self.client.write_msg(tag)
+                return True
+            except worker_died:
+                pass
+
+        return False
+
+    def cancel(self):
+        """
+            Asks the worker to abandon the running request, if any.
+        """
+        self._control(self.protocol.IN_TAG_CANCEL)
+
+    def discard(self):
+        """
+            Asks the worker to drop the request it suspended, if any.
+        """
+        self._control(schema.TAG_DISCARD, idle = True)
+
+    def preempt(self):
+        """
+            Asks the worker to suspend the running request after its current
+            chunk. Returns False if no request was in flight to ask.
+        """
+        return self._control(schema.TAG_YIELD)
+
+    def remember(self, key, tag, *msgs, read_reply=None):
+        """
+            Sends a request that sets session state and keeps it under key
+            (replacing earlier state under the same key) to be sent again
+            after a restart.
+        """
+        self._session[key] = (tag, msgs, read_reply)
+        return self.request(tag, *msgs, read_reply=read_reply)
+
+    def forget(self, key):
+        self._session.pop(key, None)
+
+    def read(self, n):
+        return self.client.read(n)
+
+    def read_into(self, buf):
+        return self.client.read_into(buf)
+
+    def read_struct(self, msg_struct):
+        return self.client.read_struct(msg_struct)
+
+    def read_audio(self, length):
+        return self.client.read_audio(length)
+
+    def read_tag(self, expected_tag=None):
+        return self.client.read_tag(expected_tag)
+
+    def metrics(self):
+        return self.request(schema.TAG_METRICS, read_reply=lambda: self.client.read_metrics())
+
+    def close(self):
+        with self._spare_lock:
+            self._closed = True
+            spare, self._spare = self._spare, None
+
+        if spare:
+            spare[0].close()
+
+        self.client.close()
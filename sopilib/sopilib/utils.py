@@ -13,14 +13,43 @@ def read_msg(stdin, size):
     if not msg:
         raise EOFError("stdin")
 
+    # unbuffered pipes may return large messages in pieces
+    while len(msg) < size:
+        part = stdin.read(size - len(msg))
+
+        if not part:
+            raise EOFError("stdin")
+
+        msg += part
+
     return msg
 
+def read_msg_into(stdin, buf):
+    """
+        Fills a writable buffer (e.g. a numpy array) from stdin without
+        intermediate copies.
+    """
+    view = memoryview(buf).cast("B")
+
+    while len(view) > 0:
+        n = stdin.readinto(view)
+
+        if not n:
+            raise EOFError("stdin")
+
+        view = view[n:]
+
+    return buf
+
 def sopimagenta_path(fn):
     # TODO: a less fragile solution
     diry = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "sopimagenta/sopimagenta")
     path = lambda suf: os.path.join(diry, suf)
     d = {
-        "gansynth_worker": path("gansynth/worker.py")
+        "ddsp_worker": path("ddsp/worker.py"),
+        "gansynth_worker": path("gansynth/worker.py"),
+        "melody_rnn_worker": path("melody_rnn/worker.py"),
+        "samplernn_worker": path("samplernn/worker.py")
     }
     
     return d[fn]
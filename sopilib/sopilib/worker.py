@@ -0,0 +1,173 @@
+from __future__ import print_function
+
+import os
+import select
+import sys
+import time
+
+from sopilib import schema
+from sopilib.utils import print_err, read_msg
+
+def control_requested(stdin, protocol):
+    """
+        Reads a cancel, yield or discard message without blocking. Returns
+        its tag, or None if nothing is waiting. Clients send nothing but
+        these while a request is running.
+    """
+    readable, _, _ = select.select([stdin], [], [], 0)
+    if not readable:
+        return None
+
+    in_tag = protocol.from_tag_msg(read_msg(stdin, protocol.tag_struct.size))
+    if in_tag not in (getattr(protocol, "IN_TAG_CANCEL", None), schema.TAG_YIELD, schema.TAG_DISCARD):
+        raise ValueError("unexpected input message tag during a request: {}".format(in_tag))
+
+    return in_tag
+
+def cancel_requested(stdin, protocol):
+    """
+        Checks for a cancel message without blocking.
+    """
+    return control_requested(stdin, protocol) == protocol.IN_TAG_CANCEL
+
+class chunked_job(object):
+    """
+        A request rendered in chunks of chunk_size items. render(start, end)
+        returns the result of a chunk and finish(chunks) writes the reply
+        from all of them.
+
+        Between chunks the job checks for control messages. A cancel stops
+        it and cancelled(chunks) replies with the chunks rendered so far. A
+        yield parks the job in the worker state and replies with the yield
+        tag, and a resume request continues it later. A discard drops the
+        parked job, not this one. Every run renders at
+        least one chunk, so a job that keeps being yielded still progresses.
+    """
+    def __init__(self, render, count, chunk_size, finish, cancelled):
+        self.render = render
+        self.count = count
+        self.chunk_size = max(1, chunk_size)
+        self.finish = finish
+        self.cancelled = cancelled
+        self.chunks = []
+        self.start = 0
+
+    def run(self, stdin, stdout, state, protocol):
+        rendered = False
+        while self.start < self.count:
+            control = control_requested(stdin, protocol) if rendered else None
+
+            if control == schema.TAG_YIELD:
+                print_err("yielding after {} of {} items".format(self.start, self.count))
+                state["suspended"] = self
+                stdout.write(protocol.to_tag_msg(schema.TAG_YIELD))
+                stdout.flush()
+                return
+
+            if control == schema.TAG_DISCARD:
+                state.pop("suspended", None)
+                continue
+
+            if control is not None:
+                print_err("cancelled after {} of {} items".format(self.start, self.count))
+                self.cancelled(self.chunks)
+                return
+
+            end = min(self.start + self.chunk_size, self.count)
+            self.chunks.append(self.render(self.start, end))
+            self.start = end
+            rendered = True
+
+        self.finish(self.chunks)
+
+class worker(object):
+    """
+        The request loop of a worker process. Tagged requests are read from
+        stdin and passed to the handler registered for the tag, which is
+        called as handler(*context, stdin, stdout, state) and writes its reply
+        to stdout. Every handler call is timed; the reserved metrics tag
+        replies with the timings per request tag.
+
+        A handler that renders through a chunked_job can be suspended by a
+        yield, and the reserved resume tag continues it. Only the reserved
+        discard tag drops the suspended job; resuming when none is suspended
+        replies with the protocol's OUT_TAG_CANCELLED.
+    """
+    def __init__(self, protocol, *context):
+        self.protocol = protocol
+        self.context = context
+        self.handlers = {}
+        self.state = {}
+        self.metrics = {}
+
+        self.stdin = os.fdopen(sys.stdin.fileno(), "rb", 0)
+        self.stdout = os.fdopen(sys.stdout.fileno(), "wb", 0)
+
+    def handler(self, tag):
+        def register(fn):
+            self.handlers[tag] = fn
+            return fn
+
+        return register
+
+    def add_handlers(self, handlers):
+        self.handlers.update(handlers)
+
+    def start(self, *init_msgs):
+        """
+            Tells the client the worker is ready, followed by any messages
+            the protocol sends along with init.
+        """
+        self.stdout.write(self.protocol.to_tag_msg(self.protocol.OUT_TAG_INIT))
+        for msg in init_msgs:
+            self.stdout.write(msg)
+        self.stdout.flush()
+
+    def read_tag(self):
+        return self.protocol.from_tag_msg(read_msg(self.stdin, self.protocol.tag_struct.size))
+
+    def handle(self, tag):
+        if tag == schema.TAG_METRICS:
+            self.write_metrics()
+            return
+
+        if tag == schema.TAG_YIELD:
+            # the request finished before the yield arrived
+            return
+
+        if tag == schema.TAG_DISCARD:
+            self.state.pop("suspended", None)
+            return
+
+        handler = self.resume if tag == schema.TAG_RESUME else self.handlers.get(tag)
+        if handler is None:
+            raise ValueError("unknown input message tag: {}".format(tag))
+
+        t0 = time.perf_counter()
+        handler(*self.context, self.stdin, self.stdout, self.state)
+        self.record(tag, time.perf_counter() - t0)
+
+    def resume(self, *args):
+        job = self.state.pop("suspended", None)
+        if job is None:
+            print_err("no suspended request to resume")
+            self.stdout.write(self.protocol.to_tag_msg(self.protocol.OUT_TAG_CANCELLED))
+            self.stdout.flush()
+            return
+
+        job.run(self.stdin, self.stdout, self.state, self.protocol)
+
+    def record(self, tag, seconds):
+        count, total, longest = self.metrics.get(tag, (0, 0.0, 0.0))
+        self.metrics[tag] = (count + 1, total + seconds, max(longest, seconds))
+
+    def write_metrics(self):
+        self.stdout.write(self.protocol.to_tag_msg(schema.TAG_METRICS))
+        self.stdout.write(schema.metrics_count_struct.pack(len(self.metrics)))
+        for tag, (count, total, longest) in sorted(self.metrics.items()):
+            self.stdout.write(schema.metric_struct.pack(tag, count, total, longest))
+        self.stdout.flush()
+
+    def serve(self):
+        while True:
+            self.handle(self.read_tag())
@@ -0,0 +1,242 @@
+from __future__ import print_function
+
+try:
+    import pyext
+except:
+    print("ERROR: This script must be loaded by the PD/Max pyext external")
+
+import os
+import queue
+import sys
+import threading
+
+import numpy as np
+
+from sopilib.client import worker_client, worker_died
+import sopilib.ddsp_protocol as protocol
+from sopilib.utils import print_err
+
+class ddsp(pyext._class):
+    def __init__(self, *args):
+        self._inlets = 1
+        self._outlets = 1
+        self._worker = None
+        self._stream_reader = None
+        self._results = queue.Queue()
+
+        self.sample_rate = 44100
+        self.f0_octave_shift = 0.0
+        self.f0_confidence_threshold = 0.85
+        self.loudness_db_shift = 0.0
+        self.adjust = True
+        self.quiet = 20.0
+        self.autotune = 0.0
+
+    def load_1(self):
+        if self._worker != None:
+            self.unload_1()
+
+        print("starting ddsp_worker process, this may take a while", file=sys.stderr)
+
+        self._worker = worker_client("ddsp_worker", protocol)
+        self._worker.read_tag(protocol.OUT_TAG_INIT)
+
+        print("ddsp_worker is ready", file=sys.stderr)
+        self._outlet(1, "loaded")
+
+    def unload_1(self):
+        if self._worker:
+            self._worker.close()
+            self._worker = None
+        else:
+            print("no ddsp_worker process is running", file=sys.stderr)
+
+        self._outlet(1, "unloaded")
+
+    def sample_rate_1(self, sample_rate):
+        self.sample_rate = int(sample_rate)
+
+    def f0_octave_shift_1(self, octaves):
+        self.f0_octave_shift = float(octaves)
+
+    def f0_confidence_threshold_1(self, threshold):
+        self.f0_confidence_threshold = float(threshold)
+
+    def loudness_db_shift_1(self, db):
+        self.loudness_db_shift = float(db)
+
+    # adjust on|off [quiet [autotune]]: move pitch and loudness towards the
+    # training data, quieting parts with no detected notes by quiet dB and
+    # snapping notes to the scale by the autotune amount (0-1)
+    def adjust_1(self, on, quiet=None, autotune=None):
+        self.adjust = str(on) not in ("0", "off")
+
+        if quiet is not None:
+            self.quiet = float(quiet)
+        if autotune is not None:
+            self.autotune = float(autotune)
+
+    def _ckpt_msg(self, ckpt_dir):
+        return protocol.to_str_msg(os.path.join(self._canvas_dir, str(ckpt_dir)))
+
+    def _streaming(self):
+        return self._stream_reader is not None and self._stream_reader.is_alive()
+
+    def timbre_transfer_1(self, ckpt_dir, in_buf_name, out_buf_name):
+        if not self._worker:
+            raise Exception("can't transfer timbre - no ddsp_worker process is running")
+
+        if self._streaming():
+            raise Exception("can't transfer timbre - a stream is running")
+
+        ckpt_msg = self._ckpt_msg(ckpt_dir)
+
+        in_audio = np.array(pyext.Buffer(in_buf_name), dtype=np.float32)
+
+        timbre_transfer_msg = protocol.to_timbre_transfer_msg(
+            self.sample_rate,
+            self.sample_rate,
+            self.f0_octave_shift,
+            self.f0_confidence_threshold,
+            self.loudness_db_shift,
+            self.adjust,
+            self.quiet,
+            self.autotune,
+            len(ckpt_msg),
+            len(in_audio)
+        )
+        self._worker.write_msg(
+            protocol.IN_TAG_TIMBRE_TRANSFER,
+            timbre_transfer_msg,
+            ckpt_msg,
+            protocol.to_audio_msg(in_audio)
+        )
+
+        self._worker.read_tag(protocol.OUT_TAG_TIMBRE_TRANSFERRED)
+
+        out_len_msg = self._worker.read(protocol.timbre_transferred_struct.size)
+        out_len = protocol.from_timbre_transferred_msg(out_len_msg)
+
+        out_audio_msg = self._worker.read(protocol.audio_size(out_len)) if out_len else b""
+        out_audio = protocol.from_audio_msg(out_audio_msg)
+
+        out_buf = pyext.Buffer(out_buf_name)
+        if len(out_buf) != len(out_audio):
+            out_buf.resize(len(out_audio))
+
+        out_buf[:] = out_audio
+        out_buf.dirty()
+
+        self._outlet(1, ["transferred", out_len])
+
+    # stream_begin ckpt_dir out_buf [block_size]: start a streaming transfer;
+    # each stream_frame in_buf sends the contents of in_buf, and output blocks
+    # are written to out_buf on the poll after the worker produces them, each
+    # followed by a "block" message. stream_end flushes the remaining output
+    def stream_begin_1(self, ckpt_dir, out_buf_name, block_size=2048):
+        if not self._worker:
+            raise Exception("can't stream - no ddsp_worker process is running")
+
+        if self._streaming():
+            raise Exception("can't stream - a stream is already running")
+
+        ckpt_msg = self._ckpt_msg(ckpt_dir)
+
+        stream_begin_msg = protocol.to_stream_begin_msg(
+            self.sample_rate,
+            self.sample_rate,
+            self.f0_octave_shift,
+            self.f0_confidence_threshold,
+            self.loudness_db_shift,
+            self.adjust,
+            self.quiet,
+            self.autotune,
+            len(ckpt_msg),
+            int(block_size)
+        )
+        self._worker.write_msg(protocol.IN_TAG_STREAM_BEGIN, stream_begin_msg, ckpt_msg)
+
+        self._stream_reader = threading.Thread(target = self._keep_reading_stream, args = (out_buf_name,), daemon = True)
+        self._stream_reader.start()
+
+    def stream_frame_1(self, in_buf_name):
+        if not self._streaming():
+            raise Exception("can't stream - no stream is running")
+
+        frame = np.array(pyext.Buffer(in_buf_name), dtype=np.float32)
+        self._worker.write_msg(
+            protocol.IN_TAG_STREAM_FRAME,
+            protocol.to_stream_frame_msg(len(frame)),
+            protocol.to_audio_msg(frame)
+        )
+
+    def stream_end_1(self):
+        if not self._streaming():
+            raise Exception("can't stream - no stream is running")
+
+        self._worker.write_msg(protocol.IN_TAG_STREAM_END)
+
+    # poll: apply the stream blocks that arrived since the last poll to the
+    # output array and outlet; bang it from a [metro] while streaming
+    def poll_1(self):
+        while True:
+            try:
+                deliver, reply = self._results.get_nowait()
+            except queue.Empty:
+                return
+
+            deliver(reply)
+
+    def _on_pd_thread(self, fn):
+        """
+            Returns a callback for the reader thread that passes its argument
+            to fn on the next poll.
+        """
+        return lambda reply: self._results.put((fn, reply))
+
+    def _stream_block(self, out_buf_name, block):
+        out_buf = pyext.Buffer(out_buf_name)
+        if len(out_buf) != len(block):
+            out_buf.resize(len(block))
+
+        out_buf[:] = block
+        out_buf.dirty()
+
+        self._outlet(1, ["block", len(block)])
+
+    def _keep_reading_stream(self, out_buf_name):
+        stream_block = self._on_pd_thread(lambda block: self._stream_block(out_buf_name, block))
+        outlet = self._on_pd_thread(lambda msg: self._outlet(1, msg))
+
+        try:
+            while True:
+                self._worker.read_tag(protocol.OUT_TAG_STREAM_BLOCK)
+
+                block_msg = self._worker.read(protocol.stream_block_struct.size)
+                block_len, last = protocol.from_stream_block_msg(block_msg)
+
+                block_audio_msg = self._worker.read(protocol.audio_size(block_len)) if block_len else b""
+                block = protocol.from_audio_msg(block_audio_msg)
+
+                if block_len:
+                    stream_block(block)
+
+                if last:
+                    break
+        except worker_died as e:
+            print_err("ddsp_worker exited during a stream: {}".format(e))
+            outlet("failed")
+            return
+
+        outlet("streamed")
+
+    def metrics_1(self):
+        if not self._worker:
+            raise Exception("can't get metrics - no ddsp_worker process is running")
+
+        # the worker's stdout belongs to the reader thread until it finishes
+        if self._streaming():
+            raise Exception("can't get metrics - a stream is running")
+
+        for tag, (count, total, longest) in self._worker.metrics().items():
+            self._outlet(1, ["metrics", tag, count, total, longest])
@@ -0,0 +1,477 @@
+# based on the ddsp timbre transfer colab
+# https://github.com/magenta/ddsp/blob/main/ddsp/colab/demos/timbre_transfer.ipynb
+
+from __future__ import print_function
+
+import collections
+import hashlib
+import os
+import pickle
+import sys
+
+import gin
+import librosa
+import numpy as np
+
+import ddsp
+import ddsp.training
+from ddsp.colab.colab_utils import auto_tune, detect_notes, fit_quantile_transform, get_tuning_factor
+import tensorflow.compat.v2 as tf
+
+import sopilib.ddsp_protocol as protocol
+from sopilib.utils import print_err, read_msg, suppress_stdout
+import sopilib.worker
+
+# ddsp models are trained on 16 kHz audio
+model_sample_rate = 16000
+
+class checkpoint(object):
+    """
+        The files of a trained model directory, read once per path. Model
+        instances depend on the input length through gin, so they are kept per
+        number of frames.
+    """
+    max_models = 4
+
+    def __init__(self, ckpt_dir):
+        self.ckpt_dir = ckpt_dir
+        self.gin_file = os.path.join(ckpt_dir, "operative_config-0.gin")
+
+        ckpt_files = [f for f in tf.io.gfile.listdir(ckpt_dir) if "ckpt" in f]
+        if not ckpt_files:
+            raise ValueError("no checkpoint in {}".format(ckpt_dir))
+        self.ckpt = os.path.join(ckpt_dir, ckpt_files[0].split(".")[0])
+
+        stats_path = os.path.join(ckpt_dir, "dataset_statistics.pkl")
+        self.dataset_stats = None
+        if tf.io.gfile.exists(stats_path):
+            with tf.io.gfile.GFile(stats_path, "rb") as f:
+                self.dataset_stats = pickle.load(f)
+
+        self._parse_gin()
+        time_steps_train = gin.query_parameter("F0LoudnessPreprocessor.time_steps")
+        n_samples_train = gin.query_parameter("Harmonic.n_samples")
+        self.hop_size = int(n_samples_train / time_steps_train)
+
+        self.models = collections.OrderedDict()
+
+    def _parse_gin(self, params=()):
+        with gin.unlock_config():
+            gin.parse_config_file(self.gin_file, skip_unknown=True)
+            gin.parse_config(list(params))
+
+    def model(self, time_steps):
+        if time_steps in self.models:
+            self.models.move_to_end(time_steps)
+            return self.models[time_steps]
+
+        n_samples = time_steps * self.hop_size
+        self._parse_gin([
+            "Harmonic.n_samples = {}".format(n_samples),
+            "FilteredNoise.n_samples = {}".format(n_samples),
+            "F0LoudnessPreprocessor.time_steps = {}".format(time_steps),
+            "oscillator_bank.use_angular_cumsum = True"
+        ])
+
+        model = ddsp.training.models.Autoencoder()
+        model.restore(self.ckpt)
+
+        self.models[time_steps] = model
+        if len(self.models) > self.max_models:
+            self.models.popitem(last=False)
+
+        return model
+
+class lru_cache(collections.OrderedDict):
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def get(self, key):
+        if key not in self:
+            return None
+
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        if len(self) > self.max_size:
+            self.popitem(last=False)
+
+checkpoints = lru_cache(4)
+features = lru_cache(16)
+
+def get_checkpoint(ckpt_dir):
+    ckpt = checkpoints.get(ckpt_dir)
+
+    if ckpt is None:
+        print_err("loading {}".format(ckpt_dir))
+        ckpt = checkpoint(ckpt_dir)
+        checkpoints.put(ckpt_dir, ckpt)
+
+    return ckpt
+
+def compute_features(audio):
+    with suppress_stdout():
+        audio_features = ddsp.training.metrics.compute_audio_features(audio[np.newaxis, :])
+    audio_features["loudness_db"] = audio_features["loudness_db"].astype(np.float32)
+
+    return audio_features
+
+def get_features(audio, sample_rate):
+    """
+        f0 and loudness of the audio at the model sample rate, cached by a hash
+        of the source audio.
+    """
+    key = hashlib.sha1(audio.tobytes()).hexdigest(), sample_rate
+    audio_features = features.get(key)
+
+    if audio_features is None:
+        if sample_rate != model_sample_rate:
+            audio = librosa.resample(audio, orig_sr=sample_rate, target_sr=model_sample_rate)
+
+        audio_features = compute_features(audio)
+        features.put(key, audio_features)
+
+    return audio_features
+
+def fix_length(audio, length):
+    if len(audio) >= length:
+        return audio[:length]
+
+    return np.pad(audio, (0, length - len(audio)))
+
+def resample(audio, src_rate, dst_rate, length):
+    if src_rate != dst_rate:
+        audio = librosa.resample(audio, orig_sr=src_rate, target_sr=dst_rate)
+
+    return fix_length(audio, length)
+
+def shift_f0(audio_features, octaves):
+    audio_features["f0_hz"] = audio_features["f0_hz"] * 2.0**octaves
+    audio_features["f0_hz"] = np.clip(audio_features["f0_hz"], 0.0, librosa.midi_to_hz(110.0))
+    return audio_features
+
+class loudness_history(object):
+    """
+        The note-on loudness of the frames a stream has synthesized so far.
+        The loudness quantile transform is fitted to the history instead of
+        each block alone, so that the loudness mapping settles over the stream
+        instead of jumping between blocks. Only the last new_frames frames of
+        each window are new; the rest is context that was added before.
+    """
+    max_frames = 2**14
+
+    def __init__(self, new_frames):
+        self.new_frames = new_frames
+        self.loudness_db = np.zeros(0, dtype=np.float32)
+
+    def normalize(self, loudness_db, mask_on, inv_quantile):
+        new_loudness_db = loudness_db[-self.new_frames:][mask_on[-self.new_frames:]]
+        self.loudness_db = np.concatenate((self.loudness_db, new_loudness_db))[-self.max_frames:]
+
+        fitted = self.loudness_db if len(self.loudness_db) else loudness_db[mask_on]
+        quantile_transform = fit_quantile_transform(fitted, np.ones(len(fitted), dtype=bool))
+
+        loudness_norm = np.ravel(loudness_db.copy())[:, np.newaxis]
+        loudness_norm[mask_on] = inv_quantile.inverse_transform(quantile_transform.transform(loudness_norm[mask_on]))
+
+        return loudness_norm
+
+def adjust_features(audio_features, dataset_stats, f0_confidence_threshold, quiet, autotune, octave=None, history=None):
+    """
+        Moves pitch and loudness towards the statistics of the training data.
+        The octave shift is estimated from the detected notes unless given,
+        and the loudness is mapped with the loudness_history if given.
+        Returns the adjusted features and the octave shift.
+    """
+    audio_features_mod = {k: v.copy() for k, v in audio_features.items()}
+
+    mask_on, note_on_value = detect_notes(
+        audio_features["loudness_db"],
+        audio_features["f0_confidence"],
+        f0_confidence_threshold
+    )
+
+    if not np.any(mask_on):
+        return audio_features_mod, octave
+
+    if octave is None:
+        pitch = ddsp.core.hz_to_midi(audio_features["f0_hz"])
+        p_diff_octave = (dataset_stats["mean_pitch"] - np.mean(pitch[mask_on])) / 12.0
+        round_fn = np.floor if p_diff_octave > 1.5 else np.ceil
+        octave = round_fn(p_diff_octave)
+    audio_features_mod = shift_f0(audio_features_mod, octave)
+
+    if history is None:
+        _, loudness_norm = fit_quantile_transform(
+            audio_features["loudness_db"],
+            mask_on,
+            inv_quantile=dataset_stats["quantile_transform"]
+        )
+    else:
+        loudness_norm = history.normalize(audio_features["loudness_db"], mask_on, dataset_stats["quantile_transform"])
+    mask_off = np.logical_not(mask_on)
+    loudness_norm[mask_off] -= quiet * (1.0 - note_on_value[mask_off][:, np.newaxis])
+    audio_features_mod["loudness_db"] = np.reshape(loudness_norm, audio_features["loudness_db"].shape)
+
+    if autotune:
+        f0_midi = np.array(ddsp.core.hz_to_midi(audio_features_mod["f0_hz"]))
+        tuning_factor = get_tuning_factor(f0_midi, audio_features_mod["f0_confidence"], mask_on)
+        f0_midi_at = auto_tune(f0_midi, tuning_factor, mask_on, amount=autotune)
+        audio_features_mod["f0_hz"] = ddsp.core.midi_to_hz(f0_midi_at)
+
+    return audio_features_mod, octave
+
+def timbre_transfer(ckpt, audio_features, f0_octave_shift, f0_confidence_threshold, loudness_db_shift, adjust, quiet, autotune, octave=None, history=None):
+    """
+        Returns the synthesized audio and the octave shift used for adjusting.
+    """
+    time_steps = len(audio_features["audio"][0]) // ckpt.hop_size
+    n_samples = time_steps * ckpt.hop_size
+
+    audio_features = {
+        "audio": audio_features["audio"][:, :n_samples],
+        "f0_hz": audio_features["f0_hz"][:time_steps],
+        "f0_confidence": audio_features["f0_confidence"][:time_steps],
+        "loudness_db": audio_features["loudness_db"][:time_steps]
+    }
+
+    if adjust and ckpt.dataset_stats is not None:
+        audio_features, octave = adjust_features(
+            audio_features,
+            ckpt.dataset_stats,
+            f0_confidence_threshold,
+            quiet,
+            autotune,
+            octave,
+            history
+        )
+    else:
+        audio_features = {k: v.copy() for k, v in audio_features.items()}
+
+    audio_features["loudness_db"] += loudness_db_shift
+    audio_features = shift_f0(audio_features, f0_octave_shift)
+
+    model = ckpt.model(time_steps)
+    with suppress_stdout():
+        outputs = model(audio_features, training=False)
+
+    return np.asarray(model.get_audio_from_outputs(outputs))[0], octave
+
+class stream(object):
+    """
+        Timbre transfer of audio that arrives in frames. The input is cut into
+        blocks of whole model frames, and each block is synthesized with the
+        preceding overlap as context, so f0 tracking is not cut off at block
+        edges. Consecutive blocks are crossfaded, which holds the output back
+        by the crossfade length. The octave shift chosen by adjust is kept for
+        the whole stream, and its loudness mapping is fitted to the loudness
+        history of the stream.
+    """
+    # crepe looks at 1024 samples around each frame
+    min_overlap = 1024
+
+    def __init__(self, ckpt, in_rate, out_rate, block_len, params):
+        self.ckpt = ckpt
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.params = params
+        self.octave = None
+
+        hop = ckpt.hop_size
+        self.block_n = max(1, int(round(block_len * model_sample_rate / in_rate / hop))) * hop
+        self.overlap_n = max(self.block_n, int(np.ceil(self.min_overlap / hop)) * hop)
+        self.window_n = self.overlap_n + self.block_n
+        self.history = loudness_history(self.block_n // hop)
+
+        self.fade = max(0, min(self._out_pos(self.overlap_n) // 2, self._out_pos(self.block_n) - 1))
+        self.fade_in = (np.arange(self.fade, dtype=np.float32) + 0.5) / max(self.fade, 1)
+        self.fade_out = 1.0 - self.fade_in
+
+        self.input = np.zeros(0, dtype=np.float32)
+        self.input_offset = 0
+        self.input_len = 0
+        self.block_count = 0
+        self.held = None
+        self.out_len = 0
+
+    def _in_pos(self, n):
+        return int(round(n * self.in_rate / model_sample_rate))
+
+    def _out_pos(self, n):
+        return int(round(n * self.out_rate / model_sample_rate))
+
+    def feed(self, audio):
+        """
+            Adds input audio and returns the output blocks that became ready.
+        """
+        self.input = np.concatenate((self.input, audio))
+        self.input_len += len(audio)
+
+        blocks = []
+        while self._in_pos((self.block_count + 1) * self.block_n) <= self.input_len:
+            blocks.append(self._process_block())
+
+        return blocks
+
+    def end(self):
+        """
+            Pads the input to a whole block and returns the remaining output,
+            cut to the length of the input.
+        """
+        remaining = int(round(self.input_len * self.out_rate / self.in_rate)) - self.out_len
+
+        blocks = []
+        if self._in_pos(self.block_count * self.block_n) < self.input_len:
+            end = self._in_pos((self.block_count + 1) * self.block_n)
+            self.input = np.concatenate((self.input, np.zeros(end - self.input_len, dtype=np.float32)))
+            blocks.append(self._process_block())
+
+        if self.held is not None:
+            blocks.append(self.held)
+            self.held = None
+
+        for i, block in enumerate(blocks):
+            blocks[i] = block[:max(0, remaining)]
+            remaining -= len(blocks[i])
+
+        return blocks
+
+    def _process_block(self):
+        w1 = (self.block_count + 1) * self.block_n
+        w0 = w1 - self.window_n
+        i0 = self._in_pos(w0)
+        i1 = self._in_pos(w1)
+
+        segment = self.input[max(i0, 0) - self.input_offset:i1 - self.input_offset]
+        if i0 < 0:
+            segment = np.concatenate((np.zeros(-i0, dtype=np.float32), segment))
+        window = resample(segment, self.in_rate, model_sample_rate, self.window_n)
+
+        # keep the input needed as context for the next window
+        keep_from = max(self._in_pos(w0 + self.block_n) - 1, self.input_offset)
+        self.input = self.input[keep_from - self.input_offset:]
+        self.input_offset = keep_from
+
+        out, self.octave = timbre_transfer(self.ckpt, compute_features(window), *self.params, octave=self.octave, history=self.history)
+        window_out = resample(out.astype(np.float32), model_sample_rate, self.out_rate, self._out_pos(w1) - self._out_pos(w0))
+
+        n = len(window_out)
+        block_out = self._out_pos(w1) - self._out_pos(w1 - self.block_n)
+        faded = window_out[n - block_out - self.fade:n - block_out]
+        rest = window_out[n - block_out:n - self.fade]
+
+        if self.held is None:
+            # the first block starts with the input
+            block = rest
+        else:
+            block = np.concatenate((self.held * self.fade_out + faded * self.fade_in, rest))
+        self.held = window_out[n - self.fade:]
+
+        self.block_count += 1
+        self.out_len += len(block)
+
+        return block
+
+def handle_timbre_transfer(stdin, stdout, state):
+    timbre_transfer_msg = read_msg(stdin, protocol.timbre_transfer_struct.size)
+    (
+        in_sample_rate,
+        out_sample_rate,
+        f0_octave_shift,
+        f0_confidence_threshold,
+        loudness_db_shift,
+        adjust,
+        quiet,
+        autotune,
+        ckpt_path_len,
+        in_audio_len
+    ) = protocol.from_timbre_transfer_msg(timbre_transfer_msg)
+
+    ckpt_path = protocol.from_str_msg(read_msg(stdin, ckpt_path_len))
+    in_audio_msg = read_msg(stdin, protocol.audio_size(in_audio_len)) if in_audio_len else b""
+    in_audio = protocol.from_audio_msg(in_audio_msg)
+
+    ckpt = get_checkpoint(ckpt_path)
+    audio_features = get_features(in_audio, in_sample_rate)
+
+    out_audio, octave = timbre_transfer(
+        ckpt,
+        audio_features,
+        f0_octave_shift,
+        f0_confidence_threshold,
+        loudness_db_shift,
+        adjust,
+        quiet,
+        autotune
+    )
+
+    if out_sample_rate != model_sample_rate:
+        out_audio = librosa.resample(out_audio, orig_sr=model_sample_rate, target_sr=out_sample_rate)
+    out_audio = out_audio.astype(np.float32)
+
+    stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_TIMBRE_TRANSFERRED))
+    stdout.write(protocol.to_timbre_transferred_msg(len(out_audio)))
+    stdout.write(protocol.to_audio_msg(out_audio))
+    stdout.flush()
+
+def write_stream_blocks(stdout, blocks, last):
+    if last and not blocks:
+        blocks = [np.zeros(0, dtype=np.float32)]
+
+    for i, block in enumerate(blocks):
+        block = block.astype(np.float32)
+        stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_STREAM_BLOCK))
+        stdout.write(protocol.to_stream_block_msg(len(block), last and i == len(blocks) - 1))
+        stdout.write(protocol.to_audio_msg(block))
+    stdout.flush()
+
+def handle_stream_begin(stdin, stdout, state):
+    stream_begin_msg = read_msg(stdin, protocol.stream_begin_struct.size)
+    (
+        in_sample_rate,
+        out_sample_rate,
+        f0_octave_shift,
+        f0_confidence_threshold,
+        loudness_db_shift,
+        adjust,
+        quiet,
+        autotune,
+        ckpt_path_len,
+        block_len
+    ) = protocol.from_stream_begin_msg(stream_begin_msg)
+
+    ckpt_path = protocol.from_str_msg(read_msg(stdin, ckpt_path_len))
+    params = (f0_octave_shift, f0_confidence_threshold, loudness_db_shift, adjust, quiet, autotune)
+
+    state["stream"] = stream(get_checkpoint(ckpt_path), in_sample_rate, out_sample_rate, block_len, params)
+
+def handle_stream_frame(stdin, stdout, state):
+    frame_len = protocol.from_stream_frame_msg(read_msg(stdin, protocol.stream_frame_struct.size))
+    frame_msg = read_msg(stdin, protocol.audio_size(frame_len)) if frame_len else b""
+    frame = protocol.from_audio_msg(frame_msg)
+
+    if "stream" not in state:
+        print_err("no stream running, ignoring frame")
+        return
+
+    write_stream_blocks(stdout, state["stream"].feed(frame), False)
+
+def handle_stream_end(stdin, stdout, state):
+    current = state.pop("stream", None)
+    write_stream_blocks(stdout, current.end() if current else [], True)
+
+handlers = {
+    protocol.IN_TAG_TIMBRE_TRANSFER: handle_timbre_transfer,
+    protocol.IN_TAG_STREAM_BEGIN: handle_stream_begin,
+    protocol.IN_TAG_STREAM_FRAME: handle_stream_frame,
+    protocol.IN_TAG_STREAM_END: handle_stream_end
+}
+
+worker = sopilib.worker.worker(protocol)
+worker.add_handlers(handlers)
+worker.start()
+worker.serve()
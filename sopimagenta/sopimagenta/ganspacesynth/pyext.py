@@ -6,17 +6,19 @@ except:
     print("ERROR: This script must be loaded by the PD/Max pyext external")
 
 import os
+import queue
 import random
-import subprocess
 import sys
-import threading
 import time
 from types import SimpleNamespace
 
 import numpy as np
 
+from sopilib.buffers import buffer_cache
+from sopilib.dispatcher import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, priorities, request_dispatcher
 import sopilib.gansynth_protocol as protocol
-from sopilib.utils import print_err, sopimagenta_path
+from sopilib.supervisor import worker_supervisor
+from sopilib.utils import print_err
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
@@ -43,10 +45,16 @@ class halluseq(pyext._class):
     def __init__(self, edits_buf_name, *args):
         self._inlets = 1
         self._outlets = 1
+        self._buffers = buffer_cache(pyext.Buffer)
         self._edits_buf_name = edits_buf_name
         self._component_count = None
-        self._proc = None
-        self._stderr_printer = None
+        self._worker = None
+        self._requests = None
+        self._results = queue.Queue()
+        self._spare = False
+        self._timeout = None
+        self._max_pending = 4
+        self._priorities = {"hallucinate_noz": PRIORITY_BACKGROUND}
         self._steps = []
         self._step_ix = 0
         self._steps.append(self._new_step())
@@ -57,42 +65,113 @@ class halluseq(pyext._class):
         self._sustain = 0.5
         self._release = 0.5
         
-    def load_1(self, ckpt_dir, batch_size=1):
-        if self._proc != None:
+    def load_1(self, ckpt_dir, batch_size=1, *audio_buf_names):
+        if self._worker != None:
             self.unload_1()
             
-        python = sys.executable
-        worker_script = sopimagenta_path("gansynth_worker")
         ckpt_dir = os.path.join(self._canvas_dir, str(ckpt_dir))
 
         print_err("starting gansynth_worker process, this may take a while")
 
-        self._proc = subprocess.Popen(
-            (python, worker_script, ckpt_dir, str(batch_size)),
-            stdin = subprocess.PIPE,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE
+        self._worker = worker_supervisor(
+            "gansynth_worker",
+            protocol,
+            (ckpt_dir, batch_size),
+            self._init_worker,
+            spare = self._spare
         )
-        self._stderr_printer = threading.Thread(target = self._keep_printing_stderr)
-        self._stderr_printer.start()
-        
-        self._read_tag(protocol.OUT_TAG_INIT)
-        
-        info_msg = self._proc.stdout.read(protocol.init_struct.size)
-        audio_length, sample_rate = protocol.from_info_msg(info_msg)
+        audio_length, sample_rate, self._pitches = self._worker.info
+        self._requests = request_dispatcher(self._worker, self._max_pending)
+
+        self._buffers.presize(audio_buf_names, audio_length)
 
         print_err("gansynth_worker is ready")
         self._outlet(1, ["worker", "on", audio_length, sample_rate])
+        self._outlet(1, ["worker", "pitches", *self._pitches])
 
     def unload_1(self):
-        if self._proc:
-            self._proc.terminate()
-            self._proc = None
-            self._stderr_printer = None
+        if self._worker:
+            self._requests.close()
+            self._worker.close()
+            self._requests = None
+            self._worker = None
         else:
             print_err("no gansynth_worker process is running")
 
         self._outlet(1, ["worker", "off"])
+
+    # spare 1: keep a second worker warmed up to take over if the worker dies
+    def spare_1(self, on):
+        self._spare = bool(on)
+
+    # timeout seconds: requests still queued or running after this long are
+    # dropped or cancelled and reported as expired; 0 disables
+    def timeout_1(self, seconds):
+        self._timeout = float(seconds) if seconds > 0 else None
+
+    # max_pending n: requests beyond n waiting for the worker are refused
+    # and reported as busy
+    def max_pending_1(self, n):
+        self._max_pending = max(1, int(n))
+        if self._requests:
+            self._requests.max_pending = self._max_pending
+
+    # priority request lane: serve the named request (e.g. synthesize) in the
+    # realtime, interactive or background lane; background renders yield to
+    # the other lanes between batches
+    def priority_1(self, what, lane):
+        if str(lane) not in priorities:
+            raise ValueError("unknown priority '{}', should be one of: {}".format(lane, " ".join(priorities)))
+
+        self._priorities[str(what)] = priorities[str(lane)]
+
+    # cancel: drop the waiting requests and stop the running one between
+    # batches
+    def cancel_1(self):
+        if not self._worker:
+            raise Exception("can't cancel - no gansynth_worker process is running")
+
+        self._requests.cancel()
+
+    # poll: apply the replies that arrived since the last poll to the arrays
+    # and outlet; bang it from a [metro] while requests are running
+    def poll_1(self):
+        while True:
+            try:
+                deliver, reply = self._results.get_nowait()
+            except queue.Empty:
+                return
+
+            deliver(reply)
+
+    def _on_pd_thread(self, fn):
+        """
+            Returns a callback for the dispatcher thread that passes its
+            argument to fn on the next poll.
+        """
+        return lambda reply: self._results.put((fn, reply))
+
+    def _submit(self, what, tag, *msgs, done=None, **kwargs):
+        """
+            Queues a request for the worker. read_reply runs on the
+            dispatcher thread and only reads the reply; done gets it on the
+            Pd thread, from poll_1. Refused and dropped requests are reported
+            with what.
+        """
+        queued = self._requests.submit(
+            tag,
+            *msgs,
+            done = self._on_pd_thread(done) if done else None,
+            dropped = self._on_pd_thread(lambda reason: self._outlet(1, [reason, what])),
+            timeout = kwargs.pop("timeout", self._timeout),
+            priority = self._priorities.get(what, PRIORITY_INTERACTIVE),
+            **kwargs
+        )
+
+        if not queued:
+            self._outlet(1, ["busy", what])
+
+        return queued
         
     def load_ganspace_components_1(self, ganspace_components_file):
         ganspace_components_file = os.path.join(
@@ -105,10 +184,17 @@ class halluseq(pyext._class):
         size_msg = protocol.to_int_msg(len(ganspace_components_file))
         components_msg = ganspace_components_file.encode('utf-8')
 
-        self._write_msg(protocol.IN_TAG_LOAD_COMPONENTS, size_msg, components_msg)
-        self._read_tag(protocol.OUT_TAG_LOAD_COMPONENTS)
-        count_msg = self._proc.stdout.read(protocol.count_struct.size)
-        self._component_count = protocol.from_count_msg(count_msg)
+        self._submit(
+            "load_ganspace_components",
+            protocol.IN_TAG_LOAD_COMPONENTS, size_msg, components_msg,
+            read_reply = self._read_component_count,
+            done = self._components_loaded,
+            session_key = "components",
+            timeout = None
+        )
+
+    def _components_loaded(self, component_count):
+        self._component_count = component_count
         print_err("_component_count =", self._component_count)
         
         buf = pyext.Buffer(self._edits_buf_name)
@@ -116,6 +202,10 @@ class halluseq(pyext._class):
         buf.dirty()
 
         print_err("GANSpace components loaded!")
+
+    def _read_component_count(self):
+        self._worker.read_tag(protocol.OUT_TAG_LOAD_COMPONENTS)
+        return self._worker.read_struct(protocol.count_struct)
         
     def next_step_1(self):
         self._read_edits()
@@ -188,34 +278,73 @@ class halluseq(pyext._class):
     def updated(self):
         self._outlet(1, "updated")
             
-    def _keep_printing_stderr(self):
-        while True:
-            line = self._proc.stderr.readline()
-            
-            if not line:
-                break
+    def _init_worker(self, worker):
+        worker.read_tag(protocol.OUT_TAG_INIT)
+        audio_length, sample_rate = worker.read_struct(protocol.init_struct)
+
+        worker.write_msg(protocol.IN_TAG_GET_PITCHES)
+        worker.read_tag(protocol.OUT_TAG_PITCHES)
+
+        count = worker.read_struct(protocol.count_struct)
+        pitches = protocol.from_pitches_msg(worker.read(count * protocol.int_struct.size))
+
+        return audio_length, sample_rate, pitches
+
+    def _read_notes(self, count):
+        """
+            Reads per-note synthesis results as a list of (status, audio),
+            where audio is None for notes that failed or were cancelled.
+        """
+        tag = self._worker.read_tag()
+        if tag == protocol.OUT_TAG_CANCELLED:
+            # a suspended request that the worker no longer has
+            return [(protocol.NOTE_STATUS_CANCELLED, None)] * count
+        if tag != protocol.OUT_TAG_AUDIO:
+            raise ValueError("expected tag {}, got {}".format(protocol.OUT_TAG_AUDIO, tag))
+
+        out_count_msg = self._worker.read(protocol.count_struct.size)
+        out_count = protocol.from_count_msg(out_count_msg)
 
-            sys.stderr.write("[gansynth_worker] ")
-            sys.stderr.write(line.decode("utf-8"))
-            sys.stderr.flush()
-        
-    def _write_msg(self, tag, *msgs):
-        tag_msg = protocol.to_tag_msg(tag)
-        self._proc.stdin.write(tag_msg)
-        for msg in msgs:
-            self._proc.stdin.write(msg)
-        self._proc.stdin.flush()
+        assert out_count == count
+
+        notes = []
+        for i in range(count):
+            status_msg = self._worker.read(protocol.note_status_struct.size)
+            status = protocol.from_note_status_msg(status_msg)
 
-    def _read(self, n):
-        data = self._proc.stdout.read(n)
-        return data
+            audio_size_msg = self._worker.read(protocol.audio_size_struct.size)
+            audio_size = protocol.from_audio_size_msg(audio_size_msg)
 
-    def _read_tag(self, expected_tag):
-        tag_msg = self._proc.stdout.read(protocol.tag_struct.size)
-        tag = protocol.from_tag_msg(tag_msg)
+            if status in (protocol.NOTE_STATUS_FAILED, protocol.NOTE_STATUS_CANCELLED):
+                notes.append((status, None))
+            else:
+                notes.append((status, self._worker.read_audio(audio_size // protocol.audio_dtype.itemsize)))
+
+        return notes
+
+    def _synthesized(self, notes, audio_buf_names, pitches):
+        failed = []
+        cancelled = []
+        snapped = []
+        for i, (status, audio) in enumerate(notes):
+            if status == protocol.NOTE_STATUS_FAILED:
+                failed.append(i)
+            elif status == protocol.NOTE_STATUS_CANCELLED:
+                cancelled.append(i)
+            else:
+                if status == protocol.NOTE_STATUS_SNAPPED:
+                    snapped.append(i)
+                self._buffers.store(audio_buf_names[i], audio)
+
+        for i in failed:
+            self._outlet(1, ["failed", audio_buf_names[i], pitches[i]])
+        for i in cancelled:
+            self._outlet(1, ["cancelled", audio_buf_names[i], pitches[i]])
+        # pitch shifted from the nearest pitch the model was trained on
+        for i in snapped:
+            self._outlet(1, ["snapped", audio_buf_names[i], pitches[i]])
 
-        if tag != expected_tag:
-            raise ValueError("expected tag {}, got {}".format(expected_tag, tag))
+        self._outlet(1, "synthesized")
 
     def _print_steps(self):
         print_err(f"_steps = {self._steps}")
@@ -250,7 +379,7 @@ class halluseq(pyext._class):
         return step
         
     def randomize_z_1(self, *buf_names):
-        if not self._proc:
+        if not self._worker:
             raise Exception("can't randomize z - no gansynth_worker process is running")
 
         in_count = len(buf_names)
@@ -259,69 +388,55 @@ class halluseq(pyext._class):
             raise ValueError("no buffer name(s) specified")
         
         in_count_msg = protocol.to_count_msg(in_count)
-        self._write_msg(protocol.IN_TAG_RAND_Z, in_count_msg)
-        
-        self._read_tag(protocol.OUT_TAG_Z)
+        self._submit(
+            "randomize_z",
+            protocol.IN_TAG_RAND_Z, in_count_msg,
+            read_reply = lambda: self._read_zs(in_count),
+            done = lambda zs: self._store_zs(zs, buf_names, "randomized")
+        )
+
+    def _read_zs(self, count):
+        self._worker.read_tag(protocol.OUT_TAG_Z)
 
-        out_count_msg = self._proc.stdout.read(protocol.count_struct.size)
+        out_count_msg = self._worker.read(protocol.count_struct.size)
         out_count = protocol.from_count_msg(out_count_msg)
         
-        assert out_count == in_count
+        assert out_count == count
 
-        for buf_name in buf_names:
-            z_msg = self._proc.stdout.read(protocol.z_struct.size)
-            z = protocol.from_z_msg(z_msg)
+        zs = []
+        for i in range(count):
+            z_msg = self._worker.read(protocol.z_struct.size)
+            zs.append(protocol.from_z_msg(z_msg).astype(np.float32))
 
-            z32 = z.astype(np.float32)
-        
-            buf = pyext.Buffer(buf_name)
-            if len(buf) != len(z32):
-                buf.resize(len(z32))
+        return zs
 
-            buf[:] = z32
-            buf.dirty()
+    def _store_zs(self, zs, buf_names, what):
+        for z32, buf_name in zip(zs, buf_names):
+            self._buffers.store(buf_name, z32)
 
-        self._outlet(1, "randomized")
+        self._outlet(1, what)
 
     def save_z_1(self, z_name, path):
         save_z_buf(z_name, path)
         #np.save(z, path_fixed)
                 
     def slerp_z_1(self, z0_name, z1_name, z_dst_name, amount):
-        if not self._proc:
+        if not self._worker:
             raise Exception("can't slerp - no gansynth_worker process is running")
 
-        z0_buf = pyext.Buffer(z0_name)
-        z1_buf = pyext.Buffer(z1_name)
-        z_dst_buf = pyext.Buffer(z_dst_name)
-
-        z0_f64 = np.array(z0_buf, dtype=np.float64)
-        z1_f64 = np.array(z1_buf, dtype=np.float64)
-        
-        self._write_msg(protocol.IN_TAG_SLERP_Z, protocol.to_slerp_z_msg(z0_f64, z1_f64, amount))
-
-        self._read_tag(protocol.OUT_TAG_Z)
-
-        out_count_msg = self._proc.stdout.read(protocol.count_struct.size)
-        out_count = protocol.from_count_msg(out_count_msg)
-
-        assert out_count == 1
-
-        z_msg = self._proc.stdout.read(protocol.z_struct.size)
-        z = protocol.from_z_msg(z_msg)
-
-        z32 = z.astype(np.float32)
+        z0 = np.asarray(self._buffers.get(z0_name))
+        z1 = np.asarray(self._buffers.get(z1_name))
 
-        if len(z_dst_buf) != len(z32):
-            z_dst_buf.resize(len(z32))
-        
-        z_dst_buf[:] = z32
-        z_dst_buf.dirty()
-
-        self._outlet(1, "slerped")
+        self._submit(
+            "slerp_z",
+            protocol.IN_TAG_SLERP_Z,
+            protocol.to_slerp_z_msg(z0, z1, amount),
+            read_reply = lambda: self._read_zs(1),
+            done = lambda zs: self._store_zs(zs, [z_dst_name], "slerped")
+        )
 
     def synthesize_1(self, *args):
-        if not self._proc:
+        if not self._worker:
             raise Exception("can't synthesize - no gansynth_worker process is running")
         
         arg_count = len(args)
@@ -329,50 +444,24 @@ class halluseq(pyext._class):
         if arg_count == 0 or arg_count % 3 != 0:
             raise ValueError("invalid number of arguments ({}), should be a multiple of 3: synthesize z1 audio1 pitch1 [z2 audio2 pitch2 ...]".format(arg_count))
 
-        gen_audio_msgs = []
-        audio_buf_names = []
-        for i in range(0, arg_count, 3):
-            z_buf_name, audio_buf_name, pitch = args[i:i+3]
-
-            z32_buf = pyext.Buffer(z_buf_name)
-            z = np.array(z32_buf, dtype=np.float64)
-            
-            gen_audio_msgs.append(protocol.to_gen_audio_msg(pitch, z))
-            audio_buf_names.append(audio_buf_name)
-            
-        in_count = len(gen_audio_msgs)
-        in_count_msg = protocol.to_count_msg(in_count)
-        self._write_msg(protocol.IN_TAG_GEN_AUDIO, in_count_msg, *gen_audio_msgs)
-                
-        self._read_tag(protocol.OUT_TAG_AUDIO)
-
-        out_count_msg = self._proc.stdout.read(protocol.count_struct.size)
-        out_count = protocol.from_count_msg(out_count_msg)
-        
-        if out_count == 0:
-            return
-
-        assert out_count == in_count
-
-        for audio_buf_name in audio_buf_names:
-            audio_size_msg = self._proc.stdout.read(protocol.audio_size_struct.size)
-            audio_size = protocol.from_audio_size_msg(audio_size_msg)
-
-            audio_msg = self._proc.stdout.read(audio_size)
-            audio_note = protocol.from_audio_msg(audio_msg)
+        z_buf_names = args[0::3]
+        audio_buf_names = args[1::3]
+        pitches = args[2::3]
 
-            audio_buf = pyext.Buffer(audio_buf_name)
-            if len(audio_buf) != len(audio_note):
-                audio_buf.resize(len(audio_note))
-
-            audio_buf[:] = audio_note
-            audio_buf.dirty()
-        
-        self._outlet(1, "synthesized")
+        gen_msg = protocol.to_gen_audio_request_msg(
+            pitches,
+            [np.asarray(self._buffers.get(z_buf_name)) for z_buf_name in z_buf_names]
+        )
+        self._submit(
+            "synthesize",
+            protocol.IN_TAG_GEN_AUDIO, gen_msg,
+            read_reply = lambda: self._read_notes(len(audio_buf_names)),
+            done = lambda notes: self._synthesized(notes, audio_buf_names, pitches)
+        )
 
     # expected format: synthesize_noz buf1 pitch1 [edit1_1 edit1_2 ...] -- buf2 pitch2 [...] -- [...]
     def synthesize_noz_1(self, *args):
-        if not self._proc:
+        if not self._worker:
             raise Exception("can't synthesize - no gansynth_worker process is running")
 
         # parse the input
@@ -397,63 +486,33 @@ class halluseq(pyext._class):
                 
         # validate input and build synthesize messages
         
-        synth_msgs = []
         for sound in sounds:
             if None in [sound.buf, sound.pitch]:
                 raise ValueError("invalid syntax, should be: synthesize_noz buf1 pitch1 [edit1_1 edit1_2 ...] [-- buf2 pitch2 [edit2_1 edit2_2 ...]] [-- ...]")
 
-            edits = []
-            for edit in sound.edits:
-                if isinstance(edit, pyext.Symbol):
-                    # edit refers to a Pd array
-                    edits_buf = pyext.Buffer(edit)
-                    for val in edits_buf:
-                        edits.append(val)
-                else:
-                    # edit is a number, probably
-                    edits.append(edit)
-            
-            synth_msgs.append(protocol.to_synthesize_noz_msg(sound.pitch, len(edits)))
-            for edit in edits:
-                synth_msgs.append(protocol.to_f64_msg(edit))
+            # edits referring to Pd arrays are read in place
+            sound.edits = [
+                np.asarray(self._buffers.get(edit)) if isinstance(edit, pyext.Symbol) else edit
+                for edit in sound.edits
+            ]
 
         # write synthesize messages
-        
-        in_count = len(sounds)
-        in_count_msg = protocol.to_count_msg(in_count)
-        self._write_msg(protocol.IN_TAG_SYNTHESIZE_NOZ, in_count_msg, *synth_msgs)
-        
-        # wait for output
-
-        self._read_tag(protocol.OUT_TAG_AUDIO)
-
-        out_count_msg = self._read(protocol.count_struct.size)
-        out_count = protocol.from_count_msg(out_count_msg)
-        
-        assert out_count == in_count
-
-        if out_count == 0:
-            return
-
-        for sound in sounds:
-            audio_size_msg = self._read(protocol.audio_size_struct.size)
-            audio_size = protocol.from_audio_size_msg(audio_size_msg)
-
-            audio_msg = self._read(audio_size)
-            audio_note = protocol.from_audio_msg(audio_msg)
-
-            audio_buf_name = sound.buf
-            audio_buf = pyext.Buffer(audio_buf_name)
-            if len(audio_buf) != len(audio_note):
-                audio_buf.resize(len(audio_note))
 
-            audio_buf[:] = audio_note
-            audio_buf.dirty()
-        
-        self._outlet(1, "synthesized")
+        synth_msg = protocol.to_synthesize_noz_request_msg(
+            [sound.pitch for sound in sounds],
+            [sound.edits for sound in sounds]
+        )
+        audio_buf_names = [sound.buf for sound in sounds]
+        self._submit(
+            "synthesize_noz",
+            protocol.IN_TAG_SYNTHESIZE_NOZ,
+            synth_msg,
+            read_reply = lambda: self._read_notes(len(audio_buf_names)),
+            done = lambda notes: self._synthesized(notes, audio_buf_names, [sound.pitch for sound in sounds])
+        )
         
     def hallucinate_noz_1(self, audio_buf_name):
-        if not self._proc:
+        if not self._worker:
             raise Exception("can't hallucinate - load a checkpoint first")
 
         if not self._steps:
@@ -466,16 +525,11 @@ class halluseq(pyext._class):
 
         print_err("steps =", self._steps)
 
-        edit_count = len(self._steps[0]["edits"])
+        edits = np.stack([step["edits"] for step in self._steps])
+        edit_count = edits.shape[1]
         
-        edit_list = []
-        for step in self._steps:
-            for edit in step["edits"]:
-                edit_list.append(edit)
-
-        print_err("len(edit_list) =", len(edit_list))
-        
-        self._write_msg(
+        self._submit(
+            "hallucinate_noz",
             protocol.IN_TAG_HALLUCINATE_NOZ,
             protocol.to_hallucinate_msg(
                 step_count,
@@ -487,22 +541,30 @@ class halluseq(pyext._class):
                 self._release
             ),
             protocol.to_count_msg(edit_count),
-            *map(protocol.to_f64_msg, edit_list)
+            protocol.to_f64_array_msg(edits),
+            read_reply = self._read_audio,
+            done = lambda audio: self._hallucinated(audio, audio_buf_name)
         )
-        
-        self._read_tag(protocol.OUT_TAG_AUDIO)
-        
-        audio_size_msg = self._proc.stdout.read(protocol.audio_size_struct.size)
-        audio_size = protocol.from_audio_size_msg(audio_size_msg)
-
-        audio_msg = self._proc.stdout.read(audio_size)
-        audio = protocol.from_audio_msg(audio_msg)
 
-        audio_buf = pyext.Buffer(audio_buf_name)
-        if len(audio_buf) != len(audio):
-            audio_buf.resize(len(audio))
+    def _hallucinated(self, audio, audio_buf_name):
+        if audio is None:
+            self._outlet(1, ["cancelled", "hallucinate_noz"])
+            return
 
-        audio_buf[:] = audio
-        audio_buf.dirty()
-        
+        self._buffers.store(audio_buf_name, audio)
         self._outlet(1, ["hallucinated", len(audio)])
+
+    def _read_audio(self):
+        """
+            Reads a hallucination, or returns None if it was cancelled.
+        """
+        tag = self._worker.read_tag()
+        if tag == protocol.OUT_TAG_CANCELLED:
+            return None
+        if tag != protocol.OUT_TAG_AUDIO:
+            raise ValueError("expected tag {}, got {}".format(protocol.OUT_TAG_AUDIO, tag))
+
+        audio_size_msg = self._worker.read(protocol.audio_size_struct.size)
+        audio_size = protocol.from_audio_size_msg(audio_size_msg)
+
+        return self._worker.read_audio(audio_size // protocol.audio_dtype.itemsize)
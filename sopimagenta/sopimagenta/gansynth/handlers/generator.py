@@ -10,7 +10,98 @@ from types import SimpleNamespace
 from magenta.models.gansynth.lib import generate_util as gu
 
 from sopilib import gansynth_protocol as protocol
+from sopilib.pitch import base_pitches, closest_pitch_indices, pitch_rate, resample_linear, resample_sinc
 from sopilib.utils import print_err, read_msg, suppress_stdout
+from sopilib.worker import chunked_job
+
+resamplers = {
+    protocol.RESAMPLE_LINEAR: resample_linear,
+    protocol.RESAMPLE_SINC: resample_sinc
+}
+
+def trained_pitches(model):
+    return sorted(model.pitch_counts.keys())
+
+def snap_pitches(model, pitches):
+    """
+        Maps each requested pitch to the closest pitch the model was trained on.
+        Returns the snapped pitches and the playback rates that shift them back.
+    """
+    trained = np.array(trained_pitches(model))
+    requested = np.array(pitches)
+    snapped = trained[closest_pitch_indices(trained, requested)]
+
+    return snapped.tolist(), pitch_rate(requested, snapped)
+
+# placeholder for notes skipped by a cancel
+CANCELLED = object()
+
+def synthesize_batch(synthesize, indices):
+    """
+        Synthesizes a batch of notes with synthesize(indices). If the batch
+        fails, falls back to synthesizing the notes one by one so that a single
+        bad note doesn't throw away the others. Failed notes are None.
+    """
+    try:
+        with suppress_stdout():
+            return list(synthesize(indices))
+    except KeyError as e:
+        print_err("batch synthesis failed on pitch {}, synthesizing notes individually".format(e.args[0]))
+
+    audios = []
+    for i in indices:
+        try:
+            with suppress_stdout():
+                audios.append(synthesize([i])[0])
+        except KeyError as e:
+            print_err("can't synthesize - model was not trained on pitch {}".format(e.args[0]))
+            audios.append(None)
+
+    return audios
+
+def synthesize_notes(synthesize, count, finish, state):
+    """
+        Returns a job that synthesizes count notes in batches of the worker's
+        batch size and passes them to finish(audios). After a cancel the
+        remaining batches are skipped and their notes are CANCELLED.
+    """
+    batch_size = state.get("batch_size", count) or count
+    flatten = lambda chunks: [audio for chunk in chunks for audio in chunk]
+
+    return chunked_job(
+        lambda start, end: synthesize_batch(synthesize, list(range(start, end))),
+        count,
+        batch_size,
+        finish = lambda chunks: finish(flatten(chunks)),
+        cancelled = lambda chunks: finish((flatten(chunks) + [CANCELLED] * count)[:count])
+    )
+
+def write_notes(stdout, audios, rates, resample=resample_linear):
+    stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_AUDIO))
+    stdout.write(protocol.to_count_msg(len(audios)))
+
+    for audio, rate in zip(audios, rates):
+        if audio is CANCELLED:
+            stdout.write(protocol.to_note_status_msg(protocol.NOTE_STATUS_CANCELLED))
+            stdout.write(protocol.to_audio_size_msg(0))
+            continue
+
+        if audio is None:
+            stdout.write(protocol.to_note_status_msg(protocol.NOTE_STATUS_FAILED))
+            stdout.write(protocol.to_audio_size_msg(0))
+            continue
+
+        if rate != 1.0:
+            status = protocol.NOTE_STATUS_SNAPPED
+            audio = resample(audio, rate)
+        else:
+            status = protocol.NOTE_STATUS_OK
+
+        stdout.write(protocol.to_note_status_msg(status))
+        stdout.write(protocol.to_audio_size_msg(audio.size * audio.itemsize))
+        stdout.write(protocol.to_audio_msg(audio))
+
+    stdout.flush()
 
 def handle_rand_z(model, stdin, stdout, state):
     """
@@ -46,13 +137,25 @@ def handle_load_ganspace_components(model, stdin, stdout, state):
     stdout.write(protocol.to_count_msg(component_count))
     stdout.flush()
 
+def handle_get_pitches(model, stdin, stdout, state):
+    """
+        Publishes the pitches the model was trained on.
+    """
+    pitches = trained_pitches(model)
+
+    stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_PITCHES))
+    stdout.write(protocol.to_count_msg(len(pitches)))
+    stdout.write(protocol.to_pitches_msg(pitches))
+    stdout.flush()
+
 def handle_set_component_amplitudes(model, stdin, stdout, state):
-    amplitudes = []
-    for i in range(0, state['ganspace_component_count']):
-        msg = read_msg(stdin, protocol.f64_struct.size)
-        value = protocol.from_float_msg(msg)
-        amplitudes.append(value)
-    state['ganspace_component_amplitudes'] = amplitudes
+    count = protocol.from_count_msg(read_msg(stdin, protocol.count_struct.size))
+    amplitudes_msg = read_msg(stdin, protocol.component_amplitudes_size(count)) if count else b""
+    amplitudes = protocol.from_component_amplitudes_msg(amplitudes_msg)
+
+    # amplitudes beyond the loaded components are ignored, missing ones are 0
+    component_count = state.get('ganspace_component_count', count)
+    state['ganspace_component_amplitudes'] = np.pad(amplitudes[:component_count], (0, max(0, component_count - count)))
 
 def handle_slerp_z(model, stdin, stdout, state):
     slerp_z_msg = read_msg(stdin, protocol.slerp_z_struct.size)
@@ -67,6 +170,22 @@ def handle_slerp_z(model, stdin, stdout, state):
     stdout.flush()
     
 def handle_gen_audio(model, stdin, stdout, state):
+    gen_audio(model, stdin, stdout, state)
+
+def handle_gen_audio_shifted(model, stdin, stdout, state):
+    """
+        Like gen_audio, but renders each latent vector only once per base pitch
+        and derives notes up to max_shift semitones away by resampling.
+    """
+    options_msg = read_msg(stdin, protocol.gen_audio_shifted_struct.size)
+    max_shift, quality = protocol.from_gen_audio_shifted_msg(options_msg)
+
+    if quality not in resamplers:
+        print_err("unknown resampling quality {}, using linear".format(quality))
+
+    gen_audio(model, stdin, stdout, state, max_shift, resamplers.get(quality, resample_linear))
+
+def gen_audio(model, stdin, stdout, state, max_shift=0, resample=resample_linear):
     count_msg = read_msg(stdin, protocol.count_struct.size)
     count = protocol.from_count_msg(count_msg)
     
@@ -102,21 +221,43 @@ def handle_gen_audio(model, stdin, stdout, state):
         layer_offsets[state['ganspace_components']['layer']] = linear_combination_batch
 
     z_arr = np.array(zs)
-    try:
-        with suppress_stdout():
-            audios = model.generate_samples_from_z(z_arr, pitches, layer_offsets=layer_offsets)
-    except KeyError as e:
-        print_err("can't synthesize - model was not trained on pitch {}".format(e.args[0]))
-        audios = []
-        
-    stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_AUDIO))
-    stdout.write(protocol.to_count_msg(len(audios)))
 
-    for audio in audios:
-        stdout.write(protocol.to_audio_size_msg(audio.size * audio.itemsize))
-        stdout.write(protocol.to_audio_msg(audio))
+    if max_shift > 0:
+        bases = base_pitches(trained_pitches(model), pitches, max_shift)
+        rates = pitch_rate(pitches, bases)
 
-    stdout.flush()
+        # render each (z, base pitch) pair once
+        renders = {}
+        render_ix = []
+        unique_zs = []
+        unique_bases = []
+        for z, base in zip(zs, bases):
+            key = (z.tobytes(), int(base))
+            if key not in renders:
+                renders[key] = len(unique_zs)
+                unique_zs.append(z)
+                unique_bases.append(int(base))
+            render_ix.append(renders[key])
+
+        unique_zs = np.array(unique_zs)
+
+        job = synthesize_notes(
+            lambda ix: model.generate_samples_from_z(unique_zs[ix], [unique_bases[i] for i in ix], layer_offsets=layer_offsets),
+            len(renders),
+            lambda rendered: write_notes(stdout, [rendered[j] for j in render_ix], rates, resample),
+            state
+        )
+    else:
+        snapped, rates = snap_pitches(model, pitches)
+
+        job = synthesize_notes(
+            lambda ix: model.generate_samples_from_z(z_arr[ix], [snapped[i] for i in ix], layer_offsets=layer_offsets),
+            count,
+            lambda audios: write_notes(stdout, audios, rates, resample),
+            state
+        )
+
+    job.run(stdin, stdout, state, protocol)
     
 def handle_synthesize_noz(model, stdin, stdout, state):    
     count_msg = read_msg(stdin, protocol.count_struct.size)
@@ -130,10 +271,8 @@ def handle_synthesize_noz(model, stdin, stdout, state):
         pitch, num_edits = protocol.from_synthesize_noz_msg(gen_msg)
 
         max_num_edits = max(max_num_edits, num_edits)
-        edits = []
-        for j in range(num_edits):
-            edit_msg = read_msg(stdin, protocol.f64_struct.size)
-            edits.append(protocol.from_f64_msg(edit_msg))
+        edits_msg = read_msg(stdin, protocol.f64_array_size(num_edits)) if num_edits else b""
+        edits = list(protocol.from_f64_array_msg(edits_msg))
 
         sounds.append(SimpleNamespace(pitch = pitch, edits = edits))
 
@@ -148,28 +287,28 @@ def handle_synthesize_noz(model, stdin, stdout, state):
     # edits = np.repeat([edits], len(pitches), axis=0)
     pitches = [sound.pitch for sound in sounds]
     edits = np.array([sound.edits for sound in sounds], dtype=pca["stdev"].dtype)
-    
-    try:
-        with suppress_stdout():
-            audios = model.generate_samples_from_edits(pitches, edits, pca)
-    except KeyError as e:
-        print_err("can't synthesize - model was not trained on pitch {}".format(e.args[0]))
-        audios = []
-
-    stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_AUDIO))
-    stdout.write(protocol.to_count_msg(len(audios)))
+    snapped, rates = snap_pitches(model, pitches)
 
-    for audio in audios:
-        stdout.write(protocol.to_audio_size_msg(audio.size * audio.itemsize))
-        stdout.write(protocol.to_audio_msg(audio))
+    job = synthesize_notes(
+        lambda ix: model.generate_samples_from_edits([snapped[i] for i in ix], edits[ix], pca),
+        count,
+        lambda audios: write_notes(stdout, audios, rates),
+        state
+    )
+    job.run(stdin, stdout, state, protocol)
 
-    stdout.flush()
+def handle_cancel(model, stdin, stdout, state):
+    # the request finished before the cancel arrived
+    pass
         
 handlers = {
     protocol.IN_TAG_RAND_Z: handle_rand_z,
     protocol.IN_TAG_SLERP_Z: handle_slerp_z,
     protocol.IN_TAG_GEN_AUDIO: handle_gen_audio,
+    protocol.IN_TAG_GEN_AUDIO_SHIFTED: handle_gen_audio_shifted,
     protocol.IN_TAG_LOAD_COMPONENTS: handle_load_ganspace_components,
     protocol.IN_TAG_SET_COMPONENT_AMPLITUDES: handle_set_component_amplitudes,
-    protocol.IN_TAG_SYNTHESIZE_NOZ: handle_synthesize_noz
+    protocol.IN_TAG_SYNTHESIZE_NOZ: handle_synthesize_noz,
+    protocol.IN_TAG_GET_PITCHES: handle_get_pitches,
+    protocol.IN_TAG_CANCEL: handle_cancel
 }
@@ -12,11 +12,31 @@ from magenta.models.gansynth.lib import generate_util as gu
 
 from sopilib import gansynth_protocol as protocol
 from sopilib.utils import print_err, read_msg, suppress_stdout
+from sopilib.worker import chunked_job
 
-def synthesize(model, zs, pitches):
-    z_arr = np.array(zs)
-    with suppress_stdout():
-        return model.generate_samples_from_z(z_arr, pitches)
+def render_chunks(render, count, finish, stdout, state):
+    """
+        Returns a job that renders count notes with render(start, end) in
+        chunks of the worker's batch size and passes them to finish(audios).
+        A cancelled render replies OUT_TAG_CANCELLED.
+    """
+    batch_size = state.get("batch_size", count) or count
+
+    def render_chunk(start, end):
+        with suppress_stdout():
+            return render(start, end)
+
+    return chunked_job(
+        render_chunk,
+        count,
+        batch_size,
+        finish = lambda chunks: finish(np.concatenate(chunks)),
+        cancelled = lambda chunks: write_cancelled(stdout)
+    )
+
+def write_cancelled(stdout):
+    stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_CANCELLED))
+    stdout.flush()
 
 def slerp(p0, p1, t):
   #Spherical linear interpolation.
@@ -147,15 +167,25 @@ def handle_hallucinate(model, stdin, stdout, state):
     initial_piches = np.array([32] * len(initial_notes)) # np.floor(30 + np.random.rand(len(initial_notes)) * 30)
     final_notes, final_pitches = interpolate_notes(initial_notes, initial_piches, interpolation_steps)
 
-    audios = synthesize(model, final_notes, final_pitches)
-    final_audio = combine_notes(audios, spacing = spacing, start_trim = start_trim, attack = attack, sustain = sustain, release = release, max_note_length=max_note_length, sr=sample_rate)
+    def finish(audios):
+        final_audio = combine_notes(audios, spacing = spacing, start_trim = start_trim, attack = attack, sustain = sustain, release = release, max_note_length=max_note_length, sr=sample_rate)
 
-    final_audio = final_audio.astype('float32')
+        final_audio = final_audio.astype('float32')
 
-    stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_AUDIO))
-    stdout.write(protocol.to_audio_size_msg(final_audio.size * final_audio.itemsize))
-    stdout.write(protocol.to_audio_msg(final_audio))
-    stdout.flush()
+        stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_AUDIO))
+        stdout.write(protocol.to_audio_size_msg(final_audio.size * final_audio.itemsize))
+        stdout.write(protocol.to_audio_msg(final_audio))
+        stdout.flush()
+
+    z_arr = np.array(final_notes)
+    job = render_chunks(
+        lambda start, end: model.generate_samples_from_z(z_arr[start:end], final_pitches[start:end]),
+        len(z_arr),
+        finish,
+        stdout,
+        state
+    )
+    job.run(stdin, stdout, state, protocol)
 
 def interpolate_edits(seq, step_count):
     last_i = len(seq) - 1
@@ -183,16 +213,9 @@ def handle_hallucinate_noz(model, stdin, stdout, state):
 
     pitch = min(model.pitch_counts.keys())
     
-    steps = []
-    for i in range(step_count):
-        edits = []
-        for j in range(edit_count):
-            edit_msg = read_msg(stdin, protocol.f64_struct.size)
-            edit = protocol.from_f64_msg(edit_msg)
-            
-            edits.append(edit)
-
-        steps.append(np.array(edits, dtype=layer_dtype))
+    edit_total = step_count * edit_count
+    edits_msg = read_msg(stdin, protocol.f64_array_size(edit_total)) if edit_total else b""
+    steps = list(protocol.from_f64_array_msg(edits_msg).reshape(step_count, edit_count).astype(layer_dtype))
     
     steps = list(interpolate_edits(steps, interpolation_steps))
 
@@ -200,18 +223,25 @@ def handle_hallucinate_noz(model, stdin, stdout, state):
         layer_steps = np.array(list(map(lambda edits: model.make_edits_layer(pca, edits), steps)), dtype=layer_dtype)
     pitch_steps = np.repeat([pitch], len(steps))
 
-    with suppress_stdout():
-        audios = model.generate_samples_from_layers({pca["layer"]: layer_steps}, pitch_steps)
-
-    final_audio = combine_notes(audios, spacing = spacing, start_trim = start_trim, attack = attack, sustain = sustain, release = release, max_note_length=max_note_length, sr=sample_rate)
-    final_audio = final_audio.astype("float32")
+    def finish(audios):
+        final_audio = combine_notes(audios, spacing = spacing, start_trim = start_trim, attack = attack, sustain = sustain, release = release, max_note_length=max_note_length, sr=sample_rate)
+        final_audio = final_audio.astype(protocol.audio_dtype)
 
-    audio_size = final_audio.size * final_audio.itemsize
-    
-    stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_AUDIO))
-    stdout.write(protocol.to_audio_size_msg(audio_size))
-    stdout.write(protocol.to_audio_msg(final_audio))
-    stdout.flush()
+        audio_size = final_audio.size * final_audio.itemsize
+        
+        stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_AUDIO))
+        stdout.write(protocol.to_audio_size_msg(audio_size))
+        stdout.write(protocol.to_audio_msg(final_audio))
+        stdout.flush()
+
+    job = render_chunks(
+        lambda start, end: model.generate_samples_from_layers({pca["layer"]: layer_steps[start:end]}, pitch_steps[start:end]),
+        len(steps),
+        finish,
+        stdout,
+        state
+    )
+    job.run(stdin, stdout, state, protocol)
 
     
 handlers = {
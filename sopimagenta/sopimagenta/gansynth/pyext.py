@@ -6,94 +6,228 @@ except:
     print("ERROR: This script must be loaded by the PD/Max pyext external")
 
 import os
+import queue
 import random
-import subprocess
 import sys
-import threading
 import time
 from types import SimpleNamespace
 
 import numpy as np
 
+from sopilib import schema
+from sopilib.buffers import buffer_cache
+from sopilib.dispatcher import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, priorities, request_dispatcher
 import sopilib.gansynth_protocol as protocol
-from sopilib.utils import print_err, sopimagenta_path
+from sopilib.supervisor import worker_supervisor
+from sopilib.utils import print_err
 
 class gansynth(pyext._class):
     def __init__(self, *args):
         self._inlets = 1
         self._outlets = 1
-        self._proc = None
-        self._stderr_printer = None
+        self._buffers = buffer_cache(pyext.Buffer)
+        self._worker = None
+        self._requests = None
+        self._results = queue.Queue()
+        self.spare = False
+        self.timeout = None
+        self.max_pending = 4
+        self.priorities = {"hallucinate": PRIORITY_BACKGROUND}
         self.ganspace_components_amplitudes_buffer_name = None
+        self.pitch_shift = 0
+        self.pitch_shift_quality = protocol.RESAMPLE_SINC
 
-    def load_1(self, ckpt_dir, batch_size=8):
-        if self._proc != None:
+    def load_1(self, ckpt_dir, batch_size=8, *audio_buf_names):
+        if self._worker != None:
             self.unload_1()
 
-        python = sys.executable
-        gen_script = sopimagenta_path("gansynth_worker")
         ckpt_dir = os.path.join(self._canvas_dir, str(ckpt_dir))
-        worker_cmd = (python, gen_script, ckpt_dir, str(batch_size))
 
         print("starting gansynth_worker process, this may take a while", file=sys.stderr)
-        print(f"worker_cmd = {worker_cmd}")
 
-        self._proc = subprocess.Popen(
-            worker_cmd,
-            stdin = subprocess.PIPE,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE
+        self._worker = worker_supervisor(
+            "gansynth_worker",
+            protocol,
+            (ckpt_dir, batch_size),
+            self._init_worker,
+            spare = self.spare
         )
-        self._stderr_printer = threading.Thread(target = self._keep_printing_stderr)
-        self._stderr_printer.start()
-        
-        self._read_tag(protocol.OUT_TAG_INIT)
-        
-        info_msg = self._read(protocol.init_struct.size)
-        audio_length, sample_rate = protocol.from_info_msg(info_msg)
+        audio_length, sample_rate, self.pitches = self._worker.info
+        self._requests = request_dispatcher(self._worker, self.max_pending)
+
+        self._buffers.presize(audio_buf_names, audio_length)
 
         print("gansynth_worker is ready", file=sys.stderr)
         self._outlet(1, ["loaded", audio_length, sample_rate])
+        self._outlet(1, ["pitches", *self.pitches])
 
 
     def unload_1(self):
-        if self._proc:
-            self._proc.terminate()
-            self._proc = None
-            self._stderr_printer = None
+        if self._worker:
+            self._requests.close()
+            self._worker.close()
+            self._requests = None
+            self._worker = None
         else:
             print("no gansynth_worker process is running", file=sys.stderr)
 
         self._outlet(1, "unloaded")
 
-    def _keep_printing_stderr(self):
+    # spare 1: keep a second worker warmed up to take over if the worker dies
+    def spare_1(self, on):
+        self.spare = bool(on)
+
+    # timeout seconds: requests still queued or running after this long are
+    # dropped or cancelled and reported as expired; 0 disables
+    def timeout_1(self, seconds):
+        self.timeout = float(seconds) if seconds > 0 else None
+
+    # max_pending n: requests beyond n waiting for the worker are refused
+    # and reported as busy
+    def max_pending_1(self, n):
+        self.max_pending = max(1, int(n))
+        if self._requests:
+            self._requests.max_pending = self.max_pending
+
+    # priority request lane: serve the named request (e.g. synthesize) in the
+    # realtime, interactive or background lane; background renders yield to
+    # the other lanes between batches
+    def priority_1(self, what, lane):
+        if str(lane) not in priorities:
+            raise ValueError("unknown priority '{}', should be one of: {}".format(lane, " ".join(priorities)))
+
+        self.priorities[str(what)] = priorities[str(lane)]
+
+    # cancel: drop the waiting requests and stop the running one between
+    # batches
+    def cancel_1(self):
+        if not self._worker:
+            raise Exception("can't cancel - no gansynth_worker process is running")
+
+        self._requests.cancel()
+
+    # poll: apply the replies that arrived since the last poll to the arrays
+    # and outlet; bang it from a [metro] while requests are running
+    def poll_1(self):
         while True:
-            line = self._proc.stderr.readline()
-            
-            if not line:
-                break
-
-            sys.stderr.write("[gansynth_worker] ")
-            sys.stderr.write(line.decode("utf-8"))
-            sys.stderr.flush()
-        
-    def _write_msg(self, tag, *msgs):
-        tag_msg = protocol.to_tag_msg(tag)
-        self._proc.stdin.write(tag_msg)
-        for msg in msgs:
-            self._proc.stdin.write(msg)
-        self._proc.stdin.flush()
-
-    def _read(self, n):
-        data = self._proc.stdout.read(n)
-        return data
-        
-    def _read_tag(self, expected_tag):
-        tag_msg = self._read(protocol.tag_struct.size)
-        tag = protocol.from_tag_msg(tag_msg)
+            try:
+                deliver, reply = self._results.get_nowait()
+            except queue.Empty:
+                return
+
+            deliver(reply)
+
+    def _on_pd_thread(self, fn):
+        """
+            Returns a callback for the dispatcher thread that passes its
+            argument to fn on the next poll.
+        """
+        return lambda reply: self._results.put((fn, reply))
+
+    def _submit(self, what, tag, *msgs, done=None, **kwargs):
+        """
+            Queues a request for the worker. read_reply runs on the
+            dispatcher thread and only reads the reply; done gets it on the
+            Pd thread, from poll_1. Refused and dropped requests are reported
+            with what.
+        """
+        queued = self._requests.submit(
+            tag,
+            *msgs,
+            done = self._on_pd_thread(done) if done else None,
+            dropped = self._on_pd_thread(lambda reason: self._outlet(1, [reason, what])),
+            timeout = kwargs.pop("timeout", self.timeout),
+            priority = self.priorities.get(what, PRIORITY_INTERACTIVE),
+            **kwargs
+        )
+
+        if not queued:
+            self._outlet(1, ["busy", what])
+
+        return queued
+
+    def metrics_1(self):
+        if not self._worker:
+            raise Exception("can't get metrics - no gansynth_worker process is running")
+
+        self._submit(
+            "metrics",
+            schema.TAG_METRICS,
+            read_reply = lambda: self._worker.client.read_metrics(),
+            done = self._metrics_read
+        )
+
+    def _metrics_read(self, metrics):
+        for tag, (count, total, longest) in metrics.items():
+            self._outlet(1, ["metrics", tag, count, total, longest])
+
+    def _init_worker(self, worker):
+        worker.read_tag(protocol.OUT_TAG_INIT)
+        audio_length, sample_rate = worker.read_struct(protocol.init_struct)
+
+        worker.write_msg(protocol.IN_TAG_GET_PITCHES)
+        worker.read_tag(protocol.OUT_TAG_PITCHES)
+
+        count = worker.read_struct(protocol.count_struct)
+        pitches = protocol.from_pitches_msg(worker.read(count * protocol.int_struct.size))
+
+        return audio_length, sample_rate, pitches
+
+    def _read_notes(self, count):
+        """
+            Reads per-note synthesis results as a list of (status, audio),
+            where audio is None for notes that failed or were cancelled.
+        """
+        tag = self._worker.read_tag()
+        if tag == protocol.OUT_TAG_CANCELLED:
+            # a suspended request that the worker no longer has
+            return [(protocol.NOTE_STATUS_CANCELLED, None)] * count
+        if tag != protocol.OUT_TAG_AUDIO:
+            raise ValueError("expected tag {}, got {}".format(protocol.OUT_TAG_AUDIO, tag))
+
+        out_count_msg = self._worker.read(protocol.count_struct.size)
+        out_count = protocol.from_count_msg(out_count_msg)
+
+        assert out_count == count
+
+        notes = []
+        for i in range(count):
+            status_msg = self._worker.read(protocol.note_status_struct.size)
+            status = protocol.from_note_status_msg(status_msg)
 
-        if tag != expected_tag:
-            raise ValueError("expected tag {}, got {}".format(expected_tag, tag))
+            audio_size_msg = self._worker.read(protocol.audio_size_struct.size)
+            audio_size = protocol.from_audio_size_msg(audio_size_msg)
+
+            if status in (protocol.NOTE_STATUS_FAILED, protocol.NOTE_STATUS_CANCELLED):
+                notes.append((status, None))
+            else:
+                notes.append((status, self._worker.read_audio(audio_size // protocol.audio_dtype.itemsize)))
+
+        return notes
+
+    def _synthesized(self, notes, audio_buf_names, pitches):
+        failed = []
+        cancelled = []
+        snapped = []
+        for i, (status, audio) in enumerate(notes):
+            if status == protocol.NOTE_STATUS_FAILED:
+                failed.append(i)
+            elif status == protocol.NOTE_STATUS_CANCELLED:
+                cancelled.append(i)
+            else:
+                if status == protocol.NOTE_STATUS_SNAPPED:
+                    snapped.append(i)
+                self._buffers.store(audio_buf_names[i], audio)
+
+        for i in failed:
+            self._outlet(1, ["failed", audio_buf_names[i], pitches[i]])
+        for i in cancelled:
+            self._outlet(1, ["cancelled", audio_buf_names[i], pitches[i]])
+        # pitch shifted from the nearest pitch the model was trained on
+        for i in snapped:
+            self._outlet(1, ["snapped", audio_buf_names[i], pitches[i]])
+
+        self._outlet(1, "synthesized")
 
     def load_ganspace_components_1(self, ganspace_components_file, component_amplitudes_buff_name):
         ganspace_components_file = os.path.join(
@@ -106,23 +240,29 @@ class gansynth(pyext._class):
         size_msg = protocol.to_int_msg(len(ganspace_components_file))
         components_msg = ganspace_components_file.encode('utf-8')
 
-        self._write_msg(protocol.IN_TAG_LOAD_COMPONENTS, size_msg, components_msg)
-        self._read_tag(protocol.OUT_TAG_LOAD_COMPONENTS)
-        count_msg = self._read(protocol.count_struct.size)
-        component_count = protocol.from_count_msg(count_msg)
+        self._submit(
+            "load_ganspace_components",
+            protocol.IN_TAG_LOAD_COMPONENTS, size_msg, components_msg,
+            read_reply = self._read_component_count,
+            done = lambda component_count: self._components_loaded(component_count, component_amplitudes_buff_name),
+            session_key = "components",
+            timeout = None
+        )
 
+    def _components_loaded(self, component_count, component_amplitudes_buff_name):
         self.ganspace_components_amplitudes_buffer_name = component_amplitudes_buff_name
-
-        buf = pyext.Buffer(component_amplitudes_buff_name)
-        buf.resize(component_count)
-        buf.dirty()
+        self._buffers.presize([component_amplitudes_buff_name], component_count)
 
         print("GANSpace components loaded!", file=sys.stderr)
 
         self._outlet(1, "loaded_pca")
 
+    def _read_component_count(self):
+        self._worker.read_tag(protocol.OUT_TAG_LOAD_COMPONENTS)
+        return self._worker.read_struct(protocol.count_struct)
+
     def randomize_z_1(self, *buf_names):
-        if not self._proc:
+        if not self._worker:
             raise Exception("can't randomize z - no gansynth_worker process is running")
 
         in_count = len(buf_names)
@@ -131,65 +271,60 @@ class gansynth(pyext._class):
             raise ValueError("no buffer name(s) specified")
         
         in_count_msg = protocol.to_count_msg(in_count)
-        self._write_msg(protocol.IN_TAG_RAND_Z, in_count_msg)
-        
-        self._read_tag(protocol.OUT_TAG_Z)
+        self._submit(
+            "randomize_z",
+            protocol.IN_TAG_RAND_Z, in_count_msg,
+            read_reply = lambda: self._read_zs(in_count),
+            done = lambda zs: self._store_zs(zs, buf_names, "randomized")
+        )
 
-        out_count_msg = self._read(protocol.count_struct.size)
+    def _read_zs(self, count):
+        self._worker.read_tag(protocol.OUT_TAG_Z)
+
+        out_count_msg = self._worker.read(protocol.count_struct.size)
         out_count = protocol.from_count_msg(out_count_msg)
         
-        assert out_count == in_count
+        assert out_count == count
 
-        for buf_name in buf_names:
-            z_msg = self._read(protocol.z_struct.size)
-            z = protocol.from_z_msg(z_msg)
+        zs = []
+        for i in range(count):
+            z_msg = self._worker.read(protocol.z_struct.size)
+            zs.append(protocol.from_z_msg(z_msg).astype(np.float32))
 
-            z32 = z.astype(np.float32)
-        
-            buf = pyext.Buffer(buf_name)
-            if len(buf) != len(z32):
-                buf.resize(len(z32))
+        return zs
 
-            buf[:] = z32
-            buf.dirty()
+    def _store_zs(self, zs, buf_names, what):
+        for z32, buf_name in zip(zs, buf_names):
+            self._buffers.store(buf_name, z32)
 
-        self._outlet(1, "randomized")
+        self._outlet(1, what)
 
     def slerp_z_1(self, z0_name, z1_name, z_dst_name, amount):
-        if not self._proc:
+        if not self._worker:
             raise Exception("can't slerp - no gansynth_worker process is running")
 
-        z0_buf = pyext.Buffer(z0_name)
-        z1_buf = pyext.Buffer(z1_name)
-        z_dst_buf = pyext.Buffer(z_dst_name)
-
-        z0_f64 = np.array(z0_buf, dtype=np.float64)
-        z1_f64 = np.array(z1_buf, dtype=np.float64)
-        
-        self._write_msg(protocol.IN_TAG_SLERP_Z, protocol.to_slerp_z_msg(z0_f64, z1_f64, amount))
-
-        self._read_tag(protocol.OUT_TAG_Z)
+        z0 = np.asarray(self._buffers.get(z0_name))
+        z1 = np.asarray(self._buffers.get(z1_name))
 
-        out_count_msg = self._read(protocol.count_struct.size)
-        out_count = protocol.from_count_msg(out_count_msg)
-
-        assert out_count == 1
-
-        z_msg = self._read(protocol.z_struct.size)
-        z = protocol.from_z_msg(z_msg)
+        self._submit(
+            "slerp_z",
+            protocol.IN_TAG_SLERP_Z,
+            protocol.to_slerp_z_msg(z0, z1, amount),
+            read_reply = lambda: self._read_zs(1),
+            done = lambda zs: self._store_zs(zs, [z_dst_name], "slerped")
+        )
 
-        z32 = z.astype(np.float32)
+    # pitch_shift max_shift [quality]: derive notes up to max_shift semitones
+    # from a single render per z; quality 0 is linear, 1 is sinc resampling
+    def pitch_shift_1(self, max_shift, quality=protocol.RESAMPLE_SINC):
+        if int(quality) not in (protocol.RESAMPLE_LINEAR, protocol.RESAMPLE_SINC):
+            raise ValueError("invalid quality ({}), should be {} (linear) or {} (sinc)".format(quality, protocol.RESAMPLE_LINEAR, protocol.RESAMPLE_SINC))
 
-        if len(z_dst_buf) != len(z32):
-            z_dst_buf.resize(len(z32))
-        
-        z_dst_buf[:] = z32
-        z_dst_buf.dirty()
-
-        self._outlet(1, "slerped")
+        self.pitch_shift = max(0, int(max_shift))
+        self.pitch_shift_quality = int(quality)
 
     def synthesize_1(self, *args):
-        if not self._proc:
+        if not self._worker:
             raise Exception("can't synthesize - no gansynth_worker process is running")
         
         arg_count = len(args)
@@ -198,58 +333,42 @@ class gansynth(pyext._class):
             raise ValueError("invalid number of arguments ({}), should be a multiple of 3: synthesize z1 audio1 pitch1 [z2 audio2 pitch2 ...]".format(arg_count))
 
         if self.ganspace_components_amplitudes_buffer_name:
-            component_buff = pyext.Buffer(self.ganspace_components_amplitudes_buffer_name)
-            components = np.array(component_buff, dtype=np.float64)
-            component_msgs = []
-            for value in components:
-                component_msgs.append(protocol.to_float_msg(value))
-            self._write_msg(protocol.IN_TAG_SET_COMPONENT_AMPLITUDES, *component_msgs)
-
-
-        gen_msgs = []
-        audio_buf_names = []
-        for i in range(0, arg_count, 3):
-            z_buf_name, audio_buf_name, pitch = args[i:i+3]
-
-            z32_buf = pyext.Buffer(z_buf_name)
-            z = np.array(z32_buf, dtype=np.float64)
-            
-            gen_msgs.append(protocol.to_gen_msg(pitch, z))
-            audio_buf_names.append(audio_buf_name)
-            
-        in_count = len(gen_msgs)
-        in_count_msg = protocol.to_count_msg(in_count)
-        self._write_msg(protocol.IN_TAG_GEN_AUDIO, in_count_msg, *gen_msgs)
-                
-        self._read_tag(protocol.OUT_TAG_AUDIO)
-
-        out_count_msg = self._read(protocol.count_struct.size)
-        out_count = protocol.from_count_msg(out_count_msg)
-        
-        if out_count == 0:
-            return
-
-        assert out_count == in_count
-
-        for audio_buf_name in audio_buf_names:
-            audio_size_msg = self._read(protocol.audio_size_struct.size)
-            audio_size = protocol.from_audio_size_msg(audio_size_msg)
-
-            audio_msg = self._read(audio_size)
-            audio_note = protocol.from_audio_msg(audio_msg)
-
-            audio_buf = pyext.Buffer(audio_buf_name)
-            if len(audio_buf) != len(audio_note):
-                audio_buf.resize(len(audio_note))
+            component_buff = self._buffers.get(self.ganspace_components_amplitudes_buffer_name)
+            amplitudes_msg = protocol.to_component_amplitudes_msg(np.asarray(component_buff))
+            queued = self._submit(
+                "synthesize",
+                protocol.IN_TAG_SET_COMPONENT_AMPLITUDES, amplitudes_msg,
+                session_key = "amplitudes",
+                timeout = None
+            )
+            if not queued:
+                return
+
+
+        z_buf_names = args[0::3]
+        audio_buf_names = args[1::3]
+        pitches = args[2::3]
+
+        gen_msg = protocol.to_gen_audio_request_msg(
+            pitches,
+            [np.asarray(self._buffers.get(z_buf_name)) for z_buf_name in z_buf_names]
+        )
+        if self.pitch_shift > 0:
+            shifted_msg = protocol.to_gen_audio_shifted_msg(self.pitch_shift, self.pitch_shift_quality)
+            gen_msgs = (protocol.IN_TAG_GEN_AUDIO_SHIFTED, shifted_msg, gen_msg)
+        else:
+            gen_msgs = (protocol.IN_TAG_GEN_AUDIO, gen_msg)
 
-            audio_buf[:] = audio_note
-            audio_buf.dirty()
-        
-        self._outlet(1, "synthesized")
+        self._submit(
+            "synthesize",
+            *gen_msgs,
+            read_reply = lambda: self._read_notes(len(audio_buf_names)),
+            done = lambda notes: self._synthesized(notes, audio_buf_names, pitches)
+        )
 
     # expected format: synthesize_noz buf1 pitch1 [edit1_1 edit1_2 ...] -- buf2 pitch2 [...] -- [...]
     def synthesize_noz_1(self, *args):
-        if not self._proc:
+        if not self._worker:
             raise Exception("can't synthesize - no gansynth_worker process is running")
 
         # parse the input
@@ -274,64 +393,33 @@ class gansynth(pyext._class):
                 
         # validate input and build synthesize messages
         
-        synth_msgs = []
         for sound in sounds:
             if None in [sound.buf, sound.pitch]:
                 raise ValueError("invalid syntax, should be: synthesize_noz buf1 pitch1 [edit1_1 edit1_2 ...] [-- buf2 pitch2 [edit2_1 edit2_2 ...]] [-- ...")
 
-            edits = []
-            for edit in sound.edits:
-                print(f"type(edit) = {type(edit)}")
-                if isinstance(edit, pyext.Symbol):
-                    # edit refers to a Pd array
-                    edits_buf = pyext.Buffer(edit)
-                    for val in edits_buf:
-                        edits.append(val)
-                else:
-                    # edit is a number, probably
-                    edits.append(edit)
-            
-            synth_msgs.append(protocol.to_synthesize_noz_msg(sound.pitch, len(edits)))
-            for edit in edits:
-                synth_msgs.append(protocol.to_f64_msg(edit))
+            # edits referring to Pd arrays are read in place
+            sound.edits = [
+                np.asarray(self._buffers.get(edit)) if isinstance(edit, pyext.Symbol) else edit
+                for edit in sound.edits
+            ]
 
         # write synthesize messages
-        
-        in_count = len(sounds)
-        in_count_msg = protocol.to_count_msg(in_count)
-        self._write_msg(protocol.IN_TAG_SYNTHESIZE_NOZ, in_count_msg, *synth_msgs)
-        
-        # wait for output
 
-        self._read_tag(protocol.OUT_TAG_AUDIO)
-
-        out_count_msg = self._read(protocol.count_struct.size)
-        out_count = protocol.from_count_msg(out_count_msg)
-        
-        assert out_count == in_count
-
-        if out_count == 0:
-            return
-
-        for sound in sounds:
-            audio_size_msg = self._read(protocol.audio_size_struct.size)
-            audio_size = protocol.from_audio_size_msg(audio_size_msg)
-
-            audio_msg = self._read(audio_size)
-            audio_note = protocol.from_audio_msg(audio_msg)
-
-            audio_buf_name = sound.buf
-            audio_buf = pyext.Buffer(audio_buf_name)
-            if len(audio_buf) != len(audio_note):
-                audio_buf.resize(len(audio_note))
-
-            audio_buf[:] = audio_note
-            audio_buf.dirty()
-        
-        self._outlet(1, "synthesized")
+        synth_msg = protocol.to_synthesize_noz_request_msg(
+            [sound.pitch for sound in sounds],
+            [sound.edits for sound in sounds]
+        )
+        audio_buf_names = [sound.buf for sound in sounds]
+        self._submit(
+            "synthesize_noz",
+            protocol.IN_TAG_SYNTHESIZE_NOZ,
+            synth_msg,
+            read_reply = lambda: self._read_notes(len(audio_buf_names)),
+            done = lambda notes: self._synthesized(notes, audio_buf_names, [sound.pitch for sound in sounds])
+        )
                 
     def hallucinate_1(self, *args):
-        if not self._proc:
+        if not self._worker:
             raise Exception("can't synthesize - load a checkpoint first")
 
         arg_count = len(args)
@@ -343,21 +431,33 @@ class gansynth(pyext._class):
         interpolation_steps = int(args[2])
         rest = list(map(float, args[3:len(args)]))
 
-        self._write_msg(protocol.IN_TAG_HALLUCINATE, protocol.to_hallucinate_msg(note_count, interpolation_steps, *rest))
+        self._submit(
+            "hallucinate",
+            protocol.IN_TAG_HALLUCINATE,
+            protocol.to_hallucinate_msg(note_count, interpolation_steps, *rest),
+            read_reply = self._read_audio,
+            done = lambda audio: self._hallucinated(audio, audio_buf_name)
+        )
 
-        self._read_tag(protocol.OUT_TAG_AUDIO)
+    def _hallucinated(self, audio, audio_buf_name):
+        if audio is None:
+            self._outlet(1, ["cancelled", "hallucinate"])
+            return
 
-        audio_size_msg = self._read(protocol.audio_size_struct.size)
-        audio_size = protocol.from_audio_size_msg(audio_size_msg)
+        self._buffers.store(audio_buf_name, audio)
+        self._outlet(1, ["hallucinated", audio.size * audio.itemsize])
 
-        audio_msg = self._read(audio_size)
-        audio_note = protocol.from_audio_msg(audio_msg)
+    def _read_audio(self):
+        """
+            Reads a hallucination, or returns None if it was cancelled.
+        """
+        tag = self._worker.read_tag()
+        if tag == protocol.OUT_TAG_CANCELLED:
+            return None
+        if tag != protocol.OUT_TAG_AUDIO:
+            raise ValueError("expected tag {}, got {}".format(protocol.OUT_TAG_AUDIO, tag))
 
-        audio_buf = pyext.Buffer(audio_buf_name)
-        if len(audio_buf) != len(audio_note):
-            audio_buf.resize(len(audio_note))
+        audio_size_msg = self._worker.read(protocol.audio_size_struct.size)
+        audio_size = protocol.from_audio_size_msg(audio_size_msg)
 
-        audio_buf[:] = audio_note
-        audio_buf.dirty()
-        
-        self._outlet(1, ["hallucinated", audio_size])
+        return self._worker.read_audio(audio_size // protocol.audio_dtype.itemsize)
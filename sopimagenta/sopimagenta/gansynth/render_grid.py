@@ -0,0 +1,263 @@
+# Renders a grid of slerped GANSynth latent vectors across a list of pitches
+# into a rows x cols x pitches x length int16 atlas plus settings JSON, the
+# layout nsynth.pyext plays back. Rows are rendered in parallel by several
+# gansynth_worker processes; finished rows are recorded in <audio>.progress so
+# an interrupted render resumes when run again with the same arguments.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import traceback
+
+import numpy as np
+
+from sopilib.client import worker_client
+import sopilib.gansynth_protocol as protocol
+from sopilib.utils import print_err
+
+def slerp(p0, p1, t):
+    omega = np.arccos(np.clip(np.dot(p0/np.linalg.norm(p0), p1/np.linalg.norm(p1)), -1.0, 1.0))
+    so = np.sin(omega)
+    if so == 0.0:
+        return (1.0 - t) * p0 + t * p1
+    return np.sin((1.0-t)*omega) / so * p0 + np.sin(t*omega)/so * p1
+
+def grid_zs(corners, rows, cols):
+    """
+        Slerps the corners (top left, top right, bottom left, bottom right)
+        into a rows x cols grid of latent vectors.
+    """
+    z00, z01, z10, z11 = corners
+    ys = np.linspace(0.0, 1.0, rows) if rows > 1 else [0.0]
+    xs = np.linspace(0.0, 1.0, cols) if cols > 1 else [0.0]
+
+    zs = np.empty((rows, cols, len(z00)), dtype=np.float64)
+    for col, x in enumerate(xs):
+        top = slerp(z00, z01, x)
+        bottom = slerp(z10, z11, x)
+        for row, y in enumerate(ys):
+            zs[row, col] = slerp(top, bottom, y)
+
+    return zs
+
+def to_int16(audio):
+    return (np.clip(audio, -1.0, 1.0) * (2**15 - 1)).astype(np.int16)
+
+class gansynth_client(worker_client):
+    def __init__(self, ckpt_dir, batch_size, name):
+        super().__init__("gansynth_worker", protocol, ckpt_dir, batch_size)
+        self.name = name
+
+        self.read_tag(protocol.OUT_TAG_INIT)
+        self.audio_length, self.sample_rate = self.read_struct(protocol.init_struct)
+
+        self.write_msg(protocol.IN_TAG_GET_PITCHES)
+        self.read_tag(protocol.OUT_TAG_PITCHES)
+        count = self.read_struct(protocol.count_struct)
+        self.pitches = protocol.from_pitches_msg(self.read(count * protocol.int_struct.size))
+
+    def load_components(self, components_file, amplitudes):
+        path_msg = components_file.encode("utf-8")
+        self.write_msg(protocol.IN_TAG_LOAD_COMPONENTS, protocol.to_int_msg(len(path_msg)), path_msg)
+        self.read_tag(protocol.OUT_TAG_LOAD_COMPONENTS)
+        self.read_struct(protocol.count_struct)
+
+        self.write_msg(protocol.IN_TAG_SET_COMPONENT_AMPLITUDES, protocol.to_component_amplitudes_msg(amplitudes))
+
+    def rand_z(self, count):
+        self.write_msg(protocol.IN_TAG_RAND_Z, protocol.to_count_msg(count))
+        self.read_tag(protocol.OUT_TAG_Z)
+        out_count = protocol.from_count_msg(self.read(protocol.count_struct.size))
+        return [protocol.from_z_msg(self.read(protocol.z_struct.size)) for i in range(out_count)]
+
+    def gen_audio(self, zs, pitches):
+        """
+            Synthesizes one note per (z, pitch). Notes that fail are None.
+        """
+        gen_msgs = [protocol.to_gen_msg(pitch, z) for z, pitch in zip(zs, pitches)]
+        self.write_msg(protocol.IN_TAG_GEN_AUDIO, protocol.to_count_msg(len(gen_msgs)), *gen_msgs)
+        self.read_tag(protocol.OUT_TAG_AUDIO)
+
+        out_count = protocol.from_count_msg(self.read(protocol.count_struct.size))
+        audios = []
+        for i in range(out_count):
+            status = protocol.from_note_status_msg(self.read(protocol.note_status_struct.size))
+            audio_size = protocol.from_audio_size_msg(self.read(protocol.audio_size_struct.size))
+
+            if status == protocol.NOTE_STATUS_FAILED:
+                audios.append(None)
+            else:
+                audios.append(protocol.from_audio_msg(self.read(audio_size)))
+
+        return audios
+
+def read_progress(progress_path):
+    if not os.path.exists(progress_path):
+        return set()
+
+    with open(progress_path, "r") as f:
+        return set(int(line) for line in f if line.strip())
+
+def render_chunks(client, chunks, zs, pitches, length, batch_size, audio, progress, progress_lock, progress_path):
+    while True:
+        try:
+            row = chunks.get_nowait()
+        except queue.Empty:
+            return
+
+        notes = [(col, pitch_i) for col in range(zs.shape[1]) for pitch_i in range(len(pitches))]
+        for i in range(0, len(notes), batch_size):
+            batch = notes[i:i+batch_size]
+            audios = client.gen_audio([zs[row, col] for col, _ in batch], [pitches[pitch_i] for _, pitch_i in batch])
+
+            for (col, pitch_i), note in zip(batch, audios):
+                if note is None:
+                    print_err("row {} col {}: failed to synthesize pitch {}".format(row, col, pitches[pitch_i]))
+                    audio[row, col, pitch_i] = 0
+                else:
+                    n = min(length, len(note))
+                    audio[row, col, pitch_i, :n] = to_int16(note[:n])
+                    audio[row, col, pitch_i, n:] = 0
+
+        audio.flush()
+
+        with progress_lock:
+            progress.add(row)
+            with open(progress_path, "a") as f:
+                f.write("{}\n".format(row))
+
+        print_err("{}: finished row {} ({}/{})".format(client.name, row, len(progress), zs.shape[0]))
+
+def render_thread(errors, *args):
+    try:
+        render_chunks(*args)
+    except Exception as e:
+        traceback.print_exc()
+        errors.append(e)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Render a GANSynth latent grid into an NSynth-style audio atlas.")
+    parser.add_argument("ckpt_dir")
+    parser.add_argument("audio_path")
+    parser.add_argument("settings_path")
+    parser.add_argument("--resolution", type = int, default = 8, help = "number of rows and columns")
+    parser.add_argument("--pitches", type = int, nargs = "+", default = [24, 36, 48, 60, 72, 84])
+    parser.add_argument("--corners", nargs = 4, metavar = "Z_NPY", help = "latent vectors for the corners (top left, top right, bottom left, bottom right); random if omitted")
+    parser.add_argument("--length", type = int, help = "note length in samples; defaults to the model's audio length")
+    parser.add_argument("--components", help = "GANSpace components file used to edit every note")
+    parser.add_argument("--amplitudes", type = float, nargs = "*", default = [], help = "GANSpace component amplitudes")
+    parser.add_argument("--workers", type = int, default = 1, help = "number of gansynth_worker processes")
+    parser.add_argument("--batch-size", type = int, default = 8)
+    args = parser.parse_args()
+
+    pitches = sorted(args.pitches)
+    rows = cols = args.resolution
+    progress_path = args.audio_path + ".progress"
+    corners_path = args.audio_path + ".corners.npy"
+    grid_path = args.audio_path + ".grid.json"
+
+    print_err("starting {} gansynth_worker process(es), this may take a while".format(args.workers))
+    clients = [gansynth_client(args.ckpt_dir, args.batch_size, "gansynth_worker {}".format(i)) for i in range(args.workers)]
+
+    try:
+        untrained = sorted(set(pitches) - set(clients[0].pitches))
+        if untrained:
+            print_err("model was not trained on pitches {}, they will be pitch shifted".format(untrained))
+
+        if args.components:
+            for client in clients:
+                client.load_components(args.components, args.amplitudes)
+
+        # the corners are saved so a resumed render continues the same grid
+        saved_corners = np.load(corners_path) if os.path.exists(corners_path) else None
+        if args.corners:
+            corners = np.array([np.load(path).astype(np.float64).reshape(protocol.Z_SIZE) for path in args.corners])
+            if saved_corners is not None and not np.array_equal(corners, saved_corners):
+                print_err("--corners differ from the corners of the render in {}, delete it to start a new render".format(corners_path))
+                sys.exit(1)
+        elif saved_corners is not None:
+            corners = saved_corners
+        else:
+            corners = np.array(clients[0].rand_z(4))
+        np.save(corners_path, corners)
+
+        length = args.length or clients[0].audio_length
+        shape = (rows, cols, len(pitches), length)
+
+        # the layout is saved so a resume can't reinterpret the atlas
+        grid = {"resolution": rows, "pitches": pitches, "length": length}
+
+        progress = read_progress(progress_path)
+        if progress and os.path.exists(args.audio_path):
+            saved_grid = None
+            if os.path.exists(grid_path):
+                with open(grid_path, "r") as f:
+                    saved_grid = json.load(f)
+
+            expected_size = int(np.prod(shape)) * np.dtype(np.int16).itemsize
+            if (saved_grid is not None and saved_grid != grid) or os.path.getsize(args.audio_path) != expected_size:
+                print_err("--resolution, --pitches or --length differ from the render in {}, delete {} to start a new render".format(args.audio_path, progress_path))
+                sys.exit(1)
+
+            audio = np.memmap(args.audio_path, dtype = np.int16, mode = "r+", shape = shape)
+            print_err("resuming, {}/{} rows already rendered".format(len(progress), rows))
+        else:
+            # starting over, so rows recorded for an earlier file don't count
+            progress = set()
+            open(progress_path, "w").close()
+            audio = np.memmap(args.audio_path, dtype = np.int16, mode = "w+", shape = shape)
+
+        with open(grid_path, "w") as f:
+            json.dump(grid, f)
+
+        settings = {
+            "nsynth": {
+                "resolution": rows,
+                "length": length,
+                "sampleRate": clients[0].sample_rate,
+                "pitches": pitches
+            }
+        }
+        with open(args.settings_path, "w") as f:
+            json.dump(settings, f, indent = 2)
+
+        zs = grid_zs(corners, rows, cols)
+
+        chunks = queue.Queue()
+        for row in range(rows):
+            if row not in progress:
+                chunks.put(row)
+
+        progress_lock = threading.Lock()
+        errors = []
+        threads = [
+            threading.Thread(
+                target = render_thread,
+                args = (errors, client, chunks, zs, pitches, length, args.batch_size, audio, progress, progress_lock, progress_path)
+            )
+            for client in clients
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if len(progress) == rows:
+            print_err("done: {}".format(args.audio_path))
+        else:
+            print_err("rendered {}/{} rows, run again to resume".format(len(progress), rows))
+
+        if errors:
+            print_err("{} worker thread(s) failed".format(len(errors)))
+            sys.exit(1)
+    finally:
+        for client in clients:
+            client.close()
+
+if __name__ == "__main__":
+    main()
@@ -14,7 +14,8 @@ from magenta.models.gansynth.lib import util
 import tensorflow.compat.v1 as tf
 
 import sopilib.gansynth_protocol as gss
-from sopilib.utils import print_err, read_msg
+from sopilib.utils import print_err
+import sopilib.worker
 
 from handlers import handlers
 
@@ -30,23 +31,11 @@ except IndexError:
 flags = lib_flags.Flags({"batch_size_schedule": [batch_size], "dataset_name": "nsynth_tfrecord"})
 model = lib_model.Model.load_from_path(ckpt_dir, flags)
 
-stdin = os.fdopen(sys.stdin.fileno(), "rb", 0)
-stdout = os.fdopen(sys.stdout.fileno(), "wb", 0)
-stdout.write(gss.to_tag_msg(gss.OUT_TAG_INIT))
+worker = sopilib.worker.worker(gss, model)
+worker.add_handlers(handlers)
+worker.state["batch_size"] = batch_size
 
 audio_length = model.config['audio_length']
 sample_rate = model.config['sample_rate']
-info_msg = gss.to_info_msg(audio_length=audio_length, sample_rate=sample_rate)
-stdout.write(info_msg)
-stdout.flush()
-
-state = {}
-
-while True:
-    in_tag_msg = read_msg(stdin, gss.tag_struct.size)
-    in_tag = gss.from_tag_msg(in_tag_msg)
-    
-    if in_tag not in handlers:
-        raise ValueError("unknown input message tag: {}".format(in_tag))
-
-    handlers[in_tag](model, stdin, stdout, state)
+worker.start(gss.to_info_msg(audio_length=audio_length, sample_rate=sample_rate))
+worker.serve()
@@ -6,20 +6,150 @@ print("loading melody_rnn")
 import sys    
 
 import os
-import queue
 import random
 import threading
 import time
 
-import magenta
-from magenta.models.melody_rnn import melody_rnn_config_flags, melody_rnn_model, melody_rnn_sequence_generator
-from magenta.models.shared.sequence_generator_bundle import read_bundle_file
-from magenta.music.protobuf import generator_pb2, music_pb2
 import monotonic
-import pretty_midi
 
+from sopilib.client import worker_client, worker_died
+import sopilib.melody_rnn_protocol as protocol
+from sopilib.primer import primer_buffer
+from sopilib.scheduler import scheduler
 from sopilib.utils import print_err
 
+class melody_rnn_worker(object):
+    """
+        A melody_rnn_worker process. Requests are written from the Pd thread
+        and answered on a reader thread, which hands the generated notes to the
+        callback registered for the request. When the worker exits, pending
+        and later requests get None.
+    """
+    def __init__(self, bundle_path, config_name):
+        self.name = "melody_rnn_worker {}".format(os.path.basename(bundle_path))
+        self.ready = threading.Event()
+        self.failed = False
+
+        self._callbacks = {}
+        self._next_request_id = 0
+        self._lock = threading.Lock()
+
+        self._client = worker_client("melody_rnn_worker", protocol, bundle_path, config_name)
+        threading.Thread(target = self._keep_reading, daemon = True).start()
+
+    def _read_notes(self, note_count):
+        notes_msg = self._client.read(protocol.notes_size(note_count)) if note_count else b""
+        return protocol.from_notes_msg(notes_msg)
+
+    def _keep_reading(self):
+        try:
+            self._client.read_tag(protocol.OUT_TAG_INIT)
+
+            self.ready.set()
+
+            while True:
+                tag = self._client.read_tag()
+                if tag == protocol.OUT_TAG_GENERATED:
+                    request_id, note_count = self._client.read_struct(protocol.generated_struct)
+                    result = self._read_notes(note_count)
+                elif tag == protocol.OUT_TAG_CANDIDATES:
+                    request_id, candidate_count = self._client.read_struct(protocol.candidates_struct)
+                    result = []
+                    for i in range(candidate_count):
+                        score, note_count = self._client.read_struct(protocol.candidate_struct)
+                        result.append((score, self._read_notes(note_count)))
+                else:
+                    raise ValueError("unexpected tag {}".format(tag))
+
+                with self._lock:
+                    callback = self._callbacks.pop(request_id, None)
+
+                if callback:
+                    callback(result)
+        except (EOFError, worker_died):
+            print_err("{} exited".format(self.name))
+        except Exception as e:
+            print_err("{} failed: {}".format(self.name, e))
+        finally:
+            with self._lock:
+                self.failed = True
+                pending = list(self._callbacks.values())
+                self._callbacks.clear()
+
+            self.ready.set()
+
+            for callback in pending:
+                callback(None)
+
+    def _request(self, tag, callback, *msgs_for_id):
+        """
+            Registers callback under a new request id and writes the request
+            built by msgs_for_id(request_id). A dead worker calls back None.
+        """
+        with self._lock:
+            if not self.failed:
+                request_id = self._next_request_id
+                self._next_request_id += 1
+                self._callbacks[request_id] = callback
+
+                try:
+                    self._client.write_msg(tag, *(to_msg(request_id) for to_msg in msgs_for_id))
+                    return request_id
+                except worker_died:
+                    self.failed = True
+                    del self._callbacks[request_id]
+
+        print_err("{} is not running, load the bundle again".format(self.name))
+        callback(None)
+        return None
+
+    def generate(self, notes, qpm, duration, callback):
+        return self._request(
+            protocol.IN_TAG_GENERATE,
+            callback,
+            lambda request_id: protocol.to_generate_msg(request_id, duration, qpm, len(notes)),
+            lambda request_id: protocol.to_primer_notes_msg(notes)
+        )
+
+    def generate_candidates(self, notes, qpm, duration, candidate_count, score_type, callback):
+        """
+            Generates candidate_count continuations in one request; callback
+            gets a list of (score, notes), best first.
+        """
+        return self._request(
+            protocol.IN_TAG_GENERATE_CANDIDATES,
+            callback,
+            lambda request_id: protocol.to_generate_candidates_msg(request_id, duration, qpm, len(notes), candidate_count, score_type),
+            lambda request_id: protocol.to_primer_notes_msg(notes)
+        )
+
+# note playback for all melody_rnn objects runs on one scheduler thread
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    global _scheduler
+
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = scheduler()
+
+        return _scheduler
+
+# workers are shared by all melody_rnn objects, keyed by bundle path
+_workers = {}
+_workers_lock = threading.Lock()
+
+def get_worker(bundle_path, config_name):
+    with _workers_lock:
+        worker = _workers.get(bundle_path)
+
+        if worker is None or worker.failed:
+            worker = melody_rnn_worker(bundle_path, config_name)
+            _workers[bundle_path] = worker
+
+        return worker
+
 try:
     import pyext
     ext_class = pyext._class
@@ -30,199 +160,254 @@ except:
         def _outlet(self, *args):
             print_err("_outlet{}".format(args))
 
+score_types = {
+    "similarity": protocol.SCORE_SIMILARITY,
+    "range": protocol.SCORE_RANGE,
+    "density": protocol.SCORE_DENSITY
+}
+
 test_notes = [(0.5, 32, 100), (0.6, 33, 50), (0.7, 33, 0), (0.8, 32, 0)]
 
-def notes_to_midi(notes, t0 = 0.0):    
-    midi = pretty_midi.PrettyMIDI()
-    inst = pretty_midi.Instrument(0)
+class melody_rnn(ext_class):
+    def __init__(self, *args):
+        self._inlets = 1
+        self._outlets = 1
 
-    # add notes to instrument
-    # a note is added only after a note-on and a corresponding note-off
-    notes_on = {}
-    for t_raw, pitch, vel in notes:
-        t = t_raw - t0
-        
-        if vel > 0:
-            notes_on[pitch] = (t, vel)
-        elif pitch in notes_on:
-            t_on, vel_on = notes_on[pitch]
-            note = pretty_midi.Note(vel_on, pitch, t_on, t)
-            inst.notes.append(note)
+        self.worker = None
+        self.loader = None
+        self.primer = primer_buffer()
+        self.notes_version = 0
 
-    # sort notes by start time
-    inst.notes.sort(key = lambda n: n.start)
-            
-    midi.instruments.append(inst)
+        # speculative mode: generate in the background whenever the primer
+        # changes, so that generate can answer with a ready continuation
+        self.speculate = False
+        self.speculate_delay = 0.2
+        self.speculate_duration = 4.0
+        self.speculate_timer = None
+        self.speculated = {}
+        self.speculate_waiting = None
+        self.speculate_lock = threading.Lock()
 
-    return midi
+        self.candidates = []
 
-def midi_to_notes(midi):
-    notes = []
+        self.scheduler = get_scheduler()
+        self.play_end = 0.0
+        self.play_lock = threading.Lock()
 
-    # split notes into on and off notes
-    for midi_note in midi.instruments[0].notes:
-        notes.append((midi_note.start, midi_note.pitch, midi_note.velocity))
-        notes.append((midi_note.end, midi_note.pitch, 0))
+    def _play(self, notes):
+        # sequences play one after another
+        with self.play_lock:
+            t0 = max(time.monotonic(), self.play_end)
 
-    # sort notes by time
-    notes.sort(key = lambda n: n[0])
+            if not notes:
+                self.play_end = self.scheduler.schedule_sequence(t0, [(0.0, None)], self._play_notes, self)
+                return
 
-    return notes
+            last_t = max(t for t, pitch, vel in notes)
+            events = [(t, (pitch, vel, t == last_t)) for t, pitch, vel in notes]
+            self.play_end = self.scheduler.schedule_sequence(t0, events, self._play_notes, self)
 
-def steps_to_seconds(steps, qpm):
-    return steps * 60.0 / qpm / 4.0
+    def _play_notes(self, payloads):
+        notes = [payload for payload in payloads if payload is not None]
 
-class melody_rnn(ext_class):
-    def __init__(self, *args):
-        self._inlets = 1
-        self._outlets = 1
+        if len(notes) == 1:
+            pitch, vel, is_last = notes[0]
+            self._outlet(1, "note", pitch, vel)
+        elif notes:
+            self._outlet(1, "notes", *[x for pitch, vel, is_last in notes for x in (pitch, vel)])
+
+        if len(notes) < len(payloads) or any(is_last for pitch, vel, is_last in notes):
+            self._outlet(1, "played")
+
+    def stop_1(self):
+        with self.play_lock:
+            self.scheduler.cancel(self)
+            self.play_end = 0.0
+
+    # flush: play the rest of the scheduled notes right away, so that no
+    # note is left hanging
+    def flush_1(self):
+        with self.play_lock:
+            self.scheduler.flush(self)
+            self.play_end = 0.0
+        
+    def load_1(self, bundle_name):
+        bundle_name = str(bundle_name)
+        bundle_path = os.path.join(self._canvas_dir, bundle_name+'.mag')
 
-        self.generator = None
-        self.notes = []
-        self.t0 = 0
+        if self.loader and self.loader.is_alive():
+            print_err("still loading, ignoring load", bundle_name)
+            return
 
-        self.queue = queue.Queue()
-        self.play_thread = threading.Thread(target = self._keep_playing)
-        self.play_thread.start()
+        self.loader = threading.Thread(target = self._load, args = (bundle_path, bundle_name), daemon = True)
+        self.loader.start()
 
-    def _make_play_note(self, pitch, vel, is_last):
-        def _play_note():
-            self._outlet(1, "note", pitch, vel)
-            if is_last:
-                self._outlet(1, "played")
+    def _load(self, bundle_path, bundle_name):
+        worker = get_worker(bundle_path, bundle_name)
+        worker.ready.wait()
 
-        return _play_note
-        
-    def _keep_playing(self):
-        pending_timer = None
-        while True:
-            # wait for any previous sequence to finish
+        if worker.failed:
+            print_err("failed to load {}".format(bundle_path))
+            return
 
-            if pending_timer:
-                pending_timer.join(timeout = 1.0)
+        self.worker = worker
+        self._outlet(1, "loaded")
 
-                if self._shouldexit:
-                    return
+    def note_1(self, pitch, vel):
+        # the primer is also read from the speculation timer thread
+        with self.speculate_lock:
+            self.primer.add(monotonic.time.time(), int(pitch), int(vel))
+        self._primer_changed()
 
-                if pending_timer.is_alive():
-                    continue
-                else:
-                    pending_timer = None
+    def clear_1(self):
+        with self.speculate_lock:
+            self.primer.clear()
+        self._primer_changed()
+
+    # primer_length n: keep at most the last n notes as the primer
+    def primer_length_1(self, n):
+        with self.speculate_lock:
+            self.primer.resize(max(1, int(n)))
+        self._primer_changed()
+
+    # speculate on [duration [delay_ms]]: after the primer has been unchanged
+    # for delay_ms, generate a continuation of the given duration in the
+    # background; speculate off turns it off
+    def speculate_1(self, on, duration=None, delay_ms=None):
+        self.speculate = str(on) not in ("0", "off")
+
+        if duration is not None:
+            self.speculate_duration = float(duration)
+        if delay_ms is not None:
+            self.speculate_delay = float(delay_ms) / 1000.0
+
+        if self.speculate:
+            self._primer_changed()
+        elif self.speculate_timer:
+            self.speculate_timer.cancel()
+
+    def _primer_changed(self):
+        with self.speculate_lock:
+            self.notes_version += 1
+            self.speculated.clear()
+
+            # a generate waiting for the speculation that just went stale is
+            # answered with a regular generate from the new primer
+            waiting, self.speculate_waiting = self.speculate_waiting, None
+            if waiting is not None:
+                notes = self.primer.notes()
+                qpm = self.primer.qpm()
+
+            if self.speculate_timer:
+                self.speculate_timer.cancel()
+
+            if self.speculate and self.worker is not None:
+                self.speculate_timer = threading.Timer(self.speculate_delay, self._speculate, (self.notes_version,))
+                self.speculate_timer.start()
+
+        if waiting is not None:
+            self.worker.generate(notes, qpm, waiting[1], self._generated)
+
+    def _speculate(self, version):
+        with self.speculate_lock:
+            if version != self.notes_version:
+                return
 
-            # get notes from queue
-            
-            try:
-                notes = self.queue.get(timeout = 1.0)
-            except queue.Empty:
-                notes = None
+            key = (version, self.speculate_duration)
+            self.speculated[key] = None
+            notes = self.primer.notes()
+            qpm = self.primer.qpm()
 
-            if self._shouldexit:
+        self.worker.generate(notes, qpm, key[1], lambda gen_notes: self._speculated(key, gen_notes))
+
+    def _speculated(self, key, gen_notes):
+        with self.speculate_lock:
+            if key not in self.speculated:
+                # the primer changed while generating
                 return
 
-            if notes == None:
-                # queue was empty
-                continue
+            if self.speculate_waiting == key:
+                # generate was called while this was running
+                self.speculate_waiting = None
+                del self.speculated[key]
+                self._generated(gen_notes)
+            elif gen_notes is None:
+                # the worker died, generate asks again
+                del self.speculated[key]
+            else:
+                self.speculated[key] = gen_notes
 
-            if not notes:
-                # got empty notes list
-                self._outlet(1, "played")
-                continue
-            
-            # schedule note timers
-            
-            last_i = len(notes) - 1
-            timers = []
-            for i, (t, pitch, vel) in enumerate(notes):
-                is_last = i == last_i
-                play_note = self._make_play_note(pitch, vel, is_last)
-                timer = threading.Timer(t, play_note)
-                timers.append(timer)
-
-                if is_last:
-                    pending_timer = timer
-
-            for timer in timers:
-                timer.start()                
+    def state_1(self):
+        print_err("notes =", self.primer.notes().tolist())
+        print_err("qpm =", self.primer.qpm())
         
-    def load_1(self, bundle_name):
-        bundle_name = str(bundle_name)
-        config = magenta.models.melody_rnn.melody_rnn_model.default_configs[bundle_name]
-        bundle_file = read_bundle_file(os.path.join(self._canvas_dir, bundle_name+'.mag'))
-        steps_per_quarter = 4
-
-        self.generator = melody_rnn_sequence_generator.MelodyRnnSequenceGenerator(
-            model = melody_rnn_model.MelodyRnnModel(config),
-            details = config.details,
-            steps_per_quarter = steps_per_quarter,
-            bundle = bundle_file
+    def generate_1(self, duration):        
+        if self.worker is None:
+            print_err("can't generate - no bundle loaded")
+            return
+
+        with self.speculate_lock:
+            key = (self.notes_version, float(duration))
+
+            if key in self.speculated:
+                gen_notes = self.speculated[key]
+                if gen_notes is None:
+                    # still generating, play it as soon as it's done
+                    self.speculate_waiting = key
+                else:
+                    del self.speculated[key]
+                    self._generated(gen_notes)
+                return
+
+        # the generated notes are scheduled for playback when they arrive
+
+        self.worker.generate(self.primer.notes(), self.primer.qpm(), float(duration), self._generated)
+
+    # candidates duration n [score]: generate n continuations at once, play
+    # the best one by the given score and keep the rest for play_candidate
+    def candidates_1(self, duration, n, score="similarity"):
+        if self.worker is None:
+            print_err("can't generate - no bundle loaded")
+            return
+
+        score = str(score)
+        if score not in score_types:
+            print_err("unknown score {}, expected one of {}".format(score, ", ".join(sorted(score_types))))
+            return
+
+        self.worker.generate_candidates(
+            self.primer.notes(), self.primer.qpm(), float(duration), max(1, int(n)), score_types[score],
+            self._generated_candidates
         )
 
-        self._outlet(1, "loaded")
+    def _generated_candidates(self, candidates):
+        if candidates is None:
+            self._outlet(1, "failed")
+            return
 
-    def note_1(self, pitch, vel):
-        t = monotonic.time.time()
-        if len(self.notes) == 0:
-            self.t0 = t
-        
-        note = (t, pitch, vel)
-        self.notes.append(note)
+        self.candidates = [notes for score, notes in candidates]
 
-    def clear_1(self):
-        del self.notes[:]
+        self._outlet(1, "candidates", len(candidates))
+        for i, (score, notes) in enumerate(candidates):
+            self._outlet(1, "candidate", i, float(score), int((notes["vel"] > 0).sum()))
 
-    def state_1(self):
-        print_err("notes =", self.notes)
-        print_err("t0 =", self.t0)
-        
-    def generate_1(self, duration):        
-        # prepare the note sequence
-        
-        midi = notes_to_midi(self.notes, self.t0)
-        primer_seq = magenta.music.midi_io.midi_to_note_sequence(midi)
+        if self.candidates:
+            self._generated(self.candidates[0])
 
-        # predict the tempo
+    def play_candidate_1(self, i):
+        i = int(i)
+        if not 0 <= i < len(self.candidates):
+            print_err("no candidate {}".format(i))
+            return
 
-        if len(primer_seq.notes) > 4:
-            estimated_tempo = midi.estimate_tempo()
-            if estimated_tempo > 240:
-                qpm = estimated_tempo / 2
-            else:
-                qpm = estimated_tempo
-        else:
-            qpm = 120
-        
-        primer_seq.tempos[0].qpm = qpm
+        self._generated(self.candidates[i])
 
-        # generate
-        
-        gen_options = generator_pb2.GeneratorOptions()
-        last_end_time = max(n.end_time for n in primer_seq.notes) if primer_seq.notes else 0
-        gen_start_time = last_end_time + steps_to_seconds(1, qpm)
-        gen_end_time = gen_start_time + duration
-        gen_options.generate_sections.add(start_time = gen_start_time, end_time = gen_end_time)
-
-        gen_seq = self.generator.generate(primer_seq, gen_options)
-        gen_midi = magenta.music.midi_io.note_sequence_to_pretty_midi(gen_seq)
-
-        # the primer sequence is included in the generated data, so strip it
-
-        new_notes = []
-        for note in gen_midi.instruments[0].notes:
-            if note.start >= gen_start_time:
-                new_note = pretty_midi.Note(
-                    note.velocity,
-                    note.pitch,
-                    note.start - gen_start_time,
-                    note.end - gen_start_time
-                )
-                new_notes.append(new_note)
-
-        gen_midi.instruments[0].notes = new_notes
-        gen_notes = midi_to_notes(gen_midi)
-
-        # add the new notes to the play queue
-        
-        self.queue.put(gen_notes)
+    def _generated(self, notes):
+        if notes is None:
+            self._outlet(1, "failed")
+            return
+
+        self._play([(float(t), int(pitch), int(vel)) for t, pitch, vel in notes])
         
     def _anything_1(self, *args):
         print_err("unhandled input:", args)
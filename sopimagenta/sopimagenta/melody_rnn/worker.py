@@ -0,0 +1,278 @@
+# based on https://github.com/googlecreativelab/aiexperiments-ai-duet
+
+from __future__ import print_function
+
+import copy
+import os
+import shutil
+import sys
+import tempfile
+
+import magenta
+from magenta.common import state_util
+from magenta.models.melody_rnn import melody_rnn_model, melody_rnn_sequence_generator
+from magenta.models.shared import events_rnn_model
+from magenta.models.shared.sequence_generator_bundle import read_bundle_file
+from magenta.music import constants
+from magenta.music.protobuf import generator_pb2, music_pb2
+import numpy as np
+import pretty_midi
+
+import sopilib.melody_rnn_protocol as protocol
+from sopilib.utils import print_err, read_msg, suppress_stdout
+import sopilib.worker
+
+def primer_to_note_sequence(notes, qpm):
+    primer_seq = music_pb2.NoteSequence()
+    primer_seq.ticks_per_quarter = constants.STANDARD_PPQ
+    primer_seq.tempos.add(qpm = qpm)
+
+    for start, end, pitch, vel in notes:
+        primer_seq.notes.add(
+            start_time = float(start),
+            end_time = float(end),
+            pitch = int(pitch),
+            velocity = int(vel)
+        )
+
+    primer_seq.total_time = float(notes["end"].max()) if len(notes) else 0.0
+
+    return primer_seq
+
+def midi_to_notes(midi):
+    notes = []
+
+    # split notes into on and off notes
+    for midi_note in midi.instruments[0].notes:
+        notes.append((midi_note.start, midi_note.pitch, midi_note.velocity))
+        notes.append((midi_note.end, midi_note.pitch, 0))
+
+    # sort notes by time
+    notes.sort(key = lambda n: n[0])
+
+    return notes
+
+def steps_to_seconds(steps, qpm):
+    return steps * 60.0 / qpm / 4.0
+
+def generate_options(primer_seq, qpm, duration):
+    gen_options = generator_pb2.GeneratorOptions()
+    last_end_time = max(n.end_time for n in primer_seq.notes) if primer_seq.notes else 0
+    gen_start_time = last_end_time + steps_to_seconds(1, qpm)
+    gen_end_time = gen_start_time + duration
+    gen_options.generate_sections.add(start_time = gen_start_time, end_time = gen_end_time)
+
+    return gen_options, gen_start_time
+
+def sequence_to_notes(gen_seq, gen_start_time):
+    gen_midi = magenta.music.midi_io.note_sequence_to_pretty_midi(gen_seq)
+
+    # the primer sequence is included in the generated data, so strip it
+
+    new_notes = []
+    for note in gen_midi.instruments[0].notes:
+        if note.start >= gen_start_time:
+            new_note = pretty_midi.Note(
+                note.velocity,
+                note.pitch,
+                note.start - gen_start_time,
+                note.end - gen_start_time
+            )
+            new_notes.append(new_note)
+
+    gen_midi.instruments[0].notes = new_notes
+    return midi_to_notes(gen_midi)
+
+def generate(generator, primer_seq, qpm, duration):
+    gen_options, gen_start_time = generate_options(primer_seq, qpm, duration)
+
+    with suppress_stdout():
+        gen_seq = generator.generate(primer_seq, gen_options)
+
+    return sequence_to_notes(gen_seq, gen_start_time)
+
+class candidates_model(melody_rnn_model.MelodyRnnModel):
+    """
+        A MelodyRnnModel that extends the primer melody into count melodies
+        at once: they are stepped through the model together, one session
+        run per step for each batch of candidates, instead of one whole
+        generation per candidate. generate_melody returns the first melody
+        and leaves all of them in self.melodies.
+    """
+    count = 1
+    melodies = []
+
+    def generate_melody(self, num_steps, primer_melody, temperature=1.0, **kwargs):
+        melody = copy.deepcopy(primer_melody)
+        transpose_amount = melody.squash(
+            self._config.min_note,
+            self._config.max_note,
+            self._config.transpose_to_key
+        )
+
+        # the same first step as _generate_events, for every candidate
+        inputs = self._config.encoder_decoder.get_inputs_batch([melody], full_length = True)
+        rnn_states = state_util.unbatch(self._session.run(self._session.graph.get_collection("initial_state")))
+        model_state = events_rnn_model.ModelState(
+            inputs = inputs[0],
+            rnn_state = rnn_states[0],
+            control_events = None,
+            control_state = None
+        )
+
+        melodies = [copy.deepcopy(melody) for i in range(self.count)]
+        model_states = [model_state] * self.count
+        logliks = np.zeros(self.count)
+        for step in range(num_steps - len(melody)):
+            melodies, model_states, logliks = self._generate_step(melodies, model_states, logliks, temperature)
+
+        for generated in melodies:
+            generated.transpose(-transpose_amount)
+
+        self.melodies = melodies
+        return melodies[0]
+
+def generate_candidates(generator, primer_seq, qpm, duration, count):
+    gen_options, gen_start_time = generate_options(primer_seq, qpm, duration)
+
+    model = generator._model
+    model.count = count
+    with suppress_stdout():
+        generator.generate(primer_seq, gen_options)
+
+    return [sequence_to_notes(melody.to_sequence(qpm = qpm), gen_start_time) for melody in model.melodies]
+
+def handle_generate(generator, candidates_generator, stdin, stdout, state):
+    generate_msg = read_msg(stdin, protocol.generate_struct.size)
+    request_id, duration, qpm, note_count = protocol.from_generate_msg(generate_msg)
+
+    notes_msg = read_msg(stdin, protocol.primer_notes_size(note_count)) if note_count else b""
+    notes = protocol.from_primer_notes_msg(notes_msg)
+
+    primer_seq = primer_to_note_sequence(notes, qpm)
+    gen_notes = generate(generator, primer_seq, qpm, duration)
+
+    stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_GENERATED))
+    stdout.write(protocol.to_generated_msg(request_id, len(gen_notes)))
+    stdout.write(protocol.to_notes_msg(gen_notes))
+    stdout.flush()
+
+def onset_matrix(candidates):
+    """
+        Pads the note-on pitches and times of each candidate into
+        (candidates, max notes) arrays, with a mask of the valid entries.
+    """
+    onsets = [c[c["vel"] > 0] for c in candidates]
+    counts = np.array([len(o) for o in onsets])
+    width = max(int(counts.max()) if len(counts) else 0, 1)
+
+    mask = np.arange(width) < counts[:, None]
+    pitches = np.zeros(mask.shape, dtype=np.int32)
+    times = np.zeros(mask.shape, dtype=np.float64)
+    if counts.sum():
+        pitches[mask] = np.concatenate([o["pitch"] for o in onsets])
+        times[mask] = np.concatenate([o["time"] for o in onsets])
+
+    return pitches, times, mask, counts
+
+def score_candidates(candidates, primer, duration, score_type):
+    pitches, times, mask, counts = onset_matrix(candidates)
+    has_notes = counts > 0
+
+    if score_type == protocol.SCORE_RANGE:
+        primer_range = np.ptp(primer["pitch"]) if len(primer) else 12
+        ranges = np.where(mask, pitches, -1).max(axis=1) - np.where(mask, pitches, 128).min(axis=1)
+        scores = -np.abs(ranges - primer_range).astype(np.float64)
+    elif score_type == protocol.SCORE_DENSITY:
+        primer_span = primer["end"].max() - primer["start"].min() if len(primer) else 0
+        primer_density = len(primer) / primer_span if primer_span > 0 else 4.0
+        scores = -np.abs(counts / max(duration, 1e-3) - primer_density)
+    elif score_type == protocol.SCORE_SIMILARITY:
+        rows = np.broadcast_to(np.arange(len(candidates))[:, None], mask.shape)
+        hists = np.zeros((len(candidates), 12))
+        np.add.at(hists, (rows[mask], pitches[mask] % 12), 1)
+
+        primer_hist = np.bincount(primer["pitch"] % 12, minlength=12).astype(np.float64) if len(primer) else np.ones(12)
+        norms = np.linalg.norm(hists, axis=1) * np.linalg.norm(primer_hist)
+        scores = hists @ primer_hist / np.maximum(norms, 1e-9)
+    else:
+        raise ValueError("unknown score type: {}".format(score_type))
+
+    # an empty continuation is never preferred
+    return np.where(has_notes, scores, -np.inf)
+
+def handle_generate_candidates(generator, candidates_generator, stdin, stdout, state):
+    generate_msg = read_msg(stdin, protocol.generate_candidates_struct.size)
+    request_id, duration, qpm, note_count, candidate_count, score_type = protocol.from_generate_candidates_msg(generate_msg)
+
+    notes_msg = read_msg(stdin, protocol.primer_notes_size(note_count)) if note_count else b""
+    notes = protocol.from_primer_notes_msg(notes_msg)
+
+    primer_seq = primer_to_note_sequence(notes, qpm)
+    candidates = [
+        np.array(gen_notes, dtype=protocol.note_dtype)
+        for gen_notes in generate_candidates(candidates_generator, primer_seq, qpm, duration, candidate_count)
+    ]
+
+    scores = score_candidates(candidates, notes, duration, score_type)
+    order = np.argsort(-scores, kind="stable")
+
+    stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_CANDIDATES))
+    stdout.write(protocol.to_candidates_msg(request_id, len(candidates)))
+    for i in order:
+        stdout.write(protocol.to_candidate_msg(scores[i], len(candidates[i])))
+        stdout.write(protocol.to_notes_msg(candidates[i]))
+    stdout.flush()
+
+handlers = {
+    protocol.IN_TAG_GENERATE: handle_generate,
+    protocol.IN_TAG_GENERATE_CANDIDATES: handle_generate_candidates
+}
+
+try:
+    bundle_path = sys.argv[1]
+    config_name = sys.argv[2]
+except IndexError:
+    print_err("usage: {} bundle_file config_name".format(os.path.basename(__file__)))
+    sys.exit(1)
+
+config = melody_rnn_model.default_configs[config_name]
+bundle_file = read_bundle_file(bundle_path)
+steps_per_quarter = 4
+# bundled graphs are exported with the batch size used for beam search,
+# usually 1, so candidates run on a graph rebuilt from the config with a
+# larger batch and restored from the bundle's checkpoint
+candidates_batch_size = 8
+
+with suppress_stdout():
+    generator = melody_rnn_sequence_generator.MelodyRnnSequenceGenerator(
+        model = melody_rnn_model.MelodyRnnModel(config),
+        details = config.details,
+        steps_per_quarter = steps_per_quarter,
+        bundle = bundle_file
+    )
+    generator.initialize()
+
+    candidates_config = copy.deepcopy(config)
+    candidates_config.hparams.batch_size = candidates_batch_size
+
+    checkpoint_dir = tempfile.mkdtemp()
+    try:
+        checkpoint_path = os.path.join(checkpoint_dir, "model.ckpt")
+        with open(checkpoint_path, "wb") as f:
+            f.write(bundle_file.checkpoint_file[0])
+
+        candidates_generator = melody_rnn_sequence_generator.MelodyRnnSequenceGenerator(
+            model = candidates_model(candidates_config),
+            details = config.details,
+            steps_per_quarter = steps_per_quarter,
+            checkpoint = checkpoint_path
+        )
+        candidates_generator.initialize()
+    finally:
+        shutil.rmtree(checkpoint_dir)
+
+worker = sopilib.worker.worker(protocol, generator, candidates_generator)
+worker.add_handlers(handlers)
+worker.start()
+worker.serve()
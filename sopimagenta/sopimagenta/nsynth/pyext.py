@@ -1,12 +1,15 @@
 from __future__ import print_function
 
-from functools import reduce
+from collections import OrderedDict
 import json
 import os
 import sys
+from types import SimpleNamespace
 
 import numpy as np
 
+from sopilib.pitch import closest_pitch_indices
+
 print("loading nsynth")
 
 try:
@@ -31,16 +34,41 @@ def load_settings(settings_path):
     with open(settings_path, "r") as f:
         return json.load(f)
 
-def load_audio(audio_path):
+def load_audio(audio_path, mmap=False):
+    if mmap:
+        return np.memmap(audio_path, dtype=np.int16, mode="r")
+
     with open(audio_path, "rb") as f:
         return np.fromfile(f, dtype=np.int16)
+
+def load_audio_f32_cache(audio_path, block_size=2**22):
+    # float32 copy of an int16 atlas, kept next to it so the conversion only
+    # happens once
+    cache_path = audio_path + ".f32"
+    audio = load_audio(audio_path, mmap=True)
+
+    cache_valid = (
+        os.path.exists(cache_path)
+        and os.path.getsize(cache_path) == audio.size * np.dtype(np.float32).itemsize
+        and os.path.getmtime(cache_path) >= os.path.getmtime(audio_path)
+    )
+
+    if not cache_valid:
+        print("writing float32 cache {}".format(cache_path))
+        cache = np.memmap(cache_path, dtype=np.float32, mode="w+", shape=audio.shape)
+        for i in range(0, audio.size, block_size):
+            cache[i:i+block_size] = audio[i:i+block_size].astype(np.float32) / 2**15
+        cache.flush()
+        del cache
+
+    return np.memmap(cache_path, dtype=np.float32, mode="r")
     
-# TODO: handle multiple instruments per corner
-def extract_samples(audio, rows, cols, length, pitches):
+def extract_layers(audio, layers, rows, cols, length, pitches):
+    # layers are separate instruments per corner, stored one grid after another
     if sorted(pitches) != pitches:
         raise ValueError("pitches list is not sorted")
     
-    n = rows * cols
+    n = layers * rows * cols
 
     n_pitches = len(audio) // n // length
     #print("pitches={}".format(pitches))
@@ -49,23 +77,102 @@ def extract_samples(audio, rows, cols, length, pitches):
     if len(pitches) != n_pitches:
         raise ValueError("n_pitches does not match length of pitches list")
 
-    samples = np.reshape(audio, (rows, cols, n_pitches, length))
+    samples = np.reshape(audio, (layers, rows, cols, n_pitches, length))
     pitches_arr = np.array(pitches, dtype=np.uint8)
                 
     return samples, pitches_arr
 
-def extract_samples_from_file(audio_path, settings):
+def extract_samples(audio, rows, cols, length, pitches):
+    samples, pitches_arr = extract_layers(audio, 1, rows, cols, length, pitches)
+
+    return samples[0], pitches_arr
+
+def extract_samples_from_file(audio_path, settings, mmap=False):
     rows = settings["nsynth"]["resolution"]
     cols = rows
     length = settings["nsynth"]["length"]
     pitches = settings["nsynth"]["pitches"]
         
-    audio = load_audio(audio_path)
+    audio = load_audio(audio_path, mmap)
     
     return extract_samples(audio, rows, cols, length, pitches)
 
-def offset(dims, indices):
-    return sum(j*reduce(lambda x, y: x*y, dims[i+1:], 1) for i, j in enumerate(indices))
+class atlas_index(object):
+    """
+        Memory-mapped atlases shared by all objects in this Python instance.
+        Each file is mapped once, however many names or objects refer to it.
+    """
+    def __init__(self):
+        self._maps = {}
+        self.atlases = {}
+
+    def map(self, audio_path, f32_cache=False):
+        key = (os.path.realpath(audio_path), bool(f32_cache))
+        audio = self._maps.get(key)
+
+        if audio is None:
+            if f32_cache:
+                audio = load_audio_f32_cache(audio_path)
+            else:
+                audio = load_audio(audio_path, mmap=True)
+            self._maps[key] = audio
+
+        return audio
+
+    def load(self, name, audio_path, settings):
+        layers = settings["nsynth"].get("layers", 1)
+        rows = settings["nsynth"]["resolution"]
+        cols = rows
+        length = settings["nsynth"]["length"]
+        pitches = settings["nsynth"]["pitches"]
+
+        samples, pitches_arr = extract_layers(self.map(audio_path), layers, rows, cols, length, pitches)
+
+        atlas = SimpleNamespace(
+            path = audio_path,
+            samples = samples,
+            pitches = pitches,
+            sample_rate = settings["nsynth"]["sampleRate"]
+        )
+        self.atlases[name] = atlas
+
+        return atlas
+
+    def unload(self, name):
+        atlas = self.atlases.pop(name)
+
+        if not any(a.path == atlas.path for a in self.atlases.values()):
+            for key in [key for key in self._maps if key[0] == os.path.realpath(atlas.path)]:
+                del self._maps[key]
+
+    def __getitem__(self, name):
+        return self.atlases[name]
+
+atlases = atlas_index()
+
+def bilinear_cells(y, x, rows, cols):
+    """
+        Returns the (row, col) indices of the four cells around a fractional
+        position (y and x in 0..1) and their bilinear weights.
+    """
+    r = y * (rows - 1)
+    c = x * (cols - 1)
+    r0 = min(int(r), rows - 1)
+    c0 = min(int(c), cols - 1)
+    r1 = min(r0 + 1, rows - 1)
+    c1 = min(c0 + 1, cols - 1)
+    fr = r - r0
+    fc = c - c0
+
+    cells = ((r0, c0), (r0, c1), (r1, c0), (r1, c1))
+    weights = np.array((
+        (1 - fr) * (1 - fc),
+        (1 - fr) * fc,
+        fr * (1 - fc),
+        fr * fc
+    ), dtype=np.float32)
+
+    return cells, weights
 
 class nsynth_loader(ext_class):
     def __init__(self, *args):
@@ -95,6 +202,93 @@ class nsynth_loader(ext_class):
         
         self._outlet(1, "loaded", [rows, cols, length, sample_rate] + pitches)
 
+class nsynth_mmap_loader(ext_class):
+    """
+        Maps the atlas instead of reading it, and only copies the pitches of
+        the current grid position into the Pd buffer. Use with a windowed
+        nsynth_controller, forwarding its position messages here.
+    """
+    def __init__(self, *args):
+        self._inlets = 1
+        self._outlets = 1
+
+        self.samples = None
+        self.buf_name = None
+        self.row = 0
+        self.col = 0
+
+    def load_1(self, audio_path, settings_path, buf_name, cache=0):
+        settings_path1 = os.path.join(self._canvas_dir, str(settings_path))
+        audio_path1 = os.path.join(self._canvas_dir, str(audio_path))
+
+        settings = load_settings(settings_path1)
+
+        rows = settings["nsynth"]["resolution"]
+        cols = rows
+        length = settings["nsynth"]["length"]
+        sample_rate = settings["nsynth"]["sampleRate"]
+        pitches = settings["nsynth"]["pitches"]
+
+        audio = atlases.map(audio_path1, cache)
+
+        self.samples, _ = extract_samples(audio, rows, cols, length, pitches)
+        self.buf_name = buf_name
+
+        buf = pyext.Buffer(buf_name)
+        window_length = len(pitches) * length
+        if len(buf) != window_length:
+            buf.resize(window_length)
+
+        self.row = 0
+        self.col = 0
+        self._write_window()
+
+        self._outlet(1, "loaded", [rows, cols, length, sample_rate] + pitches)
+
+    def position_1(self, row, col):
+        if self.samples is None:
+            return
+
+        rows, cols = self.samples.shape[:2]
+        row = min(max(int(row), 0), rows - 1)
+        col = min(max(int(col), 0), cols - 1)
+
+        if (row, col) != (self.row, self.col):
+            self.row = row
+            self.col = col
+            self._write_window()
+
+    def _write_window(self):
+        window = self.samples[self.row, self.col].reshape(-1)
+        if window.dtype == np.int16:
+            window = window.astype(np.float32) / 2**15
+
+        buf = pyext.Buffer(self.buf_name)
+        buf[:] = window
+        buf.dirty()
+
+class nsynth_atlas(ext_class):
+    """
+        Registers an atlas, possibly with several instrument layers, under a
+        name that nsynth_controllers can play from without their own copy.
+    """
+    def __init__(self, *args):
+        self._inlets = 1
+        self._outlets = 1
+
+    def load_1(self, name, audio_path, settings_path):
+        settings_path1 = os.path.join(self._canvas_dir, str(settings_path))
+        audio_path1 = os.path.join(self._canvas_dir, str(audio_path))
+
+        atlas = atlases.load(str(name), audio_path1, load_settings(settings_path1))
+        layers, rows, cols, n_pitches, length = atlas.samples.shape
+
+        self._outlet(1, "loaded", [name, layers, rows, cols, length, atlas.sample_rate] + atlas.pitches)
+
+    def unload_1(self, name):
+        atlases.unload(str(name))
+        self._outlet(1, "unloaded", name)
+
 class nsynth_controller(ext_class):
     def __init__(self, *args):
         self._inlets = 1
@@ -109,6 +303,32 @@ class nsynth_controller(ext_class):
         self.row = 0
         self.col = 0
 
+        # when windowed, the buffer only holds the pitches of the current
+        # position (see nsynth_mmap_loader)
+        self.windowed = False
+
+        # when morphing, notes are mixed from the four cells around the
+        # fractional position into voice buffers
+        self.morph_src = None
+        self.morph_voices = []
+        self.morph_voice_i = 0
+        self.morph_steps = 64
+        self.morph_cache = OrderedDict()
+        self.morph_cache_size = 32
+        self.y = 0.0
+        self.x = 0.0
+
+        # when playing from a shared atlas (see nsynth_atlas), notes are
+        # rendered into the voice buffers like morphed notes
+        self.atlas = None
+        self.atlas_data = None
+        self.layer = 0
+
+        # voice pool, allocated by voices_1
+        self.voice_pitch = None
+
+        self._build_tables()
+
     def _find_closest_pitch_i(self, pitch):
         i_r = np.searchsorted(self.pitches, pitch)
 
@@ -139,25 +359,309 @@ class nsynth_controller(ext_class):
         self.length = length
         self.sample_rate = sample_rate
         self.pitches = np.array(pitches, dtype=np.uint8)
+        self.morph_cache.clear()
+        self._build_tables()
+
+    def _build_tables(self):
+        # per-MIDI-pitch lookup tables so that a note-on is a few lookups
+        rows, cols, n_pitches, length = self.dimensions
+        self.pitch_stride = length
+        self.col_stride = n_pitches * self.pitch_stride
+        self.row_stride = cols * self.col_stride
+        self._update_cell_onset()
+
+        if n_pitches == 0:
+            self.pitch_i_table = None
+            return
+
+        midi_pitches = np.arange(128)
+        self.pitch_i_table = closest_pitch_indices(self.pitches.astype(np.int64), midi_pitches)
+        self.rate_table = 2.0**((midi_pitches - self.pitches[self.pitch_i_table].astype(np.int64))/12.0)
+        self.duration_table = float(self.length) / self.sample_rate * 1000 / self.rate_table
+
+    def _update_cell_onset(self):
+        self.cell_onset = self.row * self.row_stride + self.col * self.col_stride
+
+    def _note_params(self, pitch):
+        """
+            Returns the closest pitch index, playback rate and duration of a note.
+        """
+        i = int(pitch)
+        if i == pitch and 0 <= i < 128 and self.pitch_i_table is not None:
+            return int(self.pitch_i_table[i]), float(self.rate_table[i]), float(self.duration_table[i])
+
+        # fractional or out of range pitch
+        closest_pitch_i = int(self._find_closest_pitch_i(pitch))
+        rate = 2.0**((pitch - int(self.pitches[closest_pitch_i]))/12.0)
+        duration = float(self.length) / self.sample_rate * 1000 / rate
+
+        return closest_pitch_i, rate, duration
+
+    # morph src_buf voice_buf1 [voice_buf2 ...]: mix notes from the full atlas
+    # in src_buf into the voice buffers in turn; morph with no arguments turns
+    # morphing off
+    def morph_1(self, *args):
+        self.morph_cache.clear()
+        self.morph_voice_i = 0
+
+        if not args:
+            self.morph_src = None
+            if self.atlas is None:
+                self.morph_voices = []
+            return
+
+        if len(args) < 2:
+            raise ValueError("invalid syntax, should be: morph src_buf voice_buf1 [voice_buf2 ...]")
+
+        self.morph_src = args[0]
+        self.morph_voices = list(args[1:])
+        self.atlas = None
+        self.atlas_data = None
+
+    # atlas name voice_buf1 [voice_buf2 ...]: play from a shared atlas
+    def atlas_1(self, name, *voice_bufs):
+        if not voice_bufs:
+            raise ValueError("invalid syntax, should be: atlas name voice_buf1 [voice_buf2 ...]")
+
+        name = str(name)
+        if name not in atlases.atlases:
+            raise ValueError("no atlas named {}, load it with nsynth_atlas first".format(name))
+
+        atlas = atlases[name]
+        layers, rows, cols, n_pitches, length = atlas.samples.shape
+
+        self.atlas = name
+        self.atlas_data = atlas
+        self.layer = min(self.layer, layers - 1)
+        self.morph_voices = list(voice_bufs)
+        self.morph_voice_i = 0
+        self.loaded_1(rows, cols, length, atlas.sample_rate, *atlas.pitches)
+
+    def layer_1(self, layer):
+        layer = int(layer)
+        layers = self.atlas_data.samples.shape[0] if self.atlas_data is not None else None
+
+        if layer < 0 or (layers is not None and layer >= layers):
+            raise ValueError("no layer {}, atlas {} has {} layer(s)".format(layer, self.atlas, layers))
+
+        self.layer = layer
+        self.morph_cache.clear()
+
+    def _playable(self):
+        """
+            Detaches from the shared atlas if it was unloaded or loaded again
+            since atlas_1, so that notes aren't played from a stale grid.
+            Returns whether there is anything to play notes from.
+        """
+        if self.atlas is not None and atlases.atlases.get(self.atlas) is not self.atlas_data:
+            print("atlas {} was unloaded, use atlas again to play from it".format(self.atlas), file=sys.stderr)
+            self.atlas = None
+            self.atlas_data = None
+            if self.morph_src is None:
+                self.morph_voices = []
+            self.morph_voice_i = 0
+            self.loaded_1(0, 0, 0, self.sample_rate)
+
+        return len(self.pitches) > 0
+
+    def _morphing(self):
+        return self.morph_src is not None or self.atlas is not None
+
+    def _morph_source(self):
+        # flat samples of the grid being played, and their scale
+        if self.atlas is not None:
+            return self.atlas_data.samples[self.layer].reshape(-1), 1.0 / 2**15
+
+        return np.asarray(pyext.Buffer(self.morph_src)), 1.0
+
+    def morph_steps_1(self, steps):
+        self.morph_steps = max(1, int(steps))
+        self.morph_cache.clear()
+
+    def _morph_mix(self, pitch_i):
+        steps = self.morph_steps
+        qy = int(round(self.y * steps))
+        qx = int(round(self.x * steps))
+        key = (qy, qx, pitch_i)
+
+        mix = self.morph_cache.get(key)
+        if mix is not None:
+            self.morph_cache.move_to_end(key)
+            return mix
+
+        cells, weights = bilinear_cells(qy / steps, qx / steps, *self.dimensions[:2])
+
+        src, scale = self._morph_source()
+        onsets = [int(row * self.row_stride + col * self.col_stride + pitch_i * self.pitch_stride) for row, col in cells]
+        corners = np.stack([src[onset:onset+self.length] for onset in onsets])
+        mix = (weights * scale) @ corners
+
+        self.morph_cache[key] = mix
+        if len(self.morph_cache) > self.morph_cache_size:
+            self.morph_cache.popitem(last=False)
+
+        return mix
 
     def position_rel_1(self, y, x):
         row = round(y * (self.dimensions[0] - 1))
         col = round(x * (self.dimensions[1] - 1))
 
         self.position_1(row, col)
+
+        self.y = min(max(y, 0.0), 1.0)
+        self.x = min(max(x, 0.0), 1.0)
         
+    def windowed_1(self, windowed):
+        self.windowed = bool(windowed)
+
     def position_1(self, row, col):
         self.row = row
         self.col = col
+        self.y = row / max(self.dimensions[0] - 1, 1)
+        self.x = col / max(self.dimensions[1] - 1, 1)
+        self._update_cell_onset()
+
+        if self.windowed:
+            self._outlet(1, "position", row, col)
         
+    def _note_onset(self, closest_pitch_i, morph_voice_i):
+        if self._morphing():
+            mix = self._morph_mix(closest_pitch_i)
+
+            buf = pyext.Buffer(self.morph_voices[morph_voice_i])
+            if len(buf) != len(mix):
+                buf.resize(len(mix))
+            buf[:] = mix
+            buf.dirty()
+
+            return 0
+
+        # the dimensions arrive from Pd as floats
+        if self.windowed:
+            return int(closest_pitch_i * self.pitch_stride)
+
+        return int(self.cell_onset + closest_pitch_i * self.pitch_stride)
+
     def note_on_1(self, pitch):
-        closest_pitch_i = self._find_closest_pitch_i(pitch)
-        closest_pitch = self.pitches[closest_pitch_i]
-        rate = 2.0**((pitch - closest_pitch)/12.0)
+        if not self._playable():
+            return
+
+        if self.voice_pitch is not None:
+            self.notes_1(pitch, 127)
+            return
 
-        onset = int(offset(self.dimensions, (self.row, self.col, closest_pitch_i, 0)))
+        closest_pitch_i, rate, duration = self._note_params(pitch)
+
+        voice_i = self.morph_voice_i
+        onset = self._note_onset(closest_pitch_i, voice_i)
         start = 0
         end = self.length - 1
-        duration = float(self.length) / self.sample_rate * 1000 / rate
+
+        if self._morphing():
+            self.morph_voice_i = (voice_i + 1) % len(self.morph_voices)
+            self._outlet(1, "morph", voice_i, start, end, duration)
+            return
 
         self._outlet(1, "play", start, end, duration, onset)
+
+    # voices n: play notes through a pool of n voices, 0 turns voices off
+    def voices_1(self, n):
+        n = int(n)
+
+        if n <= 0:
+            self.voice_pitch = None
+            return
+
+        self.voice_pitch = np.full(n, -1, dtype=np.int16)
+        self.voice_onset = np.zeros(n, dtype=np.int64)
+        self.voice_start = np.zeros(n, dtype=np.int64)
+        self.voice_end = np.zeros(n, dtype=np.int64)
+        self.voice_rate = np.ones(n, dtype=np.float64)
+        self.voice_age = np.zeros(n, dtype=np.int64)
+        self.voice_counter = 0
+
+    def note_1(self, pitch, vel):
+        self.notes_1(pitch, vel)
+
+    # notes pitch1 vel1 [pitch2 vel2 ...]: note-ons (vel > 0) and note-offs
+    # (vel 0), answered with a single message:
+    # voices voice1 gate1 start1 end1 duration1 onset1 [voice2 ...]
+    def notes_1(self, *args):
+        if self.voice_pitch is None:
+            raise Exception("can't play notes - no voices allocated, use voices n first")
+
+        if len(args) % 2 != 0:
+            raise ValueError("invalid number of arguments ({}), should be a multiple of 2: notes pitch1 vel1 [pitch2 vel2 ...]".format(len(args)))
+
+        # note-offs still release voices after the atlas was unloaded
+        playable = self._playable()
+
+        updates = []
+        for i in range(0, len(args), 2):
+            pitch = int(args[i])
+            vel = args[i+1]
+
+            if vel > 0:
+                if playable:
+                    self._voice_on(pitch, updates)
+            else:
+                self._voice_off(pitch, updates)
+
+        if updates:
+            self._outlet(1, "voices", *updates)
+
+    def all_notes_off_1(self):
+        if self.voice_pitch is None:
+            return
+
+        updates = []
+        for voice_i in np.flatnonzero(self.voice_pitch >= 0):
+            self.voice_pitch[voice_i] = -1
+            updates.extend(self._voice_update(voice_i, 0))
+
+        if updates:
+            self._outlet(1, "voices", *updates)
+
+    def _voice_update(self, voice_i, gate):
+        start = int(self.voice_start[voice_i])
+        end = int(self.voice_end[voice_i])
+        rate = self.voice_rate[voice_i]
+        duration = float(end - start + 1) / self.sample_rate * 1000 / float(rate)
+
+        return (int(voice_i), gate, start, end, duration, int(self.voice_onset[voice_i]))
+
+    def _voice_on(self, pitch, updates):
+        n = len(self.voice_pitch)
+        if self._morphing():
+            # each voice renders into its own buffer, so only as many voices
+            # as there are buffers are used
+            n = min(n, len(self.morph_voices))
+
+        free = np.flatnonzero(self.voice_pitch[:n] < 0)
+        if len(free) > 0:
+            voice_i = free[0]
+        else:
+            # steal the oldest note
+            voice_i = int(np.argmin(self.voice_age[:n]))
+
+        closest_pitch_i, rate, duration = self._note_params(pitch)
+
+        self.voice_pitch[voice_i] = pitch
+        self.voice_onset[voice_i] = self._note_onset(closest_pitch_i, voice_i)
+        self.voice_start[voice_i] = 0
+        self.voice_end[voice_i] = self.length - 1
+        self.voice_rate[voice_i] = rate
+        self.voice_age[voice_i] = self.voice_counter
+        self.voice_counter += 1
+
+        updates.extend(self._voice_update(voice_i, 1))
+
+    def _voice_off(self, pitch, updates):
+        playing = np.flatnonzero(self.voice_pitch == pitch)
+        if len(playing) == 0:
+            return
+
+        voice_i = playing[np.argmin(self.voice_age[playing])]
+        self.voice_pitch[voice_i] = -1
+
+        updates.extend(self._voice_update(voice_i, 0))
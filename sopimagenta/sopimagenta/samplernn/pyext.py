@@ -0,0 +1,224 @@
+from __future__ import print_function
+
+try:
+    import pyext
+except:
+    print("ERROR: This script must be loaded by the PD/Max pyext external")
+
+import os
+import queue
+import sys
+import threading
+
+import numpy as np
+
+from sopilib.client import worker_client, worker_died
+import sopilib.samplernn_protocol as protocol
+from sopilib.utils import print_err
+
+class samplernn(pyext._class):
+    def __init__(self, *args):
+        self._inlets = 1
+        self._outlets = 1
+        self._worker = None
+        self._chunk_reader = None
+        self._results = queue.Queue()
+        self.sample_rate = 44100
+
+    def load_1(self, ckpt_path, config_path, model_sample_rate=16000):
+        if self._worker != None:
+            self.unload_1()
+
+        print("starting samplernn_worker process, this may take a while", file=sys.stderr)
+
+        self._worker = worker_client(
+            "samplernn_worker",
+            protocol,
+            os.path.join(self._canvas_dir, str(ckpt_path)),
+            os.path.join(self._canvas_dir, str(config_path)),
+            int(model_sample_rate)
+        )
+        self._worker.read_tag(protocol.OUT_TAG_INIT)
+
+        print("samplernn_worker is ready", file=sys.stderr)
+        self._outlet(1, "loaded")
+
+    def unload_1(self):
+        if self._worker:
+            self._worker.close()
+            self._worker = None
+        else:
+            print("no samplernn_worker process is running", file=sys.stderr)
+
+        self._outlet(1, "unloaded")
+
+    def sample_rate_1(self, sample_rate):
+        self.sample_rate = int(sample_rate)
+
+    # generate seed_buf duration out_buf1 temp1 [out_buf2 temp2 ...]: generate
+    # duration seconds of audio into each output buffer in one batch, seeded
+    # with the end of seed_buf ("-" for no seed)
+    def _generate_args(self, seed_buf_name, args):
+        if len(args) == 0 or len(args) % 2 != 0:
+            raise ValueError("invalid number of arguments, should be: seed_buf duration out_buf1 temp1 [out_buf2 temp2 ...]")
+
+        out_buf_names = args[0::2]
+        temperatures = args[1::2]
+
+        if str(seed_buf_name) == "-":
+            seed = np.zeros(0, dtype=np.float32)
+        else:
+            seed = np.array(pyext.Buffer(seed_buf_name), dtype=np.float32)
+
+        temp_msgs = []
+        for temperature in temperatures:
+            temp_msg = protocol.to_str_msg(str(float(temperature)))
+            temp_msgs.append(protocol.to_size_msg(len(temp_msg)))
+            temp_msgs.append(temp_msg)
+
+        return out_buf_names, seed, temp_msgs
+
+    def _generating(self):
+        return self._chunk_reader is not None and self._chunk_reader.is_alive()
+
+    def generate_1(self, seed_buf_name, duration, *args):
+        if not self._worker:
+            raise Exception("can't generate - no samplernn_worker process is running")
+
+        if self._generating():
+            raise Exception("can't generate - a chunked generation is running")
+
+        out_buf_names, seed, temp_msgs = self._generate_args(seed_buf_name, args)
+
+        generate_msg = protocol.to_generate_msg(
+            self.sample_rate,
+            self.sample_rate,
+            len(out_buf_names),
+            int(duration),
+            len(seed)
+        )
+        self._worker.write_msg(protocol.IN_TAG_GENERATE, generate_msg, protocol.to_audio_msg(seed), *temp_msgs)
+
+        self._worker.read_tag(protocol.OUT_TAG_GENERATED)
+
+        generated_msg = self._worker.read(protocol.generated_struct.size)
+        out_sr, out_count, out_len = protocol.from_generated_msg(generated_msg)
+
+        assert out_count == len(out_buf_names)
+
+        generated = self._worker.read_into(np.empty((out_count, out_len), dtype=protocol.audio_dtype))
+
+        for out_buf_name, audio in zip(out_buf_names, generated):
+            out_buf = pyext.Buffer(out_buf_name)
+            if len(out_buf) != out_len:
+                out_buf.resize(out_len)
+
+            out_buf[:] = audio
+            out_buf.dirty()
+
+        self._outlet(1, ["generated", out_count, out_len])
+
+    # generate_chunked chunk_len seed_buf duration out_buf1 temp1 [...]: like
+    # generate, but the output buffers are sized up front and filled chunk by
+    # chunk on the polls while generation runs, with a "chunk" message after
+    # each chunk so that playback can start early. cancel stops the generation
+    def generate_chunked_1(self, chunk_len, seed_buf_name, duration, *args):
+        if not self._worker:
+            raise Exception("can't generate - no samplernn_worker process is running")
+
+        if self._generating():
+            raise Exception("can't generate - a chunked generation is running")
+
+        out_buf_names, seed, temp_msgs = self._generate_args(seed_buf_name, args)
+
+        out_len = int(duration) * self.sample_rate
+        for out_buf_name in out_buf_names:
+            out_buf = pyext.Buffer(out_buf_name)
+            if len(out_buf) != out_len:
+                out_buf.resize(out_len)
+
+        generate_msg = protocol.to_generate_chunked_msg(
+            self.sample_rate,
+            self.sample_rate,
+            len(out_buf_names),
+            int(duration),
+            len(seed),
+            int(chunk_len)
+        )
+        self._worker.write_msg(protocol.IN_TAG_GENERATE_CHUNKED, generate_msg, protocol.to_audio_msg(seed), *temp_msgs)
+
+        self._chunk_reader = threading.Thread(target = self._keep_reading_chunks, args = (out_buf_names,), daemon = True)
+        self._chunk_reader.start()
+
+    def cancel_1(self):
+        if not self._generating():
+            print_err("no chunked generation is running")
+            return
+
+        self._worker.write_msg(protocol.IN_TAG_CANCEL)
+
+    # poll: apply the chunks that arrived since the last poll to the output
+    # arrays and outlet; bang it from a [metro] while generate_chunked runs
+    def poll_1(self):
+        while True:
+            try:
+                deliver, reply = self._results.get_nowait()
+            except queue.Empty:
+                return
+
+            deliver(reply)
+
+    def _on_pd_thread(self, fn):
+        """
+            Returns a callback for the reader thread that passes its argument
+            to fn on the next poll.
+        """
+        return lambda reply: self._results.put((fn, reply))
+
+    def _chunk(self, out_buf_names, offset, chunk):
+        chunk_len = chunk.shape[1]
+
+        for out_buf_name, audio in zip(out_buf_names, chunk):
+            out_buf = pyext.Buffer(out_buf_name)
+            end = min(offset + chunk_len, len(out_buf))
+            out_buf[offset:end] = audio[:end - offset]
+            out_buf.dirty()
+
+        self._outlet(1, ["chunk", offset, chunk_len])
+
+    def _keep_reading_chunks(self, out_buf_names):
+        write_chunk = self._on_pd_thread(lambda args: self._chunk(out_buf_names, *args))
+        outlet = self._on_pd_thread(lambda msg: self._outlet(1, msg))
+
+        try:
+            while True:
+                self._worker.read_tag(protocol.OUT_TAG_CHUNK)
+
+                chunk_msg = self._worker.read(protocol.chunk_struct.size)
+                offset, chunk_len, last = protocol.from_chunk_msg(chunk_msg)
+
+                chunk = self._worker.read_into(np.empty((len(out_buf_names), chunk_len), dtype=protocol.audio_dtype))
+
+                if chunk_len:
+                    write_chunk((offset, chunk))
+
+                if last:
+                    break
+        except worker_died as e:
+            print_err("samplernn_worker exited during generation: {}".format(e))
+            outlet("failed")
+            return
+
+        # the last chunk holds the end of the resampled output
+        outlet(["generated", len(out_buf_names), offset + chunk_len])
+
+    def metrics_1(self):
+        if not self._worker:
+            raise Exception("can't get metrics - no samplernn_worker process is running")
+
+        # the worker's stdout belongs to the reader thread until it finishes
+        if self._generating():
+            raise Exception("can't get metrics - a chunked generation is running")
+
+        for tag, (count, total, longest) in self._worker.metrics().items():
+            self._outlet(1, ["metrics", tag, count, total, longest])
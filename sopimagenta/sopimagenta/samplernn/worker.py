@@ -0,0 +1,277 @@
+# based on generate.py from https://github.com/rncm-prism/prism-samplernn
+
+from __future__ import print_function
+
+import json
+import math
+import os
+import sys
+
+import librosa
+import numpy as np
+import tensorflow as tf
+
+from samplernn import SampleRNN, dequantize, quantize
+
+import sopilib.samplernn_protocol as protocol
+from sopilib.utils import print_err, read_msg, suppress_stdout
+import sopilib.worker
+
+def create_inference_model(ckpt_path, batch_size, config):
+    model = SampleRNN(
+        batch_size = batch_size,
+        frame_sizes = config["frame_sizes"],
+        seq_len = config["seq_len"],
+        q_type = config["q_type"],
+        q_levels = config["q_levels"],
+        dim = config["dim"],
+        rnn_type = config.get("rnn_type"),
+        num_rnn_layers = config["num_rnn_layers"],
+        emb_size = config["emb_size"],
+        skip_conn = config.get("skip_conn"),
+        rnn_dropout = config.get("rnn_dropout")
+    )
+    num_samps = config["seq_len"] + model.big_frame_size
+    model(np.zeros((batch_size, num_samps, 1), dtype=np.float32))
+    model.load_weights(ckpt_path).expect_partial()
+
+    return model
+
+class model_cache(object):
+    """
+        The network is built for a fixed batch size, so one model is kept per
+        number of outputs.
+    """
+    def __init__(self, ckpt_path, config):
+        self.ckpt_path = ckpt_path
+        self.config = config
+        self.models = {}
+
+    def get(self, batch_size):
+        if batch_size not in self.models:
+            with suppress_stdout():
+                self.models[batch_size] = create_inference_model(self.ckpt_path, batch_size, self.config)
+
+        return self.models[batch_size]
+
+def generate_chunks(model, seed, num_samps, temperatures, chunk_len):
+    """
+        Generates one output per row of the model batch, all rows stepping
+        together, each sampled at its own temperature. seed is a quantized
+        big frame shared by all rows. Yields (outputs, chunk_len) arrays of
+        audio as generation goes.
+    """
+    batch_size = model.batch_size
+    big_frame_size = model.big_frame_size
+    frame_size = model.frame_size
+    q_levels = model.q_levels
+
+    samples = np.full((batch_size, big_frame_size + num_samps, 1), q_levels // 2, dtype=np.int32)
+    samples[:, :big_frame_size, 0] = seed
+
+    inv_temperatures = tf.constant(1.0 / np.asarray(temperatures, dtype=np.float32)[:, np.newaxis])
+
+    if hasattr(model, "reset_states"):
+        model.reset_states()
+
+    big_frame_outputs = None
+    frame_outputs = None
+    chunk_start = big_frame_size
+    for t in range(big_frame_size, big_frame_size + num_samps):
+        if t % big_frame_size == 0:
+            big_frame_outputs = model.big_frame_rnn(
+                tf.cast(samples[:, t - big_frame_size:t, :], tf.float32),
+                num_steps = 1
+            )
+
+        if t % frame_size == 0:
+            big_frame_output_i = (t // frame_size) % (big_frame_size // frame_size)
+            frame_outputs = model.frame_rnn(
+                tf.cast(samples[:, t - frame_size:t, :], tf.float32),
+                num_steps = 1,
+                conditioning_frames = tf.expand_dims(big_frame_outputs[:, big_frame_output_i, :], 1)
+            )
+
+        frame_output_i = t % frame_size
+        sample_outputs = model.sample_mlp(
+            samples[:, t - frame_size:t, :],
+            conditioning_frames = tf.expand_dims(frame_outputs[:, frame_output_i, :], 1)
+        )
+        logits = tf.reshape(sample_outputs, [-1, q_levels]) * inv_temperatures
+        samples[:, t, 0] = tf.random.categorical(logits, 1)[:, 0].numpy()
+
+        if t + 1 - chunk_start == chunk_len or t + 1 == big_frame_size + num_samps:
+            chunk = dequantize(samples[:, chunk_start:t + 1, 0], model.q_type, q_levels)
+            yield np.asarray(chunk, dtype=np.float32)
+            chunk_start = t + 1
+
+def generate(model, seed, num_samps, temperatures):
+    chunks = list(generate_chunks(model, seed, num_samps, temperatures, num_samps))
+    return np.concatenate(chunks, axis=1) if chunks else np.zeros((model.batch_size, 0), dtype=np.float32)
+
+class chunk_resampler(object):
+    """
+        Resamples consecutive chunks of a batch of outputs as one signal. The
+        output near the end of a chunk depends on input that hasn't been
+        generated yet, so the last half filter length of input is held back
+        until the next chunk, and each chunk is resampled along with half a
+        filter length of the input before it. This way chunk edges come out
+        as if the whole signal was resampled at once and don't click. end()
+        returns the output of the held back input.
+    """
+    # librosa's default filters reach this many zero crossings to each side
+    zero_crossings = 64
+
+    def __init__(self, src_rate, dst_rate, batch_size):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+
+        # resampled segments start on input samples that fall on an output
+        # sample, so that their output lines up with the output so far
+        self.step = src_rate // math.gcd(src_rate, dst_rate)
+        self.half_filter = int(np.ceil(self.zero_crossings * max(1.0, src_rate / dst_rate)))
+
+        self.input = np.zeros((batch_size, 0), dtype=np.float32)
+        self.input_start = 0
+        self.in_len = 0
+        self.out_len = 0
+
+    def _out_pos(self, n):
+        return n * self.dst_rate // self.src_rate
+
+    def __call__(self, chunk):
+        if self.src_rate == self.dst_rate:
+            return chunk
+
+        self.input = np.concatenate((self.input, chunk), axis=1)
+        self.in_len += chunk.shape[1]
+
+        return self._resample(self._out_pos(max(self.in_len - self.half_filter, 0)))
+
+    def end(self):
+        if self.src_rate == self.dst_rate:
+            return np.zeros((self.input.shape[0], 0), dtype=np.float32)
+
+        # the signal ends in silence
+        self.input = np.pad(self.input, ((0, 0), (0, self.half_filter)))
+
+        return self._resample(int(round(self.in_len * self.dst_rate / self.src_rate)))
+
+    def _resample(self, out_end):
+        out_chunk_len = max(0, out_end - self.out_len)
+        if out_chunk_len == 0:
+            return np.zeros((self.input.shape[0], 0), dtype=np.float32)
+
+        y = np.stack([librosa.resample(row, orig_sr=self.src_rate, target_sr=self.dst_rate) for row in self.input])
+
+        first = self.out_len - self._out_pos(self.input_start)
+        y = y[:, first:first + out_chunk_len]
+        if y.shape[1] < out_chunk_len:
+            y = np.pad(y, ((0, 0), (0, out_chunk_len - y.shape[1])))
+        self.out_len += out_chunk_len
+
+        # keep half a filter length of input before the next output sample
+        next_in = self.out_len * self.src_rate // self.dst_rate
+        keep_from = max((next_in - self.half_filter) // self.step * self.step, self.input_start)
+        self.input = self.input[:, keep_from - self.input_start:]
+        self.input_start = keep_from
+
+        return y.astype(np.float32)
+
+def read_generate_args(stdin, seed_sr, num_outputs, seed_len):
+    seed_msg = read_msg(stdin, seed_len * protocol.f32_struct.size) if seed_len else b""
+    seed_audio = protocol.from_audio_msg(seed_msg)
+
+    temperatures = []
+    for i in range(num_outputs):
+        temp_len = protocol.from_size_msg(read_msg(stdin, protocol.size_struct.size))
+        temperatures.append(max(float(protocol.from_str_msg(read_msg(stdin, temp_len))), 1e-3))
+
+    model = models.get(num_outputs)
+
+    # the seed is the last big frame of the seed audio, silence if there is none
+    seed = np.full(model.big_frame_size, model.q_levels // 2, dtype=np.int32)
+    if seed_len:
+        if seed_sr != sample_rate:
+            seed_audio = librosa.resample(seed_audio, orig_sr=seed_sr, target_sr=sample_rate)
+        seed_audio = seed_audio[-model.big_frame_size:]
+        seed[-len(seed_audio):] = np.asarray(quantize(seed_audio, model.q_type, model.q_levels))
+
+    return model, seed, temperatures
+
+def handle_generate(models, stdin, stdout, state):
+    generate_msg = read_msg(stdin, protocol.generate_struct.size)
+    seed_sr, out_sr, num_outputs, duration, seed_len = protocol.from_generate_msg(generate_msg)
+
+    model, seed, temperatures = read_generate_args(stdin, seed_sr, num_outputs, seed_len)
+    generated = generate(model, seed, duration * sample_rate, temperatures)
+
+    if out_sr != sample_rate:
+        generated = np.stack([
+            librosa.resample(audio, orig_sr=sample_rate, target_sr=out_sr)
+            for audio in generated
+        ])
+    generated = np.ascontiguousarray(generated, dtype=protocol.audio_dtype)
+
+    stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_GENERATED))
+    stdout.write(protocol.to_generated_msg(out_sr, num_outputs, generated.shape[1]))
+    # one contiguous (outputs, length) block, written without copying
+    stdout.write(memoryview(generated).cast("B"))
+    stdout.flush()
+
+def write_chunk(stdout, offset, chunk, last):
+    chunk = np.ascontiguousarray(chunk, dtype=protocol.audio_dtype)
+
+    stdout.write(protocol.to_tag_msg(protocol.OUT_TAG_CHUNK))
+    stdout.write(protocol.to_chunk_msg(offset, chunk.shape[1], last))
+    stdout.write(memoryview(chunk).cast("B"))
+    stdout.flush()
+
+def handle_generate_chunked(models, stdin, stdout, state):
+    generate_msg = read_msg(stdin, protocol.generate_chunked_struct.size)
+    seed_sr, out_sr, num_outputs, duration, seed_len, chunk_len = protocol.from_generate_chunked_msg(generate_msg)
+
+    model, seed, temperatures = read_generate_args(stdin, seed_sr, num_outputs, seed_len)
+
+    # chunk_len is in output samples, generation runs at the model rate
+    model_chunk_len = max(1, int(round(chunk_len * sample_rate / out_sr)))
+    resample = chunk_resampler(sample_rate, out_sr, num_outputs)
+
+    offset = 0
+    for chunk in generate_chunks(model, seed, duration * sample_rate, temperatures, model_chunk_len):
+        chunk = resample(chunk)
+        write_chunk(stdout, offset, chunk, False)
+        offset += chunk.shape[1]
+
+        if sopilib.worker.cancel_requested(stdin, protocol):
+            break
+
+    write_chunk(stdout, offset, resample.end(), True)
+
+def handle_cancel(models, stdin, stdout, state):
+    # the generation finished before the cancel arrived
+    pass
+
+handlers = {
+    protocol.IN_TAG_GENERATE: handle_generate,
+    protocol.IN_TAG_GENERATE_CHUNKED: handle_generate_chunked,
+    protocol.IN_TAG_CANCEL: handle_cancel
+}
+
+try:
+    ckpt_path = sys.argv[1]
+    config_path = sys.argv[2]
+    sample_rate = int(sys.argv[3]) if len(sys.argv) > 3 else 16000
+except IndexError:
+    print_err("usage: {} checkpoint config_file [sample_rate]".format(os.path.basename(__file__)))
+    sys.exit(1)
+
+with open(config_path, "r") as config_file:
+    config = json.load(config_file)
+
+models = model_cache(ckpt_path, config)
+
+worker = sopilib.worker.worker(protocol, models)
+worker.add_handlers(handlers)
+worker.start()
+worker.serve()